@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:59:02 2026
+
+Benchmarks for the image analysis that runs between scans. Every function is
+timed on synthetic STM images from 128 to 2048 pixels, both complete and
+NaN-padded (a frame that's partway through being scanned), and the results are
+saved per commit so they can be compared.
+
+    python benchmarks/analysis.py                           # Everything. Saves benchmarks/results/analysis-<commit>.json
+    python benchmarks/analysis.py -k isClean -s 512 1024    # Some of it
+    python benchmarks/analysis.py compare old.json new.json # Compare two runs
+    python benchmarks/analysis.py --against old.json        # Run, save and compare against an earlier run
+
+Reported per function, size and frame kind:
+    time       : Median wall clock time per call (s)
+    best       : Fastest call (s)
+    peakMemory : Peak memory allocated by numpy/Python during one call
+                 (bytes). Allocations made inside OpenCV aren't seen by
+                 tracemalloc
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import warnings
+
+import numpy as np
+from scipy import ndimage
+
+SIZES   = [128,256,512,1024,2048]
+KINDS   = ["full","partial"]
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+###############################################################################
+# Synthetic images
+###############################################################################
+def syntheticImage(pixels,lxy=50e-9,seed=0):
+    """
+    A scan of a few terraces with adsorbates, noise and tip changes. Heights
+    are in m like a z channel grabbed from the instrument.
+
+    Parameters
+    ----------
+    pixels : Pixels (and lines) in the image
+    lxy    : Width of the frame (m)
+    seed   : Random seed
+
+    Returns
+    -------
+    scanData : pixels x pixels image
+
+    """
+    rng  = np.random.default_rng(seed)
+    y,x  = np.mgrid[0:pixels,0:pixels]*(lxy/pixels)
+    u    = x*np.cos(0.3) + y*np.sin(0.3) + 2e-9*np.sin(y/7e-9)                  # Meandering step edges
+    z    = 1.2e-10*np.floor(u/15e-9) + 2e-12*x/lxy                              # Terraces on a slight tilt
+
+    n    = int(40*(lxy/50e-9)**2)
+    cx   = rng.uniform(0,lxy,n)
+    cy   = rng.uniform(0,lxy,n)
+    blobs = np.zeros((pixels,pixels))
+    blobs[(cy/lxy*pixels).astype(int),(cx/lxy*pixels).astype(int)] = 1
+    sigma = 0.6e-9/lxy*pixels
+    z    += 2e-10*ndimage.gaussian_filter(blobs, sigma)*2*np.pi*sigma**2        # Adsorbates about 1 nm across
+
+    for row in rng.choice(pixels, 4, replace=False):                            # Tip changes: the tip jumps for the rest of the frame
+        z[row:] += rng.choice([-1,1])*3e-11
+
+    z += rng.normal(0, 4e-12, z.shape)
+    return z
+
+def imprintImage(pixels,lxy=10e-9,seed=0):
+    """
+    A small frame over a tip shaper imprint, as assessed after tip shaping.
+    The imprint is just above and to the right of the centre
+
+    """
+    rng  = np.random.default_rng(seed)
+    y,x  = np.mgrid[0:pixels,0:pixels]*(lxy/pixels) - lxy/2
+    r2   = ((x - 1e-9)**2 + (y + 1e-9)**2)/(1e-9)**2
+    z    = 3e-10*np.exp(-r2) + rng.normal(0, 4e-12, (pixels,pixels))
+    return z
+
+def partial(scanData,fraction=0.5):
+    """
+    NaN-pad the rows that haven't been scanned yet, the way the instrument
+    returns a frame that's still being scanned
+
+    """
+    scanData = scanData.copy()
+    scanData[int(fraction*len(scanData)):] = np.nan
+    return scanData
+
+###############################################################################
+# Cases
+###############################################################################
+def cases(moduleDir):
+    """
+    Functions to benchmark, keyed by name. Each entry is the kind of image it
+    works on ('survey' or 'imprint') and a function that takes that image and
+    returns a callable doing the work once. The callable works on a fresh
+    copy each call since some of these functions modify their input.
+
+    """
+    from scanbot.server import utilities
+    from scanbot.server import nanonispyfit as napfit
+    from scanbot.server.scanbot import scanbot
+
+    bot = scanbot(types.SimpleNamespace(module_dir=moduleDir + '/'))            # makePNG only needs somewhere to write
+    lxy = 50e-9
+
+    def frameOffset(im):
+        moved = np.roll(im, (5,-3), axis=(0,1))
+        return lambda: utilities.getFrameOffset(im, moved, dxy=[lxy/len(im)]*2)
+
+    return {"nanonispyfit.plane"        : ("survey",  lambda im: lambda: napfit.flatten(im.copy(), 'plane')),
+            "nanonispyfit.line"         : ("survey",  lambda im: lambda: napfit.flatten(im.copy(), 'line')),
+            "nanonispyfit.filter_sigma" : ("survey",  lambda im: lambda: napfit.filter_sigma(np.nan_to_num(im))),
+            "getFrameOffset"            : ("survey",  frameOffset),
+            "classify"                  : ("survey",  lambda im: lambda: utilities.classify(im.copy(), "bench.sxm", [])),
+            "findTipChanges"            : ("survey",  lambda im: lambda: utilities.findTipChanges(im.copy())),
+            "isClean"                   : ("survey",  lambda im: lambda: utilities.isClean(im.copy(), lxy)),
+            "findIslands"               : ("survey",  lambda im: lambda: utilities.findIslands(im.copy(), [lxy,lxy])),
+            "meanCurvature"             : ("survey",  lambda im: lambda: utilities.meanCurvature(im.copy(), [lxy/len(im)]*2)),
+            "assessTip"                 : ("imprint", lambda im: lambda: utilities.assessTip(im.copy(), 10e-9, [1e-9,1e-9])),
+            "makePNG"                   : ("survey",  lambda im: lambda: bot.makePNG(im.copy(), pngFilename='bench.png'))}
+
+###############################################################################
+# Measurement
+###############################################################################
+def measure(work,minTime=0.5,maxCalls=50):
+    """
+    Time a callable and measure its peak memory
+
+    Parameters
+    ----------
+    work     : Does the work once
+    minTime  : Keep calling work until this much time has passed (s)...
+    maxCalls : ...or it's been called this many times
+
+    Returns
+    -------
+    result : dictionary with time, best, calls and peakMemory
+
+    """
+    work()                                                                      # Warm up caches (fft plans, lru_caches, imports)
+
+    times = []
+    start = time.perf_counter()
+    while(len(times) < 3 or (time.perf_counter() - start < minTime and len(times) < maxCalls)):
+        t = time.perf_counter()
+        work()
+        times.append(time.perf_counter() - t)
+
+    tracemalloc.start()                                                         # Measured separately so it doesn't slow the timed calls
+    tracemalloc.reset_peak()
+    work()
+    _,peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"time"       : statistics.median(times),
+            "best"       : min(times),
+            "calls"      : len(times),
+            "peakMemory" : peak}
+
+def commit():
+    """
+    Short hash of the checked out commit, marked dirty if there are
+    uncommitted changes. 'unknown' outside a git repository
+
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        sha   = subprocess.run(["git","rev-parse","--short","HEAD"],cwd=root,capture_output=True,text=True,check=True).stdout.strip()
+        dirty = subprocess.run(["git","status","--porcelain","--untracked-files=no"],cwd=root,capture_output=True,text=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        return "unknown"
+    return sha + ("-dirty" if dirty else "")
+
+def run(args):
+    with tempfile.TemporaryDirectory() as moduleDir:
+        with contextlib.redirect_stdout(open(os.devnull,'w')):
+            allCases = cases(moduleDir)
+        names = [name for name in allCases if not args.k or any(k in name for k in args.k)]
+
+        results = {"commit": commit(), "timestamp": time.time(), "settings": vars(args), "results": {}}
+        for size in args.sizes:
+            survey,imprint = syntheticImage(size),imprintImage(size)
+            images = {"survey"  : {"full": survey,  "partial": partial(survey)},
+                      "imprint" : {"full": imprint, "partial": partial(imprint,0.75)}} # Enough of the imprint scanned to assess it
+
+            for name in names:
+                family,factory = allCases[name]
+                for kind in args.kinds:
+                    work = factory(images[family][kind])
+
+                    key = name + "/" + str(size) + "/" + kind
+                    try:
+                        with contextlib.redirect_stdout(open(os.devnull,'w')), warnings.catch_warnings():
+                            warnings.simplefilter("ignore")                     # NaN-padded frames warn on every call
+                            result = measure(work,args.min_time)
+                    except Exception as e:
+                        result = {"error": type(e).__name__ + ": " + str(e)}
+                    results["results"][key] = result
+                    print(summary(key,result))
+    return results
+
+###############################################################################
+# Comparison
+###############################################################################
+def summary(key,result):
+    if("error" in result): return key.ljust(40) + "  ERROR: " + result["error"]
+    return (key.ljust(40)
+            + ("%.3f ms" % (1e3*result["time"])).rjust(14)
+            + ("%.1f MB" % (result["peakMemory"]/2**20)).rjust(12))
+
+def compare(old,new,threshold=0.1):
+    """
+    Print the change in time and memory for every benchmark in both runs
+
+    Parameters
+    ----------
+    old,new   : Results loaded from two runs
+    threshold : Flag changes bigger than this fraction as regressions
+
+    Returns
+    -------
+    regressions : Number of benchmarks that got slower or use more memory by
+                  more than threshold
+
+    """
+    print("old: " + old["commit"] + "  new: " + new["commit"])
+    print("".ljust(40) + "old time".rjust(12) + "new time".rjust(12) + "speedup".rjust(10) + "memory".rjust(10))
+
+    regressions = 0
+    for key,b in new["results"].items():
+        a = old["results"].get(key)
+        if(a is None or "error" in a or "error" in b): continue
+        speedup = a["time"]/b["time"]
+        memory  = b["peakMemory"]/a["peakMemory"] if a["peakMemory"] else 1
+        flag    = ""
+        if(speedup < 1/(1 + threshold) or memory > 1 + threshold):
+            flag = "  <-- regression"
+            regressions += 1
+        print(key.ljust(40)
+              + ("%.3f ms" % (1e3*a["time"])).rjust(12)
+              + ("%.3f ms" % (1e3*b["time"])).rjust(12)
+              + ("%.2fx" % speedup).rjust(10)
+              + ("%.2fx" % memory).rjust(10) + flag)
+
+    return regressions
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+###############################################################################
+# Command line
+###############################################################################
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Benchmark Scanbot's image analysis")
+    parser.add_argument('files', nargs='*', help="compare OLD NEW: compare two saved runs instead of benchmarking")
+    parser.add_argument('-k', nargs='+', default=[], help="only benchmark functions whose name contains one of these")
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES, help="image sizes (pixels)")
+    parser.add_argument('--kinds', nargs='+', default=KINDS, choices=KINDS, help="complete and/or NaN-padded frames")
+    parser.add_argument('--min-time', type=float, default=0.5, help="time each benchmark for at least this long (s)")
+    parser.add_argument('-o', '--output', default="", help="save the results here. Default: benchmarks/results/analysis-<commit>.json")
+    parser.add_argument('--against', default="", help="compare the results against this earlier run")
+    parser.add_argument('--threshold', type=float, default=0.1, help="flag slow downs or memory increases bigger than this fraction")
+    return parser.parse_args()
+
+def main():
+    args = parseArgs()
+
+    if(args.files):
+        if(len(args.files) != 3 or args.files[0] != "compare"): sys.exit("Usage: analysis.py compare OLD NEW")
+        regressions = compare(load(args.files[1]),load(args.files[2]),args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    results = run(args)
+
+    output = args.output or os.path.join(RESULTS, "analysis-" + results["commit"] + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output,'w') as f:
+        json.dump(results,f,indent=1)
+    print("Saved " + output)
+
+    if(args.against):
+        print()
+        regressions = compare(load(args.against),results,args.threshold)
+        sys.exit(1 if regressions else 0)
+
+if(__name__ == "__main__"):
+    main()
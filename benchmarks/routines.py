@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:58:14 2026
+
+End to end benchmarks of Scanbot's routines against the simulated Nanonis
+instrument in scanbot/server/nanonis_sim.py. Each routine is run through the
+same command interface the app uses and timed per frame.
+
+    python benchmarks/routines.py                       # Every routine
+    python benchmarks/routines.py survey zdep -px 256   # Some of them
+    python benchmarks/routines.py -o results.json       # Save the results
+
+Reported per routine:
+    frames      : Scans completed by the instrument
+    wall        : Wall clock time for the whole routine (s)
+    cpu         : CPU time used by Scanbot (s). The simulator's share is
+                  taken out
+    scanning    : Wall clock time the instrument spent scanning (s)
+    idle        : Wall clock time the instrument sat between scans (s). This
+                  is the time lost to processing, uploads and fixed sleeps
+    peakMemory  : Peak memory allocated by Python while the routine ran
+                  (bytes)
+    roundTrips  : Number of TCP commands sent to the instrument
+    ...PerFrame : The above divided by the number of frames
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROUTINES = {"survey"         : ["survey","-n=2","-xy=20e-9","-st=0"],
+            "survey2"        : ["survey2","-n=1","-nx=2","-ny=1","-xy=20e-9","-st=0","-zStep=10","-xStep=10","-yStep=10"],
+            "bias_dep"       : ["bias_dep","-n=3","-bi=-1","-bf=1","-pxdc=64","-gif=1"],
+            "zdep"           : ["zdep","-nz=3","-bset=-0.1","-dcbias=0","-gif=1"],
+            "auto_tip_shape" : ["auto_tip_shape","-n=4","-wh=10e-9","-st=0","-sym=0.5","-size=5"]}
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Benchmark Scanbot routines against a simulated instrument")
+    parser.add_argument('routines', nargs='*', default=list(ROUTINES), help="routines to run: " + ", ".join(ROUTINES))
+    parser.add_argument('-px', type=int, default=128, help="pixels (and lines) per frame")
+    parser.add_argument('-t', '--time-scale', type=float, default=50, help="instrument time runs this many times faster than the wall clock")
+    parser.add_argument('--line-time', type=float, default=0.2, help="forward time per line on the instrument (s)")
+    parser.add_argument('--tip-change-rate', type=float, default=0, help="average tip changes per scanned line")
+    parser.add_argument('--crash-probability', type=float, default=0, help="chance of a crash on each coarse XY move")
+    parser.add_argument('--drift', type=float, nargs=2, default=[0,0], help="sample drift vx vy (m/s)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600, help="give up on a routine after this long (s)")
+    parser.add_argument('-o', '--output', default="", help="write the results to this json file")
+    parser.add_argument('-v', '--verbose', action='store_true', help="show Scanbot's output")
+    return parser.parse_args()
+
+def runRoutine(interface,sim,name,timeout,verbose):
+    from scanbot.server import global_
+
+    command,*userArgs = ROUTINES[name]
+    firstEvent = len(sim.events)
+    commands   = sum(sim.stats["commands"].values())
+    simCPU     = sim.stats["cpu"]
+
+    tracemalloc.reset_peak()
+    start,cpu = time.perf_counter(),time.process_time()
+    with contextlib.redirect_stdout(sys.stdout if verbose else open(os.devnull,'w')):
+        error = interface.commands[command](userArgs) or ""                     # Routines run on the scheduler's thread. Anything returned here is an error
+        task  = getattr(global_,'tasks',None)
+        if(not error and task):
+            task.join(timeout)
+            if(task.is_alive()):
+                error = "Timed out"
+                interface.stop(user_args=[])
+    wall = time.perf_counter() - start
+    cpu  = time.process_time() - cpu - (sim.stats["cpu"] - simCPU)
+    _,peak = tracemalloc.get_traced_memory()
+
+    scanning,idle,frames = 0,0,0
+    lastEnd,scanStart = None,None
+    for t,event,_ in sim.events[firstEvent:]:
+        if(event == "scan_start"):
+            if(lastEnd is not None): idle += t - lastEnd
+            if(scanStart is None): scanStart = t
+            lastEnd = None
+        if(event in ["scan_end","scan_stop"] and scanStart is not None):
+            scanning += t - scanStart
+            frames   += event == "scan_end"
+            lastEnd,scanStart = t,None
+
+    result = {"frames"     : frames,
+              "wall"       : wall,
+              "cpu"        : cpu,
+              "scanning"   : scanning,
+              "idle"       : idle,
+              "peakMemory" : peak,
+              "roundTrips" : sum(sim.stats["commands"].values()) - commands,
+              "error"      : str(error)}
+    for key in ["wall","cpu","idle","peakMemory","roundTrips"]:
+        result[key + "PerFrame"] = result[key]/frames if frames else None
+    return result
+
+def main():
+    args = parseArgs()
+    sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull,'w')):
+        from scanbot.server.nanonis_sim import nanonis_sim
+        from scanbot.server.scanbot_interface import scanbot_interface
+
+    unknown = [name for name in args.routines if not name in ROUTINES]
+    if(unknown): sys.exit("Unknown routine(s): " + ", ".join(unknown))
+
+    results = {"settings": vars(args), "timestamp": time.time(), "routines": {}}
+    sim = nanonis_sim(ports=[0,0,0,0],timeScale=args.time_scale,lineTime=args.line_time,
+                      pixels=args.px,lines=args.px,seed=args.seed,drift=args.drift,
+                      tipChangeRate=args.tip_change_rate,crashProbability=args.crash_probability)
+
+    tracemalloc.start()
+    with sim, tempfile.TemporaryDirectory() as moduleDir:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull,'w')):
+            interface = scanbot_interface(run_mode='c',module_dir=moduleDir + '/') # Terminal mode takes sizes in m. Nothing is uploaded with the default config
+        interface.IP       = sim.IP
+        interface.portList = sim.ports
+
+        for name in args.routines:
+            result = runRoutine(interface,sim,name,args.timeout,args.verbose)
+            results["routines"][name] = result
+            perFrame = result["wallPerFrame"]
+            print(name.ljust(16) + str(result["frames"]).rjust(4) + " frames"
+                  + "  wall " + ("%.2f" % result["wall"]).rjust(7) + " s"
+                  + "  per frame " + ("%.2f s" % perFrame if perFrame else "-").rjust(8)
+                  + "  idle " + ("%.2f" % result["idle"]).rjust(7) + " s"
+                  + "  cpu " + ("%.2f" % result["cpu"]).rjust(7) + " s"
+                  + "  peak " + ("%.1f" % (result["peakMemory"]/2**20)).rjust(7) + " MB"
+                  + ("  ERROR: " + result["error"] if result["error"] else ""))
+
+        with contextlib.redirect_stdout(open(os.devnull,'w')):
+            interface.uploader.close(wait=False)
+            interface.scheduler.close()
+
+    if(args.output):
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=1)
+
+if(__name__ == "__main__"):
+    main()
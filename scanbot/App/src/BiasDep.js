@@ -1,5 +1,5 @@
-import React, { useEffect, useState, useRef } from 'react';
-import { Sidebar, usePersistedState, GoBack } from './Components';
+import React, { useEffect, useState } from 'react';
+import { Sidebar, usePersistedState, GoBack, useImageStream } from './Components';
 import { positiveInt, number, positiveNumber } from './Validations';
 import emptyFrameIcon from './img/frame.png';
 import './styles/Survey.css'
@@ -15,8 +15,6 @@ function BiasDep() {
     const [lastImage,  setLastImage]  = useState({ src: emptyFrameIcon, alt: "blank image", width: 300, height: 300} );
     const [biasDepGif, setBiasDepGif] = useState([{ src: emptyFrameIcon, alt: "blank image", width: 300, height: 300}] );
     const [imageIndex, setImageIndex] = useState(0);
-    const [lastTimestamp, setLastTimestamp] = useState(0);
-    const timerIdRef = useRef(null);
     
     const handleInputChange = (formIndex, name, value, index) => {
         var goahead = true
@@ -166,56 +164,19 @@ function BiasDep() {
         }
     }
 
-    useEffect(() => {
-        const pollingCallback = async () => {
-            const timestamp = lastTimestamp
-            const index = imageIndex
-            const response = await fetch('/image_updates', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({timestamp: timestamp}),
-            })
-            
-            if(response.ok){
-                const blob = await response.blob()
-                const url = URL.createObjectURL(blob);
-                
-                var image = lastImage
-                image['src'] = url
-                setLastImage(image)
-                setImageIndex(index + 1)
-                setLastTimestamp(Date.now())
-                
-                fetchGif();
+    useImageStream(running, (url) => {
+        setLastImage({...lastImage, src: url})
+        setImageIndex(index => index + 1)
+        fetchGif();
+    });
 
-                const n = parseInt(allFormData[0]['n'])
-                if(index + 2 > n) {
-                    setRunning(false);
-                    stopPolling();
-                }
-            }
-        };
-    
-        const startPolling = () => {
-          timerIdRef.current = setInterval(pollingCallback, 3000);
-        };
-    
-        const stopPolling = () => {
-          clearInterval(timerIdRef.current);
-        };
-    
-        if (running) {
-          startPolling();
+    useEffect(() => {
+        const n = parseInt(allFormData[0]['n'])
+        if(running && imageIndex >= n) {
+            setRunning(false);
         }
-    
-        return () => {
-          stopPolling();
-        };
-
         // eslint-disable-next-line react-hooks/exhaustive-deps
-    }, [running, imageIndex]);
+    }, [imageIndex]);
       
     useEffect(() => {
         const handleBeforeUnload = (event) => {
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
 import collapseIcon from './img/up.png';
 import backIcon from './img/back-button.png';
@@ -17,6 +17,33 @@ export function usePersistedState(key, initialState) {
     return [state, setState];
 }
 
+// Calls onImage(url, frame) for every image Scanbot publishes while active is
+// true. Images are pushed by the server (/image_stream) as soon as they're
+// published, then downloaded from /get_image/<seq>. url is an object URL for
+// the png
+export function useImageStream(active, onImage) {
+    const onImageRef = useRef(onImage);
+    onImageRef.current = onImage;
+
+    useEffect(() => {
+        if (!active) return;
+
+        const source = new EventSource('/image_stream');
+        source.addEventListener('image', async (event) => {
+            const frame = JSON.parse(event.data);
+            const response = await fetch(frame.url);
+            if (!response.ok) return;
+
+            const blob = await response.blob();
+            onImageRef.current(URL.createObjectURL(blob), frame);
+        });
+
+        return () => {
+            source.close();
+        };
+    }, [active]);
+}
+
 export const GoBack = ({cleanUp,navigateTo}) => {
     let navigate = useNavigate();
 
@@ -1,7 +1,7 @@
-import React, { useEffect, useState, useRef } from 'react';
+import React, { useEffect, useState } from 'react';
 import { useLocation, useNavigate } from 'react-router-dom';
 import { is_auto_init, positiveNumber, positiveInt, number, checkHook } from './Validations';
-import { Sidebar, GoBack, usePersistedState } from './Components';
+import { Sidebar, GoBack, usePersistedState, useImageStream } from './Components';
 import Webcam from './Webcam';
 import emptyFrameIcon from './img/frame.png';
 import './styles/STMControl.css'
@@ -31,8 +31,6 @@ function STMControl () {
     const [lastImage,  setLastImage]  = useState({ src: emptyFrameIcon, alt: "blank image", width: 300, height: 300} );
     const [imprintGif, setImprintGif] = useState([{ src: emptyFrameIcon, alt: "blank image", width: 300, height: 300}] );
     const [ imprintScore, setImprintScore ] = useState({size: 0, sym: 0})
-    const [lastTimestamp, setLastTimestamp] = useState(0);
-    const timerIdRef = useRef(null);
     let query = useQuery();
     const navigate = useNavigate();
     const location = useLocation();
@@ -213,51 +211,15 @@ function STMControl () {
         fetch("/stop")
     }
 
-    useEffect(() => {
-        const pollingCallback = async () => {
-            const timestamp = lastTimestamp
-            const response = await fetch('/image_updates', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({timestamp: timestamp}),
-            })
-            
-            const blob = await response.blob()
-            const url = URL.createObjectURL(blob);
-
-            if(response.ok){
-                if(autoTipRunning) {
-                    await autoTipUpdate(url)
-                }
-
-                if(goToTargetRunning) {
-                    await goToUpdate(url)
-                }
-
-                setLastTimestamp(Date.now())
-            }
-        };
-    
-        const startPolling = () => {
-          timerIdRef.current = setInterval(pollingCallback, 3000);
-        };
-    
-        const stopPolling = () => {
-          clearInterval(timerIdRef.current);
-        };
-    
-        if (autoTipRunning || goToTargetRunning) {
-          startPolling();
+    useImageStream(autoTipRunning || goToTargetRunning, async (url) => {
+        if(autoTipRunning) {
+            await autoTipUpdate(url)
         }
-    
-        return () => {
-          stopPolling();
-        };
 
-        // eslint-disable-next-line react-hooks/exhaustive-deps
-    }, [autoTipRunning,goToTargetRunning]);
+        if(goToTargetRunning) {
+            await goToUpdate(url)
+        }
+    });
     
     async function goToUpdate(url) {
         let image = tipTrackingImage
@@ -1,6 +1,6 @@
 import React, { useEffect, useState, useRef } from 'react';
 import { useLocation, useNavigate } from 'react-router-dom';
-import { Sidebar, usePersistedState, GoBack } from './Components';
+import { Sidebar, usePersistedState, GoBack, useImageStream } from './Components';
 import { checkHook, is_auto_init, positiveInt, integer, positiveNumber } from './Validations';
 import { Gallery } from "react-grid-gallery";
 import emptyFrameIcon from './img/frame.png';
@@ -29,9 +29,7 @@ function Survey() {
         { src: emptyFrameIcon, alt: "blank image", width: 300, height: 300},
         { src: emptyFrameIcon, alt: "blank image", width: 300, height: 300},
     ]);
-    const [surveyIndex, setSurveyIndex]             = useState(0);
     // const [surveyFinalIndex, setSurveyFinalIndex]   = useState(1);
-    const [surveyTimestamp, setSurveyTimestamp]     = useState(0);
     const [galleryRowHeight, setGalleryRowHeight]   = useState(300);
     const timerIdRef = useRef(null);
     const navigate = useNavigate();
@@ -196,7 +194,6 @@ function Survey() {
             }
         }
         setSurveyImages(images)
-        setSurveyIndex(0)
 
         setSurveyRunning(true)
     }
@@ -269,29 +266,19 @@ function Survey() {
         }
     ];
 
+    useImageStream(surveyRunning, (url) => {
+        setSurveyImages(images => {
+            const index = images.findIndex(image => image.src === emptyFrameIcon)   // Next empty slot in the grid
+            if (index < 0) return images;
+
+            const updated = [...images];
+            updated[index] = {...updated[index], src: url};
+            return updated;
+        })
+    });
+
     useEffect(() => {
         const pollingCallback = async () => {
-            const timestamp = surveyTimestamp
-            const index = surveyIndex
-            const response = await fetch('/image_updates', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({timestamp: timestamp}),
-            })
-            
-            if(response.ok){
-                const blob = await response.blob()
-                const url = URL.createObjectURL(blob);
-                
-                var images = surveyImages
-                images[index]['src'] = url
-                setSurveyImages(images)
-                setSurveyIndex(index + 1)
-                setSurveyTimestamp(Date.now())
-            }
-
             const actionResponse = await fetch('/get_state')
             const actionData     = await actionResponse.json()
             const action = actionData['action']
@@ -323,7 +310,7 @@ function Survey() {
           stopPolling();
         };
         // eslint-disable-next-line react-hooks/exhaustive-deps
-      }, [surveyRunning, surveyIndex]);
+      }, [surveyRunning]);
     
       useEffect(() => {
         const handleBeforeUnload = (event) => {
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:12:40 2026
+
+Incremental animation writers. Frames are encoded and appended to the file
+on disk as they're produced so a series never has to be re-encoded from
+scratch.
+"""
+
+from scanbot.server import tracing
+from scanbot.server import lazy
+
+import numpy as np
+import struct
+import io
+import os
+
+Image = lazy.lazy_module('PIL.Image')                                           # Only needed to quantise colour frames
+cv2   = lazy.lazy_module('cv2')
+
+def openWriter(path,fps=2):
+    """
+    Returns a writer for path. The format is taken from the extension: .gif,
+    .mp4 or .webm.
+
+    Parameters
+    ----------
+    path : Output path
+    fps  : Frames per second
+
+    """
+    if(path.lower().endswith('.gif')): return gif_writer(path,fps=fps)
+    return video_writer(path,fps=fps)
+
+def readFrame(frame):
+    """
+    Frames can be passed in as a path to an image file or an (h,w,3) uint8
+    BGR array (e.g. from render.colourise).
+
+    """
+    if(isinstance(frame,str)):
+        image = cv2.imread(frame,cv2.IMREAD_COLOR)
+        if(image is None): raise IOError("Could not read frame " + frame)
+        return image
+    frame = np.asarray(frame)
+    if(frame.ndim == 2): return cv2.cvtColor(frame.astype(np.uint8),cv2.COLOR_GRAY2BGR)
+    return frame[:,:,:3]
+
+class gif_writer():
+    """
+    Appends frames to a GIF on disk. The file is a complete, valid GIF after
+    every append: each new frame overwrites the trailer and writes a new one.
+    Every frame gets its own colour table so colormapped frames (up to 256
+    colours) are stored exactly.
+
+    """
+    def __init__(self,path,fps=2,loop=0):
+        """
+        Parameters
+        ----------
+        path : Output path. Overwritten if it exists
+        fps  : Frames per second
+        loop : Number of loops. 0 loops forever
+
+        """
+        self.path   = path
+        self.delay  = max(1,int(round(100/fps)))                                # GIF delays are in 1/100 s
+        self.loop   = loop
+        self.size   = None                                                      # (w,h) of the logical screen. Set by the first frame
+        self.frames = 0
+
+    @tracing.traced("render")
+    def append(self,frame):
+        image = readFrame(frame)
+        if(self.size is None):
+            self.size = (image.shape[1],image.shape[0])
+            with open(self.path,'wb') as f:
+                f.write(self.header() + b';')
+
+        if((image.shape[1],image.shape[0]) != self.size):                       # Every frame has to fit the logical screen
+            image = cv2.resize(image,self.size,interpolation=cv2.INTER_NEAREST)
+
+        block = self.graphicControl() + self.imageBlock(image)
+        with open(self.path,'r+b') as f:
+            f.seek(-1,os.SEEK_END)                                              # Overwrite the trailer
+            f.write(block + b';')
+            f.truncate()
+        self.frames += 1
+
+    def close(self):
+        pass                                                                    # Nothing buffered. The file is complete after each append
+
+    def header(self):
+        w,h = self.size
+        header  = b'GIF89a' + struct.pack('<HHBBB',w,h,0x70,0,0)                # Logical screen. No global colour table
+        header += b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H',self.loop) + b'\x00'
+        return header
+
+    def graphicControl(self):
+        return b'\x21\xf9\x04\x04' + struct.pack('<H',self.delay) + b'\x00\x00'  # Disposal: leave in place
+
+    def imageBlock(self,image):
+        """
+        Encode one frame with PIL and lift its image descriptor and LZW data
+        out, moving the global colour table PIL writes into a local one.
+
+        """
+        rgb = np.ascontiguousarray(image[:,:,::-1])
+        packed = (rgb[:,:,0].astype(np.uint32) << 16) | (rgb[:,:,1].astype(np.uint32) << 8) | rgb[:,:,2]
+        colours,index = np.unique(packed,return_inverse=True)
+        if(len(colours) <= 256):                                                # Exact palette. Typical for colormapped data
+            palette = np.stack([(colours >> 16) & 255,(colours >> 8) & 255,colours & 255],axis=1).astype(np.uint8)
+            im = Image.fromarray(index.reshape(packed.shape).astype(np.uint8),'P')
+            im.putpalette(palette.ravel().tolist())
+        else:
+            im = Image.fromarray(rgb).quantize(256)
+
+        buf = io.BytesIO()
+        im.save(buf,format='GIF')
+        data = buf.getvalue()
+
+        packedLSD = data[10]
+        pos = 13
+        colourTable = b''
+        tableBits = 0
+        if(packedLSD & 0x80):
+            tableBits = packedLSD & 0x07
+            colourTable = data[pos:pos + 3*2**(tableBits + 1)]
+            pos += len(colourTable)
+
+        while(data[pos] == 0x21):                                               # Skip PIL's extensions. We write our own graphic control
+            pos += 2
+            while(data[pos]): pos += data[pos] + 1
+            pos += 1
+
+        if(data[pos] != 0x2c): raise ValueError("Unexpected GIF block from encoder")
+        descriptor = bytearray(data[pos:pos + 10])
+        pos += 10
+        if(not descriptor[9] & 0x80):
+            descriptor[9] = (descriptor[9] & 0x78) | 0x80 | tableBits          # Local colour table instead of global
+            descriptor += colourTable
+        else:
+            tableSize = 3*2**((descriptor[9] & 0x07) + 1)
+            descriptor += data[pos:pos + tableSize]
+            pos += tableSize
+
+        start = pos
+        pos += 1                                                                # LZW minimum code size
+        while(data[pos]): pos += data[pos] + 1
+        pos += 1
+        return bytes(descriptor) + data[start:pos]
+
+class video_writer():
+    """
+    MP4/WebM output through cv2.VideoWriter. Better suited to long series
+    than GIF. The file is only playable once the writer is closed.
+
+    """
+    codecs = {'.mp4'  : 'mp4v',
+              '.webm' : 'VP80'}
+
+    def __init__(self,path,fps=2):
+        self.path   = path
+        self.fps    = fps
+        self.size   = None
+        self.frames = 0
+        self.writer = None
+
+    @tracing.traced("render")
+    def append(self,frame):
+        image = readFrame(frame)
+        if(self.writer is None):
+            self.size = (image.shape[1] + image.shape[1]%2,image.shape[0] + image.shape[0]%2) # Most codecs need even dimensions
+            codec = self.codecs.get(os.path.splitext(self.path)[1].lower(),'mp4v')
+            self.writer = cv2.VideoWriter(self.path,cv2.VideoWriter_fourcc(*codec),self.fps,self.size)
+            if(not self.writer.isOpened()): raise IOError("Could not open video writer for " + self.path)
+
+        if((image.shape[1],image.shape[0]) != self.size):
+            image = cv2.resize(image,self.size,interpolation=cv2.INTER_NEAREST)
+        self.writer.write(np.ascontiguousarray(image))
+        self.frames += 1
+
+    def close(self):
+        if(self.writer is not None):
+            self.writer.release()
+            self.writer = None
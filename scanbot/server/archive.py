@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:11:52 2026
+
+Append-only scan archive. Replaces the one-pickle-per-scan files written by
+utilities.pklDict: every scan in a survey goes into one archive directory
+that can be uploaded in one go and read back lazily.
+"""
+
+import numpy as np
+import threading
+import ntpath
+import json
+import time
+import zlib
+import os
+
+class scan_archive():
+    """
+    An archive is a directory holding:
+        index.jsonl  : One json line per scan with the scan's metadata and
+                       where its data is (chunk, offset, shape, dtype)
+        chunk_N.bin  : Raw scan data, one array after another. A new chunk
+                       is started once a chunk reaches chunkSize bytes
+
+    Uncompressed scans are read back as read-only memory maps so nothing is
+    loaded until it's used. Compressed scans (zlib) are smaller but have to
+    be decompressed when read.
+
+    Index lines are only written once the data they point to is on disk, so
+    an archive that was being written when scanbot died is still readable up
+    to the last complete scan.
+
+    Each record has the same keys as the pickles from utilities.pklDict:
+    sxm, data, comments, pixels, lines, x, y, w, h, angle.
+
+    """
+    indexName = "index.jsonl"
+
+    def __init__(self,path,compress=False,chunkSize=64*2**20):
+        """
+        Parameters
+        ----------
+        path      : Archive directory. Created if it doesn't exist. Existing
+                    archives are appended to.
+        compress  : zlib compress scans as they're appended
+        chunkSize : Size a chunk can grow to before a new one is started
+                    (bytes)
+
+        """
+        self.path      = path
+        self.compress  = compress
+        self.chunkSize = chunkSize
+        self.records   = []
+        self.file      = None                                                   # Chunk currently being appended to
+        self.chunk     = -1
+        self.lock      = threading.Lock()
+
+        if(os.path.isfile(os.path.join(path,self.indexName))): self.load()
+
+    def append(self,scanData,filePath,x,y,w,h,angle,pixels,lines,comments=""):
+        """
+        Add a scan. Takes the same arguments as utilities.pklDict with the
+        metadata from scanbot.getMetaData.
+
+        Returns
+        -------
+        record : Index entry for the scan
+
+        """
+        data = np.ascontiguousarray(scanData)
+        raw  = data.tobytes()
+        if(self.compress): raw = zlib.compress(raw,1)                           # Fastest level. Scan data doesn't compress much harder than this
+
+        with self.lock:
+            if(self.file is None or (self.file.tell() and self.file.tell() + len(raw) > self.chunkSize)):
+                self.nextChunk()
+
+            offset = self.file.tell()
+            self.file.write(raw)
+            self.file.flush()
+
+            record = {"sxm"        : ntpath.split(filePath)[1],
+                      "comments"   : comments,
+                      "pixels"     : int(pixels),
+                      "lines"      : int(lines),
+                      "x"          : float(x),
+                      "y"          : float(y),
+                      "w"          : float(w),
+                      "h"          : float(h),
+                      "angle"      : float(angle),
+                      "timestamp"  : time.time(),
+                      "chunk"      : self.chunkName(self.chunk),
+                      "offset"     : offset,
+                      "nbytes"     : len(raw),
+                      "shape"      : list(data.shape),
+                      "dtype"      : data.dtype.str,
+                      "compressed" : bool(self.compress)}
+
+            with open(os.path.join(self.path,self.indexName),'a') as f:
+                f.write(json.dumps(record) + "\n")
+            self.records.append(record)
+            return record
+
+    def read(self,idx):
+        """
+        Returns the data of scan idx. A read-only memory map for uncompressed
+        scans.
+
+        """
+        record = self.records[idx]
+        path   = os.path.join(self.path,record["chunk"])
+        dtype  = np.dtype(record["dtype"])
+        shape  = tuple(record["shape"])
+        if(not record["compressed"]):
+            if(not record["nbytes"]): return np.zeros(shape,dtype=dtype)        # Can't memory map nothing
+            return np.memmap(path,dtype=dtype,mode='r',offset=record["offset"],shape=shape)
+
+        with open(path,'rb') as f:
+            f.seek(record["offset"])
+            raw = zlib.decompress(f.read(record["nbytes"]))
+        return np.frombuffer(raw,dtype=dtype).reshape(shape)
+
+    def meta(self,idx):
+        return dict(self.records[idx])
+
+    def find(self,sxm):
+        """
+        Returns the index of the last scan saved from sxm file. None if it's
+        not in the archive.
+
+        """
+        for idx in reversed(range(len(self.records))):
+            if(self.records[idx]["sxm"] == sxm): return idx
+        return None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self,idx):
+        """
+        Returns scan idx as a dictionary in the same format as the pickles
+        from utilities.pklDict.
+
+        """
+        record = self.meta(idx)
+        record["data"] = self.read(idx)
+        return record
+
+    def __iter__(self):
+        for idx in range(len(self.records)):
+            yield self[idx]
+
+    def close(self):
+        with self.lock:
+            if(self.file):
+                self.file.close()
+                self.file = None
+
+    def nextChunk(self):
+        if(self.file): self.file.close()
+        os.makedirs(self.path,exist_ok=True)
+        self.chunk += 1
+        self.file = open(os.path.join(self.path,self.chunkName(self.chunk)),'ab')
+
+    def chunkName(self,chunk):
+        return "chunk_" + str(chunk).zfill(5) + ".bin"
+
+    def load(self):
+        with open(os.path.join(self.path,self.indexName),'r') as f:
+            lines = f.readlines()
+        for line in lines:
+            try:
+                self.records.append(json.loads(line))
+            except json.JSONDecodeError:                                        # Half written line from a crash. Everything before it is fine
+                with open(os.path.join(self.path,self.indexName),'w') as f:
+                    f.writelines(json.dumps(record) + "\n" for record in self.records)
+                break
+        if(self.records):
+            self.chunk = int(self.records[-1]["chunk"][6:11])                   # New scans go in a new chunk, after anything left half written
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:41:15 2026
+
+Threaded camera capture for tip tracking. Frames are read continuously on a
+background thread into a preallocated ring buffer so the tracking loop never
+waits on the camera and never sees frames that went stale in the driver's
+queue while the motors were stepping. The tip is then tracked in a small
+region of interest around where it's expected to be.
+"""
+
+from scanbot.server import utilities
+from scanbot.server import lazy
+
+import numpy as np
+import threading
+import time
+
+cv2 = lazy.lazy_module('cv2')
+
+class camera_stream():
+    """
+    Wraps a cv2.VideoCapture. A reader thread fills a ring buffer of frames
+    and keeps a running average of the most recent ones up to date as each
+    frame arrives: a boxcar average (exact, kept as an integer sum) or an
+    exponential moving average.
+
+    Frames handed out by latest() and read() are read-only views into the
+    ring buffer. They stay valid until the reader wraps around to that slot
+    again (size frames later). Copy them (or pass out=) to keep them longer.
+
+    Also behaves enough like a cv2.VideoCapture (read, isOpened, release) to
+    be passed to the existing helpers in utilities.
+
+    """
+    def __init__(self,cap,size=32,average=11,alpha=0,replaySpeed=0):
+        """
+        Parameters
+        ----------
+        cap         : Opened cv2.VideoCapture (camera or video file)
+        size        : Number of frames in the ring buffer
+        average     : Number of frames in the boxcar average. Must be less
+                      than size
+        alpha       : Use an exponential moving average with this weight for
+                      new frames instead of the boxcar. 0 for boxcar
+        replaySpeed : For video files. Play back at this multiple of the
+                      file's frame rate. 0 reads frames as fast as they can
+                      be decoded (live cameras pace themselves)
+
+        """
+        if(average >= size): raise ValueError("average must be less than the ring buffer size")
+        self.cap         = cap
+        self.size        = size
+        self.averageN    = average
+        self.alpha       = alpha
+        self.replaySpeed = replaySpeed
+
+        self.frames   = None                                                    # Ring buffer (size, rows, cols, channels). Allocated once the frame size is known
+        self.sum      = None                                                    # Integer sum of the frames in the boxcar
+        self.ema      = None                                                    # Exponential moving average
+        self.seq      = 0                                                       # Sequence number of the newest frame. 0 until the first one arrives
+        self.lastRead = 0                                                       # Sequence number of the last frame returned by read()
+        self.ended    = False                                                   # Camera stopped delivering or the video ran out
+        self.closed   = False
+        self.started  = time.time()
+        self.lock     = threading.Condition()
+
+        self.thread = threading.Thread(target=self.reader,name="scanbot-camera",daemon=True)
+        self.thread.start()
+
+    def reader(self):
+        fps = 0
+        if(self.replaySpeed > 0):
+            fps = (self.cap.get(cv2.CAP_PROP_FPS) or 30)*self.replaySpeed       # Frames per second to deliver at
+        start = time.time()
+
+        while(not self.closed):
+            slot = self.seq % self.size if self.frames is not None else 0
+            try:
+                if(self.frames is None): ret,frame = self.cap.read()
+                else:                    ret,frame = self.cap.read(self.frames[slot]) # Decode straight into the ring buffer
+            except Exception as e:
+                print("Camera read failed: " + str(e))
+                ret = False
+            if(not ret or frame is None): break
+
+            if(self.frames is None):                                            # First frame. Now we know how big they are
+                frame = np.asarray(frame)
+                self.frames = np.zeros((self.size,) + frame.shape,dtype=np.uint8)
+                self.sum    = np.zeros(frame.shape,dtype=np.int32)
+                if(self.alpha): self.ema = frame.astype(np.float32)
+            if(frame is not self.frames[slot]): self.frames[slot] = frame       # Driver handed back its own buffer
+
+            with self.lock:
+                np.add(self.sum,self.frames[slot],out=self.sum)
+                if(self.seq >= self.averageN):
+                    np.subtract(self.sum,self.frames[(slot - self.averageN) % self.size],out=self.sum) # Oldest frame drops out of the boxcar
+                if(self.alpha): cv2.accumulateWeighted(self.frames[slot],self.ema,self.alpha)
+                self.seq += 1
+                self.lock.notify_all()
+
+            if(fps):
+                delay = start + self.seq/fps - time.time()
+                if(delay > 0): time.sleep(delay)
+
+        with self.lock:
+            self.ended = True
+            self.lock.notify_all()
+
+    def wait(self,after=0,timeout=None):
+        """
+        Block until there's a frame newer than after.
+
+        Returns
+        -------
+        seq : Sequence number of the newest frame. 0 if the stream ended or
+              timed out first
+
+        """
+        with self.lock:
+            self.lock.wait_for(lambda: self.seq > after or self.ended or self.closed,timeout)
+            if(self.seq > after): return self.seq
+            return 0
+
+    def latest(self,out=None):
+        """
+        Returns
+        -------
+        seq   : Sequence number of the newest frame. 0 if there isn't one yet
+        frame : Read-only view of the newest frame, or a copy in out if given
+
+        """
+        with self.lock:
+            if(not self.seq): return 0,None
+            view = self.frames[(self.seq - 1) % self.size]
+            if(out is not None):
+                np.copyto(out,view)
+                return self.seq,out
+        view = view.view()
+        view.flags.writeable = False
+        return self.seq,view
+
+    def averaged(self,out=None,region=None):
+        """
+        Running average of the most recent frames (boxcar, or exponential if
+        alpha was set).
+
+        Parameters
+        ----------
+        out    : float32 array to write the average into. A new one is made if
+                 None or if it's the wrong shape
+        region : (rows, cols) slices. Only average this part of the frame
+
+        Returns
+        -------
+        average : float32 average frame. None if there are no frames yet
+
+        """
+        with self.lock:
+            if(not self.seq): return None
+            source = self.ema if self.alpha else self.sum
+            if(region is not None): source = source[region]
+            if(out is None or out.shape != source.shape): out = np.empty(source.shape,dtype=np.float32)
+            if(self.alpha):
+                np.copyto(out,source)
+            else:
+                np.multiply(source,1/min(self.seq,self.averageN),out=out,casting='unsafe')
+            return out
+
+    def shape(self):
+        with self.lock:
+            return None if self.frames is None else self.frames.shape[1:]
+
+    def fresh(self):
+        """
+        Returns
+        -------
+        seq : Once the stream is past this frame, the average only contains
+              frames captured after this call (e.g. after the tip has moved)
+
+        """
+        with self.lock:
+            return self.seq + (0 if self.alpha else self.averageN - 1)
+
+    def fps(self):
+        with self.lock:
+            return self.seq/max(time.time() - self.started,1e-9)
+
+###############################################################################
+# cv2.VideoCapture interface
+###############################################################################
+    def read(self):
+        """
+        Next frame that hasn't been returned by read() yet. Waits for one if
+        needed.
+
+        Returns
+        -------
+        ret   : False if the stream has ended
+        frame : Read-only view of the frame
+
+        """
+        seq = self.wait(self.lastRead)
+        if(not seq): return False,None
+        self.lastRead = seq
+        return True,self.latest()[1]
+
+    def isOpened(self):
+        with self.lock:
+            return not (self.ended or self.closed) or self.seq > self.lastRead
+
+    def release(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.thread.join(2)
+        self.cap.release()
+
+###############################################################################
+# Tip tracking
+###############################################################################
+class tip_tracker():
+    """
+    Follows the tip from frame to frame. Each update only looks at a region
+    of interest around where the tip is expected to be (its last position
+    plus its velocity), so the cost per frame depends on the size of the ROI
+    rather than the resolution of the camera. The whole frame is only
+    searched when the tip can't be found in the ROI.
+
+    The tip is found the same way as utilities.trackTip: the difference from
+    the initial frame is thresholded, and the blob that overlaps a small
+    window around the expected position is the tip. Its lowest row is the
+    apex and the middle of the blob inside the window is its column.
+
+    """
+    threshold = 160                                                             # Same threshold as utilities.trackTip
+    window    = 10                                                              # Half width of the window the tip's blob has to overlap (px)
+    margin    = 48                                                              # The ROI extends this far past the window (px)
+    minArea   = 20                                                              # Smallest blob that can be picked up again after losing the tip (px)
+    maxLost   = 100                                                             # Give up after this many updates in a row without finding the tip
+
+    def __init__(self,initialFrame,tipPos):
+        """
+        Parameters
+        ----------
+        initialFrame : Frame captured before the tip started moving
+        tipPos       : Tip position marked by the user [col, row]
+
+        """
+        self.initialFrame = np.asarray(initialFrame)
+        self.rows,self.cols = self.initialFrame.shape[:2]
+        self.pos          = np.array(tipPos[:2],dtype=int)
+        self.velocity     = np.zeros(2)                                         # Smoothed change in position between updates (px)
+        self.roi          = None                                                # Region searched in the last update
+        self.lost         = 0                                                   # Updates in a row the tip wasn't found
+        self.searches     = 0                                                   # Full frame searches so far
+
+    def region(self,centre=None):
+        """
+        Returns
+        -------
+        region : (rows, cols) slices of the ROI around centre. The whole
+                 frame if centre is None
+
+        """
+        if(centre is None): return (slice(0,self.rows),slice(0,self.cols))
+        reach = self.window + self.margin + int(np.ceil(np.abs(self.velocity).max()))
+        col,row = centre
+        return (slice(max(0,row - reach),min(self.rows,row + reach + 1)),
+                slice(max(0,col - reach),min(self.cols,col + reach + 1)))
+
+    def update(self,source):
+        """
+        Find the tip in the current frame.
+
+        Parameters
+        ----------
+        source : Callable that takes a region (rows, cols slices) and returns
+                 that part of the current frame, e.g.
+                 lambda region: stream.averaged(region=region)
+
+        Returns
+        -------
+        tipPos : Tip position [col, row]. None if the tip was lost
+
+        """
+        prediction = np.round(self.pos + self.velocity).astype(int)
+        tipPos = None
+        if(not self.lost):
+            self.roi = self.region(prediction)
+            tipPos = self.locate(source(self.roi),self.roi,prediction)
+        if(tipPos is None):                                                     # Not in the ROI. Look everywhere
+            self.searches += 1
+            self.roi = self.region()
+            tipPos = self.locate(source(self.roi),self.roi,prediction,reacquire=self.lost > 0)
+
+        if(tipPos is None):
+            self.lost += 1
+            self.velocity[:] = 0
+            return None
+
+        if(self.lost): self.velocity[:] = 0
+        else:          self.velocity = 0.5*self.velocity + 0.5*(tipPos - self.pos)
+        self.pos  = tipPos
+        self.lost = 0
+        return tipPos.copy()
+
+    def locate(self,frame,region,prediction,reacquire=False):
+        """
+        Find the tip within one region of the frame.
+
+        Parameters
+        ----------
+        frame      : The region of the current frame
+        region     : Where the region is in the frame
+        prediction : Expected tip position [col, row] in the frame
+        reacquire  : If nothing overlaps the window around the prediction,
+                     take the nearest big enough blob instead
+
+        Returns
+        -------
+        tipPos : Tip position [col, row] in the frame. None if not found
+
+        """
+        top,left = region[0].start,region[1].start
+        diff   = utilities.backgroundDifference(self.initialFrame[region],frame)
+        binary = (diff > self.threshold).astype(np.uint8)
+        count,labels,stats,_ = cv2.connectedComponentsWithStats(binary,connectivity=8)
+        if(count < 2): return None                                              # Nothing but background
+
+        col,row = prediction - [left,top]
+        window  = (slice(max(0,row - self.window),max(0,row + self.window)),
+                   slice(max(0,col - self.window),max(0,col + self.window)))
+        overlap = np.bincount(labels[window].ravel(),minlength=count)
+        overlap[0] = 0
+
+        if(overlap.max()):
+            label = np.argmax(overlap)
+        elif(reacquire):
+            x,y,w,h,area = stats[1:].T
+            dx = np.maximum(0,np.maximum(x - col,col - (x + w - 1)))            # Distance from the prediction to each blob's bounding box
+            dy = np.maximum(0,np.maximum(y - row,row - (y + h - 1)))
+            distance = np.where(area >= self.minArea,dx**2 + dy**2,np.inf)
+            if(not np.isfinite(distance.min())): return None
+            label = np.argmin(distance) + 1
+        else:
+            return None
+
+        x,y,w,h,_ = stats[label]
+        bottom = y + h - 1
+        if(bottom == binary.shape[0] - 1 and region[0].stop < self.rows):
+            return None                                                         # The blob carries on below the ROI so the apex isn't in it
+
+        if(not overlap.max()):                                                  # Picked up again. Centre on the blob's apex
+            window = (slice(max(0,bottom - self.window),bottom + 1),slice(x,x + w))
+        cols = np.flatnonzero((labels[window] == label).any(axis=0))
+        tipCol = int((cols[0] + cols[-1])/2) + window[1].start
+
+        return np.array([tipCol + left,bottom + top])
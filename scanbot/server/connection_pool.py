@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:12:41 2026
+
+Persistent nanonisTCP sessions shared between Scanbot routines.
+"""
+
+import select
+import threading
+import time
+
+class connection_pool():
+    """
+    Keeps one nanonisTCP session open per configured port for the lifetime of
+    the process. Sessions are leased to one thread at a time. Leases are
+    reentrant within a thread so nested helpers (getMetaData, checkEventFlags,
+    moveArea inside survey2, etc.) reuse the session already held by the
+    calling routine instead of grabbing another port.
+
+    """
+    reconnectDelay = 0.2                                                        # Nanonis needs a moment before the same port can be reopened (from experience)
+
+    def __init__(self,factory,waitTimeout=2):
+        """
+        Parameters
+        ----------
+        factory     : Callable factory(IP,PORT) that opens a new session
+        waitTimeout : Time to wait for a port to become free before giving up
+                      (s)
+
+        """
+        self.factory     = factory
+        self.waitTimeout = waitTimeout
+
+        self.IP       = None
+        self.ports    = []
+        self.sessions = {}                                                      # port: open session
+        self.idle     = []                                                      # Ports with an open session that is not leased
+        self.leases   = {}                                                      # thread ident: [session, depth, thread, broken]
+        self.lock     = threading.Condition()
+
+        self.stats = {"leases"      : 0,                                        # Total number of leases handed out
+                      "nested"      : 0,                                        # Leases that reused a session already held by the thread
+                      "reused"      : 0,                                        # Leases served from an already open session
+                      "connects"    : 0,                                        # New TCP handshakes
+                      "reconnects"  : 0,                                        # Sessions reopened after failing a health check
+                      "failures"    : 0,                                        # Failed attempts to open a session
+                      "reclaimed"   : 0,                                        # Leases reclaimed from threads that died holding them
+                      "waits"       : 0,                                        # Leases that had to wait for a free port
+                      "waitTime"    : 0.0}                                      # Total time spent waiting for a free port (s)
+
+    def acquire(self,IP,ports):
+        """
+        Lease a session for the calling thread.
+
+        Parameters
+        ----------
+        IP    : IP of the pc controlling nanonis
+        ports : Configured list of ports
+
+        Returns
+        -------
+        connection : [0] nanonisTCP connection handle if successful. 0 if not
+                     [1] Error message if there was an error. 0 if not
+
+        """
+        ident = threading.get_ident()
+        with self.lock:
+            self.configure(IP,ports)
+
+            self.stats["leases"] += 1
+            if(ident in self.leases):                                           # This thread already holds a session. Hand it out again
+                self.leases[ident][1] += 1
+                self.stats["nested"] += 1
+                return [self.leases[ident][0],0]
+
+            start  = time.time()
+            waited = False
+            error  = ""
+            while(True):
+                self.reclaim()
+                port = self.freePort()
+                if(port is not None): break
+
+                remaining = self.waitTimeout - (time.time() - start)
+                if(remaining <= 0): return [0,error or "No ports available"]
+
+                waited = True
+                self.lock.wait(remaining)
+
+            if(waited):
+                self.stats["waits"]    += 1
+                self.stats["waitTime"] += time.time() - start
+
+            NTCP,error = self.open(port)
+            if(error): return [0,error]
+
+            self.leases[ident] = [NTCP,1,threading.current_thread(),False]
+            return [NTCP,0]
+
+    def release(self,NTCP,broken=False):
+        """
+        Return a session to the pool.
+
+        Parameters
+        ----------
+        NTCP   : Connection handle returned by acquire
+        broken : Flag the session as unusable so it's reopened on next lease
+
+        """
+        ident = threading.get_ident()
+        with self.lock:
+            lease = self.leases.get(ident)
+            if(not lease or lease[0] is not NTCP):                              # Released by a thread that doesn't own it. Find the owner
+                owners = [i for i,l in self.leases.items() if l[0] is NTCP]
+                if(not owners):
+                    if(broken or self.sessions.get(NTCP.PORT) is not NTCP): self.drop(NTCP) # Not one of ours. Make sure it's closed
+                    return
+                ident = owners[0]
+                lease = self.leases[ident]
+
+            lease[1] -= 1
+            lease[3] = lease[3] or broken
+            if(lease[1] > 0): return                                            # Still in use further up the call stack. Dropped once the outermost lease is released
+
+            del self.leases[ident]
+            if(lease[3] or self.sessions.get(NTCP.PORT) is not NTCP):           # Broken or the pool was reconfigured while leased
+                self.drop(NTCP)
+            else:
+                self.idle.append(NTCP.PORT)
+            self.lock.notify()
+
+    def close(self):
+        """
+        Close every idle session. Sessions that are leased are closed when they
+        are released.
+
+        """
+        with self.lock:
+            for port in self.idle:
+                self.closeSession(self.sessions.pop(port))
+            self.idle = []
+            self.ports = []
+
+    def metrics(self):
+        """
+        Returns
+        -------
+        metrics : dictionary of pool counters and current state
+
+        """
+        with self.lock:
+            metrics = dict(self.stats)
+            metrics["ports"] = list(self.ports)
+            metrics["open"]  = len(self.sessions)
+            metrics["idle"]  = len(self.idle)
+            metrics["busy"]  = len(self.leases)
+            return metrics
+
+    def configure(self,IP,ports):
+        """
+        Reconcile the pool with the current IP and port list. Sessions that
+        are no longer valid are closed (or dropped on release if leased).
+
+        """
+        ports = list(ports)
+        if(IP == self.IP and ports == self.ports): return
+
+        for port in list(self.sessions):
+            if(IP != self.IP or port not in ports):
+                session = self.sessions.pop(port)
+                if(port in self.idle):
+                    self.idle.remove(port)
+                    self.closeSession(session)
+
+        self.IP    = IP
+        self.ports = ports
+
+    def freePort(self):
+        """
+        Returns the next port to lease. Idle sessions are preferred over
+        opening new ones. None if every port is busy.
+
+        """
+        if(self.idle): return self.idle.pop()
+        busy = [l[0].PORT for l in self.leases.values()]
+        for port in reversed(self.ports):                                       # Same order ports were popped from the list previously
+            if(port not in self.sessions and port not in busy): return port
+        return None
+
+    def open(self,port):
+        """
+        Returns a healthy session for the port, opening or reopening the TCP
+        connection if required.
+
+        """
+        NTCP = self.sessions.get(port)
+        if(NTCP):
+            if(self.isHealthy(NTCP)):
+                self.stats["reused"] += 1
+                return [NTCP,0]
+
+            try:                                                                # Stale session. Reopen it on the same port
+                self.closeSession(NTCP)
+                time.sleep(self.reconnectDelay)
+                NTCP.connect()
+                self.stats["reconnects"] += 1
+                return [NTCP,0]
+            except Exception as e:
+                del self.sessions[port]
+                self.stats["failures"] += 1
+                return [0,str(e)]
+
+        try:
+            NTCP = self.factory(self.IP,port)
+        except Exception as e:
+            self.stats["failures"] += 1
+            return [0,str(e)]
+
+        self.sessions[port] = NTCP
+        self.stats["connects"] += 1
+        return [NTCP,0]
+
+    def drop(self,NTCP):
+        """
+        Close a session and forget it so the port is reopened next time.
+
+        """
+        port = NTCP.PORT
+        if(self.sessions.get(port) is NTCP):
+            del self.sessions[port]
+            if(port in self.idle): self.idle.remove(port)
+        self.closeSession(NTCP)
+
+    def reclaim(self):
+        """
+        Take back leases held by threads that finished without releasing them
+        (e.g. a routine that raised an exception).
+
+        """
+        for ident,lease in list(self.leases.items()):
+            if(lease[2].is_alive()): continue
+            del self.leases[ident]
+            self.stats["reclaimed"] += 1
+            NTCP = lease[0]
+            if(lease[3] or self.sessions.get(NTCP.PORT) is not NTCP):
+                self.drop(NTCP)
+            else:
+                self.idle.append(NTCP.PORT)                                     # Health check on the next lease decides whether it's usable
+
+    def isHealthy(self,NTCP):
+        """
+        Cheap health check that doesn't cost a round trip to nanonis. An idle
+        session should have nothing to read. If the socket is readable then
+        either nanonis closed it or there is a stray response left over from
+        an interrupted command. Either way it needs to be reopened.
+
+        """
+        try:
+            fd = NTCP.s.fileno()
+            if(not isinstance(fd,int)): return True                             # Can't inspect this handle. Let any problem surface on use
+            if(fd < 0): return False
+            readable,_,_ = select.select([fd],[],[],0)
+            return not readable
+        except Exception:
+            return False
+
+    def closeSession(self,NTCP):
+        try:
+            NTCP.close_connection()
+        except Exception:
+            pass
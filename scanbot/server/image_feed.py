@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:05:33 2026
+
+In-memory feed of the images Scanbot produces. sendPNG publishes into it and
+the web server pushes new frames to clients as they arrive.
+"""
+
+from collections import deque
+import threading
+import time
+
+class image_feed():
+    """
+    Ring buffer of recent images and their metadata. Each frame is a
+    dictionary:
+        seq       : Sequence number. Increases by one with each frame
+        timestamp : Time the frame was published (s since epoch)
+        filename  : png filename
+        data      : Encoded image bytes
+        meta      : Dictionary of extra information (e.g. tip imprint scores)
+
+    """
+    def __init__(self,maxFrames=64):
+        """
+        Parameters
+        ----------
+        maxFrames : Number of frames to keep. Older frames are dropped
+
+        """
+        self.frames = deque(maxlen=maxFrames)
+        self.seq    = 0
+        self.lock   = threading.Condition()
+
+    def publish(self,filename,data,meta={}):
+        """
+        Add a frame and wake up anyone waiting for one.
+
+        Returns
+        -------
+        seq : Sequence number of the new frame
+
+        """
+        with self.lock:
+            self.seq += 1
+            self.frames.append({"seq"       : self.seq,
+                                "timestamp" : time.time(),
+                                "filename"  : filename,
+                                "data"      : data,
+                                "meta"      : dict(meta)})
+            self.lock.notify_all()
+            return self.seq
+
+    def latest(self,key=None):
+        """
+        Returns the most recent frame. None if there isn't one.
+
+        Parameters
+        ----------
+        key : Only consider frames with this key in their metadata
+
+        """
+        with self.lock:
+            for frame in reversed(self.frames):
+                if(key is None or key in frame["meta"]): return frame
+        return None
+
+    def get(self,seq):
+        with self.lock:
+            for frame in self.frames:
+                if(frame["seq"] == seq): return frame
+        return None
+
+    def since(self,seq=0):
+        """
+        Returns every frame newer than seq, oldest first.
+
+        """
+        with self.lock:
+            return [frame for frame in self.frames if frame["seq"] > seq]
+
+    def wait(self,seq=0,timeout=None):
+        """
+        Block until there is a frame newer than seq.
+
+        Returns
+        -------
+        frames : Frames newer than seq, oldest first. Empty if timed out
+
+        """
+        with self.lock:
+            self.lock.wait_for(lambda: self.seq > seq,timeout=timeout)
+            return [frame for frame in self.frames if frame["seq"] > seq]
+
+    def clear(self,upTo=None):
+        """
+        Drop frames. Sequence numbers keep counting so clients don't see
+        old numbers reused.
+
+        Parameters
+        ----------
+        upTo : Only drop frames with seq <= upTo. None drops everything
+
+        """
+        with self.lock:
+            if(upTo is None): upTo = self.seq
+            while(self.frames and self.frames[0]["seq"] <= upTo):
+                self.frames.popleft()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:41:20 2026
+
+Deferred imports. Heavy dependencies, optional hooks and upload backends are
+stood in for by a proxy that imports the real module the first time it's
+used, so starting (and restarting) Scanbot only pays for what the session
+actually needs. Also keeps a record of startup and import times for the
+import_profile command.
+"""
+
+import importlib
+import threading
+import time
+import sys
+
+started = time.time()                                                           # Roughly when scanbot started importing
+stages  = []                                                                    # [name, duration (s)] of each startup stage
+loads   = {}                                                                    # module name: [import time (s), time since start it was imported (s)]
+proxies = []                                                                    # Names of every lazy module created
+lock    = threading.RLock()
+
+class lazy_module():
+    """
+    Stands in for a module until something on it is used:
+
+        zulip = lazy.lazy_module('zulip')
+        zulip.Client(...)                                                       # zulip is imported here
+
+    Attribute reads, writes and deletes all go to the real module, so
+    unittest.mock.patch works on a lazy module's attributes the same way it
+    does on the module itself. If the module can't be imported, the
+    ImportError is raised where it's first used (and again each time after
+    that, so a hook that's added later gets picked up).
+
+    """
+    def __init__(self,name):
+        object.__setattr__(self,'_name',name)
+        object.__setattr__(self,'_module',None)
+        with lock:
+            proxies.append(name)
+
+    def _load(self):
+        if(self._module is None):
+            object.__setattr__(self,'_module',load(self._name))
+        return self._module
+
+    def __getattr__(self,attr):
+        return getattr(self._load(),attr)
+
+    def __setattr__(self,attr,value):
+        setattr(self._load(),attr,value)
+
+    def __delattr__(self,attr):
+        delattr(self._load(),attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return "<lazy module '" + self._name + "' (" + ("loaded" if self._module else "not loaded yet") + ")>"
+
+def load(name):
+    """
+    Import a module and record how long it took.
+
+    """
+    if(name in sys.modules): return sys.modules[name]
+    with lock:
+        start  = time.perf_counter()
+        module = importlib.import_module(name)
+        loads.setdefault(name,[time.perf_counter() - start,time.time() - started])
+    return module
+
+class stage():
+    """
+    Context manager that records how long a step of startup took.
+
+        with lazy.stage("interface"):
+            ...
+
+    """
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,excType,exc,tb):
+        mark(self.name,time.perf_counter() - self.start)
+        return False
+
+def mark(name,duration=None):
+    """
+    Record a startup stage. If duration is None, it's the time since scanbot
+    started importing.
+
+    """
+    with lock:
+        stages.append([name,time.time() - started if duration is None else duration])
+
+def report():
+    """
+    Returns
+    -------
+    report : Readable summary of startup stages, modules that were imported
+             on first use and modules that haven't been needed yet
+
+    """
+    with lock:
+        stageList = list(stages)
+        loadList  = sorted(loads.items(),key=lambda x: x[1][1])
+        waiting   = [name for name in dict.fromkeys(proxies) if not name in loads and not name in sys.modules]
+
+    report = "Startup:\n"
+    for name,duration in stageList:
+        report += "  " + name + ": " + str(round(duration*1000)) + " ms\n"
+
+    report += "Imported on first use:\n"
+    for name,(duration,at) in loadList:
+        report += "  " + name + ": " + str(round(duration*1000)) + " ms (" + str(round(at,1)) + " s after start)\n"
+    if(not loadList): report += "  none\n"
+
+    report += "Not needed yet: " + (", ".join(waiting) if waiting else "none")
+    return report
@@ -0,0 +1,718 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:41:09 2026
+
+Simulated Nanonis instrument. Speaks enough of the Nanonis TCP programming
+interface to run Scanbot's routines end to end without booking microscope
+time.
+"""
+
+from scipy import ndimage
+import numpy as np
+import threading
+import socket
+import struct
+import time
+
+class nanonis_sim():
+    """
+    Stand-in for the Nanonis TCP programming interface. Listens on a set of
+    ports and answers the commands nanonisTCP sends (Scan, ZCtrl, Motor,
+    FolMe, Bias, Current, TipShaper, Piezo, Marks, Signals, AutoApproach)
+    using the same wire format as Nanonis: a 40 byte header followed by a
+    big-endian body, with the error section at the end of every response.
+
+    The instrument is modelled as:
+        surface  : Terraces with meandering step edges, patchy adsorbate
+                   coverage (some areas clean, some not) and any imprints
+                   left by the tip shaper. The same coordinates always give
+                   the same surface
+        scan     : Lines come in at the rate set by Scan.SpeedSet. Partial
+                   frames have NaN for the lines not scanned yet. Rows are
+                   in the order they were acquired, so upward scans start at
+                   the bottom of the frame
+        drift    : The sample moves at a constant velocity, less whatever
+                   Piezo.DriftCompSet compensates
+        tip      : Tip changes happen at random while scanning. They change
+                   the apparent height and sharpness of the tip from that
+                   line on. Tip shaping leaves an imprint the size and shape
+                   of the tip and, if the tip goes deep enough, reshapes it
+        crashes  : Coarse XY moves crash the tip at random. The current reads
+                   crashCurrent until the tip is retracted far enough in Z+
+
+    Time on the instrument runs timeScale times faster than the wall clock so
+    long routines can be run quickly. Sleeps in Scanbot itself aren't sped
+    up.
+
+    One deviation from Nanonis: an end of scan that happened before anyone
+    called Scan.WaitEndOfScan is reported to the next call instead of being
+    lost. Scans finish much sooner than Scanbot expects when timeScale is
+    large and Scanbot would otherwise wait forever.
+
+    """
+    headerSize = 40
+    channelNames = {0: "Current (A)", 14: "Z (m)", 18: "OC M1 Freq. Shift (Hz)", 30: "Bias (V)"}
+
+    def __init__(self,IP='127.0.0.1',ports=[6501,6502,6503,6504],timeScale=1,
+                 lineTime=0.2,pixels=256,lines=256,seed=0,drift=[0,0],
+                 noise=4e-12,coverage=2e16,tipChangeRate=0,crashProbability=0,
+                 crashCurrent=50e-9,approachTime=5):
+        """
+        Parameters
+        ----------
+        IP               : Address to listen on
+        ports            : Ports to listen on. 0 picks a free port (see
+                           self.ports once started)
+        timeScale        : Instrument time runs this many times faster than
+                           the wall clock
+        lineTime         : Default forward time per line (s)
+        pixels,lines     : Default scan buffer size
+        seed             : Seed for the surface and every random event
+        drift            : Sample drift [vx,vy] (m/s)
+        noise            : RMS height noise (m)
+        coverage         : Average adsorbate density (1/m2)
+        tipChangeRate    : Average number of tip changes per scanned line
+        crashProbability : Chance of crashing the tip on each coarse XY move
+        crashCurrent     : Current while the tip is crashed (A)
+        approachTime     : Time an auto approach takes (s)
+
+        """
+        self.IP               = IP
+        self.ports            = list(ports)
+        self.timeScale        = timeScale
+        self.seed             = seed
+        self.drift            = np.array(drift,dtype=float)
+        self.noise            = noise
+        self.coverage         = coverage
+        self.tipChangeRate    = tipChangeRate
+        self.crashProbability = crashProbability
+        self.crashCurrent     = crashCurrent
+        self.approachTime     = approachTime
+
+        self.rng      = np.random.default_rng(seed)
+        self.lock     = threading.Condition()
+        self.t0       = time.time()
+        self.servers  = []
+        self.threads  = []
+        self.running  = False
+
+        self.frame    = [0.0,0.0,50e-9,50e-9,0.0]                               # x,y,w,h,angle (m)
+        self.buffer   = {"channels": [0,14,18], "pixels": pixels, "lines": lines}
+        self.speed    = [lineTime/pixels*50e-9,lineTime/pixels*50e-9,lineTime,lineTime,0,1.0] # fwd speed, bwd speed, fwd line time, bwd line time, const param, speed ratio
+        self.props    = {"continuous": 0, "bouncy": 0, "autosave": 0, "series": "sim_", "comment": ""}
+        self.bias     = 1.0
+        self.setpoint = 100e-12
+        self.zOn      = True
+        self.z        = 0.0
+        self.tipXY    = np.array([0.0,0.0])
+        self.range    = [1e-6,1e-6,300e-9]
+        self.driftComp= {"on": 0, "v": np.zeros(3), "satLimit": 10.0}
+        self.motorFA  = [1000.0,100.0]                                          # Frequency, amplitude
+        self.motorPos = np.zeros(3,dtype=int)                                   # Steps taken in x,y,z
+        self.motorStop = threading.Event()                                      # Set by Motor.StopMove to end a move early
+        self.crashed  = 0                                                       # Z+ steps still needed to clear a crash
+        self.approach = 0                                                       # Time the current auto approach finishes. 0 if not approaching
+        self.tipShaperProps = [0.05,0,-0.1,-1e-9,0.1,0.0,0.1,3e-9,0.1,0.1,1]
+        self.tip      = {"radius": 0.5e-9, "asymmetry": 0.1, "offset": 0.0}
+        self.imprints = []                                                      # [x,y,sx,sy,height] (m)
+        self.scan     = {"running": False, "start": 0, "paused": 0, "direction": 1,
+                         "data": None, "pending": False, "path": ""}
+        self.scanCount= 0
+
+        self.stats  = {"commands": {}, "cpu": 0.0, "bytes": 0}
+        self.events = []                                                        # [wall time, event, details]
+
+        self.commands = {'Scan.Action'          : self.scanAction,
+                         'Scan.StatusGet'       : self.scanStatusGet,
+                         'Scan.WaitEndOfScan'   : self.scanWaitEndOfScan,
+                         'Scan.FrameSet'        : self.scanFrameSet,
+                         'Scan.FrameGet'        : self.scanFrameGet,
+                         'Scan.BufferSet'       : self.scanBufferSet,
+                         'Scan.BufferGet'       : self.scanBufferGet,
+                         'Scan.PropsSet'        : self.scanPropsSet,
+                         'Scan.PropsGet'        : self.scanPropsGet,
+                         'Scan.SpeedSet'        : self.scanSpeedSet,
+                         'Scan.SpeedGet'        : self.scanSpeedGet,
+                         'Scan.FrameDataGrab'   : self.scanFrameDataGrab,
+                         'ZCtrl.ZPosSet'        : self.zPosSet,
+                         'ZCtrl.ZPosGet'        : self.zPosGet,
+                         'ZCtrl.OnOffSet'       : self.zOnOffSet,
+                         'ZCtrl.OnOffGet'       : self.zOnOffGet,
+                         'ZCtrl.SetpntSet'      : self.setpntSet,
+                         'ZCtrl.SetpntGet'      : self.setpntGet,
+                         'ZCtrl.Withdraw'       : self.withdraw,
+                         'Motor.StartMove'      : self.motorStartMove,
+                         'Motor.FreqAmpSet'     : self.motorFreqAmpSet,
+                         'Motor.FreqAmpGet'     : self.motorFreqAmpGet,
+                         'Motor.StopMove'       : self.motorStopMove,
+                         'FolMe.XYPosSet'       : self.folmeXYPosSet,
+                         'FolMe.XYPosGet'       : self.folmeXYPosGet,
+                         'Bias.Set'             : self.biasSet,
+                         'Bias.Get'             : self.biasGet,
+                         'Current.Get'          : self.currentGet,
+                         'TipShaper.Start'      : self.tipShaperStart,
+                         'TipShaper.PropsSet'   : self.tipShaperPropsSet,
+                         'TipShaper.PropsGet'   : self.tipShaperPropsGet,
+                         'Piezo.RangeGet'       : self.piezoRangeGet,
+                         'Piezo.DriftCompSet'   : self.driftCompSet,
+                         'Piezo.DriftCompGet'   : self.driftCompGet,
+                         'Marks.LineDraw'       : self.ok,
+                         'Marks.LinesErase'     : self.ok,
+                         'Marks.PointDraw'      : self.ok,
+                         'Marks.PointsErase'    : self.ok,
+                         'Signals.InSlotsGet'   : self.signalsInSlotsGet,
+                         'AutoApproach.Open'    : self.ok,
+                         'AutoApproach.OnOffSet': self.autoApproachOnOffSet,
+                         'AutoApproach.OnOffGet': self.autoApproachOnOffGet}
+
+###############################################################################
+# Server
+###############################################################################
+    def start(self):
+        """
+        Start listening. Ports given as 0 are replaced with the port the OS
+        picked.
+
+        """
+        self.running = True
+        for idx,port in enumerate(self.ports):
+            server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+            server.bind((self.IP,port))
+            server.listen()
+            self.ports[idx] = server.getsockname()[1]
+            self.servers.append(server)
+            t = threading.Thread(target=self.accept,args=(server,),name="nanonis-sim-" + str(self.ports[idx]),daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.running = False
+        for server in self.servers:
+            try:
+                server.close()
+            except OSError:
+                pass
+        self.servers = []
+        with self.lock:
+            self.lock.notify_all()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*args):
+        self.stop()
+
+    def accept(self,server):
+        while(self.running):
+            try:
+                conn,_ = server.accept()
+            except OSError:                                                     # Server closed
+                return
+            t = threading.Thread(target=self.serve,args=(conn,),daemon=True)
+            t.start()
+
+    def serve(self,conn):
+        """
+        Answer commands on one connection until the client hangs up.
+
+        """
+        with conn:
+            while(self.running):
+                header = self.recvExact(conn,self.headerSize)
+                if(header is None): return
+                name = header[:32].rstrip(b'\x00').decode(errors='replace')
+                size,respond = struct.unpack('>iH',header[32:38])
+                body = self.recvExact(conn,size)
+                if(body is None): return
+
+                cpu = time.thread_time()
+                try:
+                    if(not name in self.commands): raise Exception("Command not simulated: " + name)
+                    payload,error = self.commands[name](body),""
+                except Exception as e:
+                    payload,error = b'',str(e) or type(e).__name__
+                response = payload + self.errorSection(error)
+
+                with self.lock:
+                    self.stats["commands"][name] = self.stats["commands"].get(name,0) + 1
+                    self.stats["cpu"]   += time.thread_time() - cpu
+                    self.stats["bytes"] += len(response)
+
+                if(not respond): continue
+                header = name.encode()[:32].ljust(32,b'\x00') + struct.pack('>iI',len(response),0)
+                try:
+                    conn.sendall(header + response)
+                except OSError:
+                    return
+
+    def recvExact(self,conn,size):
+        data = b''
+        while(len(data) < size):
+            try:
+                chunk = conn.recv(size - len(data))
+            except OSError:
+                return None
+            if(not chunk): return None
+            data += chunk
+        return data
+
+    def errorSection(self,error):
+        if(not error): return struct.pack('>ii',0,0)                            # Status, code. The message is only there when status is set
+        message = error.encode()
+        return struct.pack('>iii',1,0,len(message)) + message
+
+###############################################################################
+# Clock
+###############################################################################
+    def clock(self):
+        """
+        Instrument time (s)
+
+        """
+        return (time.time() - self.t0)*self.timeScale
+
+    def sleep(self,duration):
+        """
+        Wait for duration seconds of instrument time
+
+        """
+        if(duration > 0): time.sleep(duration/self.timeScale)
+
+    def log(self,event,**details):
+        self.events.append([time.time(),event,details])
+
+###############################################################################
+# Surface
+###############################################################################
+    def topography(self,X,Y):
+        """
+        Height of the surface (m) at coordinates X,Y (m). Rows of X,Y are
+        scan lines.
+
+        """
+        u = X*np.cos(0.3) + Y*np.sin(0.3)                                       # Distance across the terraces
+        v = Y*np.cos(0.3) - X*np.sin(0.3)
+        u = u + 4e-9*np.sin(2*np.pi*v/90e-9) + 2e-9*np.sin(2*np.pi*v/23e-9)     # Meandering step edges
+        Z = 2e-10*np.floor(u/60e-9)
+
+        cell = 20e-9
+        xmin,xmax = np.min(X) - 3e-9,np.max(X) + 3e-9
+        ymin,ymax = np.min(Y) - 3e-9,np.max(Y) + 3e-9
+        features = []
+        for ix in range(int(np.floor(xmin/cell)),int(np.floor(xmax/cell)) + 1):
+            for iy in range(int(np.floor(ymin/cell)),int(np.floor(ymax/cell)) + 1):
+                features += self.adsorbates(ix,iy,cell)
+        features += self.imprints
+
+        for x0,y0,sx,sy,height in features:
+            if(x0 < xmin or x0 > xmax or y0 < ymin or y0 > ymax): continue
+            gy = np.exp(-(Y[:,0] - y0)**2/(2*sy**2))                            # Y is constant along a line so the profile in y is per row
+            rows = np.flatnonzero(gy > 1e-3)
+            if(not len(rows)): continue
+            Z[rows] += height*gy[rows,None]*np.exp(-(X[rows] - x0)**2/(2*sx**2))
+        return Z
+
+    def adsorbates(self,ix,iy,cell):
+        """
+        Adsorbates in one cell of the surface. Each cell has its own seed so
+        the surface doesn't depend on the order it's looked at.
+
+        """
+        rng = np.random.default_rng([self.seed,ix + 2**20,iy + 2**20])
+        patch = 4.0 if rng.random() < 0.3 else 0.25                             # Some areas are dirtier than others
+        count = rng.poisson(self.coverage*patch*cell**2)
+        x = (ix + rng.random(count))*cell
+        y = (iy + rng.random(count))*cell
+        s = rng.uniform(0.4e-9,1.0e-9,count)
+        h = rng.uniform(0.8e-10,4e-10,count)
+        return [[x[i],y[i],s[i],s[i],h[i]] for i in range(count)]
+
+    def acquire(self,direction):
+        """
+        Generate the frame the tip will see over the next scan. Rows are in
+        the order they are scanned.
+
+        """
+        x,y,w,h,_ = self.frame
+        pixels,lines = self.buffer["pixels"],self.buffer["lines"]
+        lineTime = self.speed[2] + self.speed[3]
+
+        cols = x - w/2 + (np.arange(pixels) + 0.5)*w/pixels
+        rows = y + h/2 - (np.arange(lines) + 0.5)*h/lines                       # Top line first
+        if(direction == 1): rows = rows[::-1]                                   # Upward scans start at the bottom
+
+        t  = self.clock() + np.arange(lines)*lineTime
+        v  = self.drift - self.driftComp["v"][:2]*(self.driftComp["on"] > 0)
+        X  = cols[None,:] - v[0]*t[:,None]                                      # Where the sample is under the tip when each line is scanned
+        Y  = np.repeat((rows - v[1]*t)[:,None],pixels,axis=1)
+        Z  = self.topography(X,Y)
+
+        segments = [0]                                                          # Lines where the tip changes
+        changes = self.rng.poisson(self.tipChangeRate*lines) if self.tipChangeRate else 0
+        segments += sorted(self.rng.integers(1,lines,changes).tolist())
+        segments.append(lines)
+
+        data = np.empty_like(Z)
+        for start,end in zip(segments[:-1],segments[1:]):
+            if(start > 0):
+                self.tip["radius"] *= self.rng.uniform(0.8,1.8)
+                self.tip["offset"] += self.rng.choice([-1,1])*self.rng.uniform(0.3e-10,1.5e-10)
+                self.log("tip_change",line=int(start))
+            sigma = self.tip["radius"]/(w/pixels)
+            blurred = ndimage.gaussian_filter(Z,sigma) if sigma > 0.3 else Z
+            data[start:end] = blurred[start:end] + self.tip["offset"]
+
+        data += self.rng.normal(scale=self.noise,size=data.shape)
+        return (data + self.z).astype(np.float32)
+
+###############################################################################
+# Scan
+###############################################################################
+    def update(self):
+        """
+        Finish the scan in progress if its time is up. Called with the lock
+        held.
+
+        """
+        scan = self.scan
+        if(not scan["running"] or scan["paused"]): return
+        lineTime = self.speed[2] + self.speed[3]
+        if(self.clock() - scan["start"] < self.buffer["lines"]*lineTime): return
+
+        self.scanCount += 1
+        scan["running"] = False
+        scan["pending"] = True
+        scan["path"]    = "C:/sim/" + self.props["series"] + str(self.scanCount).zfill(3) + ".sxm"
+        self.log("scan_end",path=scan["path"])
+        self.lock.notify_all()
+
+        if(self.props["continuous"]):
+            direction = 1 - scan["direction"] if self.props["bouncy"] else scan["direction"]
+            self.startScan(direction)
+
+    def startScan(self,direction):
+        self.scan.update({"running": True, "start": self.clock(), "paused": 0, "pending": False,
+                          "direction": direction, "data": self.acquire(direction)})
+        self.log("scan_start",frame=list(self.frame),direction=direction)
+
+    def linesScanned(self):
+        scan = self.scan
+        if(scan["data"] is None): return 0
+        if(not scan["running"]): return len(scan["data"])
+        now = scan["paused"] or self.clock()
+        return int(min(len(scan["data"]),(now - scan["start"])/(self.speed[2] + self.speed[3])))
+
+    def scanAction(self,body):
+        action,direction = struct.unpack('>HI',body)
+        with self.lock:
+            self.update()
+            if(action == 0):                                                    # Start. Restarts a scan in progress
+                self.startScan(direction)
+            elif(action == 1 and self.scan["running"]):                         # Stop
+                self.scan["data"] = self.scan["data"].copy()
+                self.scan["data"][self.linesScanned():] = np.nan
+                self.scan.update({"running": False, "pending": True, "path": ""})
+                self.log("scan_stop")
+                self.lock.notify_all()
+            elif(action == 2 and self.scan["running"] and not self.scan["paused"]):
+                self.scan["paused"] = self.clock()
+            elif(action == 3 and self.scan["paused"]):
+                self.scan["start"] += self.clock() - self.scan["paused"]
+                self.scan["paused"] = 0
+        return b''
+
+    def scanStatusGet(self,body):
+        with self.lock:
+            self.update()
+            return struct.pack('>I',int(self.scan["running"]))
+
+    def scanWaitEndOfScan(self,body):
+        timeout, = struct.unpack('>i',body)
+        deadline = None if timeout < 0 else time.time() + timeout/1000
+        with self.lock:
+            while(True):
+                self.update()
+                if(self.scan["pending"]):
+                    self.scan["pending"] = False
+                    path = self.scan["path"].encode()
+                    return struct.pack('>II',0,len(path)) + path
+                if(not self.running): raise Exception("Simulator stopped")
+
+                wait = 0.5                                                      # Wake up when the scan should be finished
+                if(self.scan["running"] and not self.scan["paused"]):
+                    remaining = self.buffer["lines"]*(self.speed[2] + self.speed[3]) - (self.clock() - self.scan["start"])
+                    wait = min(wait,max(remaining/self.timeScale,0.001))
+                if(deadline is not None):
+                    if(time.time() >= deadline): return struct.pack('>II',1,0)
+                    wait = min(wait,deadline - time.time())
+                self.lock.wait(wait)
+
+    def scanFrameSet(self,body):
+        with self.lock:
+            self.frame = list(struct.unpack('>5f',body))
+        return b''
+
+    def scanFrameGet(self,body):
+        with self.lock:
+            return struct.pack('>5f',*self.frame)
+
+    def scanBufferSet(self,body):
+        n, = struct.unpack('>i',body[:4])
+        channels = list(struct.unpack('>' + str(n) + 'i',body[4:4 + 4*n]))
+        pixels,lines = struct.unpack('>ii',body[4 + 4*n:12 + 4*n])
+        with self.lock:
+            self.buffer = {"channels": channels, "pixels": max(16,int(np.ceil(pixels/16)*16)), "lines": lines}
+        return b''
+
+    def scanBufferGet(self,body):
+        with self.lock:
+            channels = self.buffer["channels"]
+            return struct.pack('>i' + str(len(channels)) + 'iii',len(channels),*channels,self.buffer["pixels"],self.buffer["lines"])
+
+    def scanPropsSet(self,body):
+        continuous,bouncy,autosave,size = struct.unpack('>IIIi',body[:16])
+        series = body[16:16 + size].decode()
+        idx = 16 + size
+        size, = struct.unpack('>i',body[idx:idx + 4])
+        comment = body[idx + 4:idx + 4 + size].decode()
+        with self.lock:
+            if(continuous): self.props["continuous"] = int(continuous == 1)     # 0 means no change
+            if(bouncy):     self.props["bouncy"]     = int(bouncy == 1)
+            if(autosave):   self.props["autosave"]   = autosave - 1
+            if(series):     self.props["series"]     = series
+            if(comment):    self.props["comment"]    = comment
+        return b''
+
+    def scanPropsGet(self,body):
+        with self.lock:
+            series  = self.props["series"].encode()
+            comment = self.props["comment"].encode()
+            return (struct.pack('>IIIi',self.props["continuous"],self.props["bouncy"],self.props["autosave"],len(series)) + series
+                    + struct.pack('>i',len(comment)) + comment
+                    + struct.pack('>iii',8,0,0))                                # No modules, autopaste
+
+    def scanSpeedSet(self,body):
+        fwdSpeed,bwdSpeed,fwdTime,bwdTime,_,ratio = struct.unpack('>4fHf',body)
+        with self.lock:
+            if(fwdTime > 0): self.speed[2] = fwdTime
+            if(ratio > 0):   self.speed[5] = ratio
+            self.speed[3] = bwdTime if bwdTime > 0 else self.speed[2]/self.speed[5]
+            w = self.frame[2]
+            self.speed[0] = w/self.speed[2]
+            self.speed[1] = w/self.speed[3]
+        return b''
+
+    def scanSpeedGet(self,body):
+        with self.lock:
+            return struct.pack('>4fHf',*self.speed)
+
+    def scanFrameDataGrab(self,body):
+        channel,direction = struct.unpack('>II',body)
+        with self.lock:
+            self.update()
+            if(not channel in self.buffer["channels"]): raise Exception("Channel " + str(channel) + " is not in the scan buffer")
+            data = self.scan["data"]
+            scanDirection = self.scan["direction"]
+            if(data is None):
+                data = np.full((self.buffer["lines"],self.buffer["pixels"]),np.nan,dtype=np.float32)
+            else:
+                done = self.linesScanned()
+                if(done < len(data)):
+                    data = data.copy()
+                    data[done:] = np.nan
+            if(channel == 0):                                                   # Current is at the setpoint wherever the tip has been
+                data = np.where(np.isnan(data),np.nan,self.setpoint).astype(np.float32)
+            if(channel == 18):                                                  # Frequency shift gets more negative over higher features
+                data = (-3e10*(data - self.z) - 5).astype(np.float32)
+
+        name = self.channelNames.get(channel,"Signal " + str(channel)).encode()
+        return (struct.pack('>i',len(name)) + name + struct.pack('>ii',*data.shape)
+                + data.astype('>f4').tobytes() + struct.pack('>i',scanDirection))
+
+###############################################################################
+# Z controller, bias, current
+###############################################################################
+    def zPosSet(self,body):
+        with self.lock:
+            self.z, = struct.unpack('>f',body)
+        return b''
+
+    def zPosGet(self,body):
+        with self.lock:
+            return struct.pack('>f',self.z + self.rng.normal(scale=self.noise))
+
+    def zOnOffSet(self,body):
+        on, = struct.unpack('>I',body)
+        with self.lock:
+            self.zOn = bool(on)
+        return b''
+
+    def zOnOffGet(self,body):
+        with self.lock:
+            return struct.pack('>I',int(self.zOn))
+
+    def setpntSet(self,body):
+        with self.lock:
+            self.setpoint, = struct.unpack('>f',body)
+        return b''
+
+    def setpntGet(self,body):
+        with self.lock:
+            return struct.pack('>f',self.setpoint)
+
+    def withdraw(self,body):
+        wait,timeout = struct.unpack('>Ii',body)
+        with self.lock:
+            self.zOn = False
+            self.z   = self.range[2]/2
+        if(wait): self.sleep(0.2)
+        return b''
+
+    def biasSet(self,body):
+        with self.lock:
+            self.bias, = struct.unpack('>f',body)
+        return b''
+
+    def biasGet(self,body):
+        with self.lock:
+            return struct.pack('>f',self.bias)
+
+    def currentGet(self,body):
+        with self.lock:
+            if(self.crashed): current = self.crashCurrent
+            elif(self.zOn):   current = self.setpoint*(1 + self.rng.normal(scale=0.05))
+            else:             current = self.rng.normal(scale=1e-13)
+            return struct.pack('>f',current)
+
+###############################################################################
+# Motor, approach, follow me
+###############################################################################
+    def motorStartMove(self,body):
+        direction,steps,group,wait = struct.unpack('>IHII',body)
+        axis,sign = direction//2,1 - 2*(direction%2)                            # X+,X-,Y+,Y-,Z+,Z-
+        with self.lock:
+            self.motorPos[axis] += sign*steps
+            if(axis == 2 and sign > 0 and self.crashed):
+                self.crashed = max(0,self.crashed - steps)
+                if(not self.crashed): self.log("crash_cleared")
+            if(axis < 2 and steps and self.rng.random() < self.crashProbability):
+                self.crashed = int(self.rng.integers(50,200))
+                self.zOn = False
+                self.log("crash",steps=self.crashed)
+            duration = steps/self.motorFA[0]
+            self.motorStop.clear()
+        start = time.time()
+        if(wait and steps and self.motorStop.wait(duration/self.timeScale)):    # Motor.StopMove from another connection ends the move early
+            taken = int(steps*min(1,(time.time() - start)*self.timeScale/duration))
+            with self.lock:
+                self.motorPos[axis] -= sign*(steps - taken)                     # Steps that weren't taken before the stop
+        return b''
+
+    def motorStopMove(self,body):
+        self.motorStop.set()
+        return b''
+
+    def motorFreqAmpSet(self,body):
+        frequency,amplitude,_ = struct.unpack('>ffH',body)
+        with self.lock:
+            self.motorFA = [max(frequency,1.0),amplitude]
+        return b''
+
+    def motorFreqAmpGet(self,body):
+        with self.lock:
+            return struct.pack('>ff',*self.motorFA)
+
+    def autoApproachOnOffSet(self,body):
+        on, = struct.unpack('>H',body)
+        with self.lock:
+            self.approach = self.clock() + self.approachTime if on else 0
+        return b''
+
+    def autoApproachOnOffGet(self,body):
+        with self.lock:
+            if(self.approach and self.clock() >= self.approach):                # Landed
+                self.approach = 0
+                self.zOn = True
+                self.z   = 0.0
+            return struct.pack('>H',int(bool(self.approach)))
+
+    def folmeXYPosSet(self,body):
+        x,y,wait = struct.unpack('>ddI',body)
+        with self.lock:
+            distance = np.hypot(*(np.array([x,y]) - self.tipXY))
+            self.tipXY = np.array([x,y])
+        if(wait): self.sleep(distance/100e-9)                                   # 100 nm/s
+        return b''
+
+    def folmeXYPosGet(self,body):
+        with self.lock:
+            return struct.pack('>dd',*self.tipXY)
+
+###############################################################################
+# Tip shaper
+###############################################################################
+    def tipShaperPropsSet(self,body):
+        with self.lock:
+            self.tipShaperProps = list(struct.unpack('>fI8fI',body))
+        return b''
+
+    def tipShaperPropsGet(self,body):
+        with self.lock:
+            return struct.pack('>fI8fI',*self.tipShaperProps)
+
+    def tipShaperStart(self,body):
+        """
+        Leave an imprint of the tip at the tip's position. The deeper the
+        tip goes, the more likely it is to come out a different shape.
+
+        """
+        wait,timeout = struct.unpack('>Ii',body)
+        with self.lock:
+            props = self.tipShaperProps
+            depth = abs(min(props[3],0))
+            r,a   = self.tip["radius"],self.tip["asymmetry"]
+            angle = self.rng.uniform(0,np.pi)
+            sx,sy = r*(1 + a),r/(1 + a)
+            sx,sy = np.hypot(sx*np.cos(angle),sy*np.sin(angle)),np.hypot(sx*np.sin(angle),sy*np.cos(angle)) # Axis-aligned approximation of a rotated imprint
+            self.imprints.append([self.tipXY[0],self.tipXY[1],sx,sy,3e-10])
+
+            reshaped = self.rng.random() < min(1,(depth/2e-9)**2)
+            if(reshaped):
+                self.tip = {"radius"   : float(np.clip(self.rng.lognormal(np.log(0.35e-9),0.4),0.1e-9,3e-9)),
+                            "asymmetry": float(self.rng.uniform(0,0.6)),
+                            "offset"   : 0.0}
+            self.log("tip_shape",depth=depth,reshaped=bool(reshaped),radius=self.tip["radius"])
+            duration = props[4] + props[6] + props[8] + props[9]
+            self.zOn = bool(props[10]) or self.zOn
+        if(wait): self.sleep(duration)
+        return b''
+
+###############################################################################
+# Piezo, signals
+###############################################################################
+    def piezoRangeGet(self,body):
+        return struct.pack('>3f',*self.range)
+
+    def driftCompSet(self,body):
+        on,vx,vy,vz,satLimit = struct.unpack('>i4f',body)
+        with self.lock:
+            if(on >= 0): self.driftComp["on"] = on
+            self.driftComp["v"] = np.array([vx,vy,vz])
+            self.driftComp["satLimit"] = satLimit
+        return b''
+
+    def driftCompGet(self,body):
+        with self.lock:
+            return struct.pack('>I3f3If',int(self.driftComp["on"] > 0),*self.driftComp["v"],0,0,0,self.driftComp["satLimit"])
+
+    def signalsInSlotsGet(self,body):
+        names   = [self.channelNames[c].encode() for c in sorted(self.channelNames)]
+        payload = b''.join(struct.pack('>i',len(name)) + name for name in names)
+        indexes = sorted(self.channelNames)
+        return (struct.pack('>ii',len(payload),len(names)) + payload
+                + struct.pack('>i' + str(len(indexes)) + 'i',len(indexes),*indexes))
+
+    def ok(self,body):
+        return b''
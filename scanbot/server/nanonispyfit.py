@@ -7,9 +7,12 @@ Created on Mon Dec 12 22:57:34 2016
 """
 
 import numpy as _np
+from functools import lru_cache as _lru_cache
 
-from scipy import optimize as _optimize
-from scipy.stats import norm as _norm
+from scanbot.server import lazy as _lazy
+
+_optimize = _lazy.lazy_module('scipy.optimize')                                 # scipy.stats alone takes a few hundred ms to import. Only load it when fitting
+_stats    = _lazy.lazy_module('scipy.stats')
 
 
 ### internal functions not loaded by core_functions:
@@ -18,20 +21,60 @@ def _plane(a0, a1, b1, x0, y0):
     return lambda x,y: a0 +a1*(x-x0) +b1*(y-y0)
     
 def _planemoments(data):
-    a0 = _np.abs(data).min()
-    index = (data-a0).argmin()
-    x, y = data.shape
-    x0 = float(index / x)
-    y0 = float(index % y)
+    a0 = _np.nanmin(_np.abs(data))
+    index = _np.nanargmin(data-a0)
+    x0, y0 = _np.unravel_index(index, data.shape)
     a1 = 0.0
     b1 = 0.0
-    return a0, a1, b1, x0, y0
+    return a0, a1, b1, float(x0), float(y0)
  
-def _fitplane(data):
+def _fitplane_leastsq(data):
+    # Original iterative fit. Kept as a reference for the closed-form solver
     params = _planemoments(data)
     errorfunction = lambda p: _np.ravel(_plane(*p)(*_np.indices(data.shape)) - data)
     p, success = _optimize.leastsq(errorfunction, params)
     return p
+
+@_lru_cache(maxsize=32)
+def _grid_moments(shape, region=None):
+    # Coordinates and normal-equation matrix of an unmasked plane fit. x and y
+    # are centred on the image so the sums stay well conditioned. Cached since
+    # every frame in a run has the same shape.
+    x = _np.arange(shape[0]) - (shape[0] - 1)/2
+    y = _np.arange(shape[1]) - (shape[1] - 1)/2
+    if region is not None:
+        x = x[region[0][0]:region[1][0]]
+        y = y[region[0][1]:region[1][1]]
+    
+    n = len(x)*len(y)
+    M = _np.array([[n,             x.sum()*len(y),  y.sum()*len(x)],
+                   [x.sum()*len(y), (x*x).sum()*len(y), x.sum()*y.sum()],
+                   [y.sum()*len(x), x.sum()*y.sum(),  (y*y).sum()*len(x)]])
+    for a in (x, y): a.setflags(write=False)
+    return x, y, _np.linalg.pinv(M)
+
+def _fitplane(data, region=None):
+    # Closed-form least squares fit of a0 + a1*x + b1*y using the centred
+    # coordinates from _grid_moments. nan's are excluded from the fit.
+    x, y, Minv = _grid_moments(data.shape, region)
+    if region is not None:
+        data = data[region[0][0]:region[1][0], region[0][1]:region[1][1]]
+    
+    mask = _np.isnan(data)
+    if mask.any():
+        valid = ~mask
+        cx = valid.sum(axis=1)                                                  # Valid points per row
+        cy = valid.sum(axis=0)                                                  # Valid points per column
+        M = _np.array([[cx.sum(),  x @ cx,      y @ cy],
+                       [x @ cx,    (x*x) @ cx,  x @ valid @ y],
+                       [y @ cy,    x @ valid @ y, (y*y) @ cy]])
+        Minv = _np.linalg.pinv(M)
+        data = _np.where(mask, 0, data)
+    
+    rows = data.sum(axis=1, dtype=_np.float64)
+    cols = data.sum(axis=0, dtype=_np.float64)
+    b = _np.array([rows.sum(), x @ rows, y @ cols])
+    return Minv @ b
     
 def _return_plane(params, data):
     _fit_data = _plane(*params)
@@ -58,34 +101,95 @@ def plane_fit_2d(scan_image, region=None):
         plane-subtracted image array
 
     '''
-    if region == None:
-        return scan_image - _return_plane(_fitplane(scan_image),scan_image)
-    else:
-        scan_fit_area = scan_image[region[0][0]:region[1][0], region[0][1]:region[1][1]]
-        return scan_image - _return_plane(_fitplane(scan_fit_area), scan_image)
+    scan_image = _np.asarray(scan_image)
+    if region is not None:
+        region = tuple(tuple(corner) for corner in region)                      # Hashable for the moment cache
+    
+    a0, a1, b1 = _fitplane(scan_image, region)
+    x, y, _ = _grid_moments(scan_image.shape)
+    
+    dtype = scan_image.dtype if _np.issubdtype(scan_image.dtype, _np.floating) else _np.float64
+    flat = scan_image - (a0 + a1*x).astype(dtype)[:, None]                  # Subtract the plane one axis at a time. Avoids building it in float64
+    flat -= (b1*y).astype(dtype)[None, :]
+    return flat
     
     
+@_lru_cache(maxsize=32)
+def _vandermonde(n, order):
+    # Vandermonde matrix on x in [-1,1] (well conditioned for high order) and
+    # its pseudo-inverse. Shared by every row of every frame with n points.
+    x = _np.linspace(-1, 1, n) if n > 1 else _np.zeros(1)
+    V = _np.vander(x, order + 1)
+    P = _np.linalg.pinv(V)
+    V.setflags(write=False)
+    P.setflags(write=False)
+    return V, P
+
+def row_poly_fit(scan_image, order=1, axis=1):
+    '''
+    Subtract a polynomial background from every line of an image at once.
+    
+    Parameters
+    ----------
+    scan_image : 2d array
+        image to be flattened.
+    order : int, optional
+        polynomial order. 1 = line, 2 = parabola.
+    axis : int, optional
+        1 fits along each row (standard line-by-line flattening), 0 fits 
+        along each column.
+
+    Returns
+    -------
+    TYPE
+        line-flattened image array. nan's are ignored in the fit and kept in 
+        the output.
+
+    '''
+    scan_image = _np.asarray(scan_image)
+    data = scan_image if axis == 1 else scan_image.T                            # Work on rows
+    V, P = _vandermonde(data.shape[1], int(order))
+    
+    mask = _np.isnan(data)
+    partial = mask.any(axis=1)
+    coeffs = _np.empty((data.shape[0], V.shape[1]))
+    
+    coeffs[~partial] = data[~partial] @ P.T                                     # Complete rows share one pseudo-inverse
+    if partial.any():                                                           # Rows with nan's get their own weighted normal equations
+        w = (~mask[partial]).astype(_np.float64)
+        d = _np.where(mask[partial], 0, data[partial])
+        A = _np.einsum('rn,nk,nj->rkj', w, V, V)
+        b = d @ V
+        coeffs[partial] = (_np.linalg.pinv(A) @ b[:, :, None])[:, :, 0]         # pinv copes with rows that are (almost) all nan
+    
+    dtype = data.dtype if _np.issubdtype(data.dtype, _np.floating) else _np.float64
+    flat = data - (coeffs @ V.T).astype(dtype)
+    return flat if axis == 1 else flat.T
+    
 def row_line_fit(scan_image):
-    x = _np.arange(scan_image.shape[0])
-    for i in range(scan_image.shape[1]):
-        fit = _np.polyfit(x,scan_image[i,],1)
-        fit = _np.polyval(fit, x)
-        scan_image[i,] -= fit
-    return scan_image
+    return row_poly_fit(scan_image, order=1)
 
 def subtract_average(scan_image):
     return scan_image - _np.mean(scan_image)
     
 def row_parabolic_fit(scan_image):
-    x = _np.arange(scan_image.shape[0])
-    for i in range(scan_image.shape[1]):
-        fit = _np.polyfit(x,scan_image[i,],2)
-        fit = _np.polyval(fit, x)
-        scan_image[i,] -= fit
-    return scan_image
+    return row_poly_fit(scan_image, order=2)
+
+flatten_modes = {'none'      : no_filter,
+                 'plane'     : plane_fit_2d,
+                 'line'      : row_line_fit,
+                 'parabolic' : row_parabolic_fit,
+                 'column'    : lambda scan_image: row_poly_fit(scan_image, order=1, axis=0)}
+
+def flatten(scan_image, mode='plane'):
+    '''
+    Flatten an image using one of flatten_modes.
+
+    '''
+    return flatten_modes[mode](scan_image)
     
 def filter_sigma(image, sig=3):
-    mu, sigma = _norm.fit(image)
+    mu, sigma = _stats.norm.fit(image)
     vmin = mu - sig * sigma
     vmax = mu + sig * sigma
     return vmin, vmax
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 13:40:05 2026
+
+Headless rendering of scan data straight to image files. Data is mapped
+through a precomputed 256 entry colormap and encoded with OpenCV so no
+matplotlib figure is ever created.
+"""
+
+from scanbot.server import lazy
+
+from functools import lru_cache
+import numpy as np
+
+cv2 = lazy.lazy_module('cv2')
+
+@lru_cache(maxsize=None)
+def colormapLUT(cmap='inferno'):
+    """
+    Returns a 256 entry lookup table for a matplotlib colormap. matplotlib is
+    only imported the first time a colormap is requested.
+
+    Parameters
+    ----------
+    cmap : Name of the matplotlib colormap
+
+    Returns
+    -------
+    lut : (256,3) uint8 array in BGR order (OpenCV channel order)
+
+    """
+    try:
+        from matplotlib import colormaps
+        colormap = colormaps[cmap]
+    except ImportError:                                                         # matplotlib < 3.5
+        from matplotlib import cm
+        colormap = cm.get_cmap(cmap)
+
+    rgb = colormap(np.linspace(0,1,256),bytes=True)[:,:3]                       # Quantised the same way matplotlib does when drawing
+    lut = np.ascontiguousarray(rgb[:,::-1])
+    lut.setflags(write=False)
+    return lut
+
+def floating(value):
+    """
+    Convert to the float type matplotlib normalises in. Floats keep their
+    precision. Integers of two bytes or less become float32, the rest
+    float64.
+
+    """
+    value = np.asarray(value)
+    if(value.dtype.kind == 'f'): return value
+    return value.astype(np.promote_types(value.dtype,np.float32))
+
+def colourise(data,vmin=None,vmax=None,cmap='inferno'):
+    """
+    Map a 2D array through a colormap. Values are binned the same way as
+    matplotlib's imshow so the output matches it pixel for pixel. Values
+    outside [vmin,vmax] saturate and nan's are drawn black.
+
+    Parameters
+    ----------
+    data : 2D array to colourise. (h,w,3) RGB arrays are passed through
+           as-is.
+    vmin : Value mapped to the bottom of the colormap. Defaults to the minimum
+    vmax : Value mapped to the top of the colormap. Defaults to the maximum
+    cmap : Name of the matplotlib colormap
+
+    Returns
+    -------
+    image : (h,w,3) uint8 BGR image
+
+    """
+    data = np.asarray(data)
+    if(data.ndim == 3):                                                         # Already an RGB image
+        image = data[:,:,:3]
+        if(image.dtype != np.uint8):
+            image = np.clip(np.round(image*255),0,255).astype(np.uint8)
+        return np.ascontiguousarray(image[:,:,::-1])
+
+    if(vmin is None): vmin = np.nanmin(data)
+    if(vmax is None): vmax = np.nanmax(data)
+    vmin,vmax = floating(vmin),floating(vmax)
+
+    index = np.array(data,dtype=floating(data).dtype)                           # float32 data stays float32, the same as matplotlib.colors.Normalize
+    nans  = np.isnan(index)
+    if(vmax > vmin):                                                            # Same order of operations as Normalize, in place
+        index -= vmin
+        index /= (vmax - vmin)
+    else: index[:] = 0
+    index *= 256
+    np.clip(index,0,255,out=index)
+    index[nans] = 0
+
+    image = colormapLUT(cmap)[index.astype(np.uint8)]
+    if(nans.any()): image[nans] = 0                                             # Black for missing data
+    return image
+
+def writeImage(filename,image,scale=1,quality=90):
+    """
+    Encode an image to disk. The format is taken from the file extension.
+    PNGs are written with fast (light) compression. WebP uses quality.
+
+    Parameters
+    ----------
+    filename : Output path (.png or .webp)
+    image    : (h,w,3) uint8 BGR image
+    scale    : Integer upscale factor. Each pixel becomes a scale x scale
+               block so the output stays pixel-exact.
+    quality  : WebP quality (1-100)
+
+    Returns
+    -------
+    filename : Output path
+
+    """
+    scale = int(scale)
+    if(scale > 1):
+        image = cv2.resize(image,None,fx=scale,fy=scale,interpolation=cv2.INTER_NEAREST)
+
+    params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+    if(filename.lower().endswith('.webp')):
+        params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+
+    if(not cv2.imwrite(filename,image,params)):
+        raise IOError("Could not write image " + filename)
+
+    return filename
+
+def renderImage(filename,data,vmin=None,vmax=None,cmap='inferno',scale=1):
+    """
+    Colourise data and write it to filename. See colourise and writeImage.
+
+    """
+    return writeImage(filename,colourise(data,vmin,vmax,cmap),scale=scale)
@@ -21,6 +21,15 @@ from nanonisTCP.TipShaper import TipShaper
 from scanbot.server import global_
 from scanbot.server import utilities
 from scanbot.server import nanonispyfit as napfit
+from scanbot.server.connection_pool import connection_pool
+from scanbot.server import workers
+from scanbot.server import tracing
+from scanbot.server import lazy
+from scanbot.server import settle
+from scanbot.server import render
+from scanbot.server import animation
+from scanbot.server.archive import scan_archive
+from scanbot.server.stitcher import mosaic
 
 import time
 from datetime import datetime as dt
@@ -28,21 +37,16 @@ from datetime import timedelta
 from pathlib import Path
 import ntpath
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('agg')
-import cv2
 import os
 import math
 
-try: import hk_classifier
-except: pass
-
-try: import hk_tipShape
-except: pass
+hk_classifier = lazy.lazy_module('hk_classifier')                               # Hooks are imported the first time they're called. Every call is already in a try/except
+hk_tipShape   = lazy.lazy_module('hk_tipShape')
+hk_light      = lazy.lazy_module('hk_light')
 
-try: from hk_light import turn_on
-except: pass
+cv2         = lazy.lazy_module('cv2')                                           # Only needed for the camera and for rendering
+camera      = lazy.lazy_module('scanbot.server.camera')
+tip_control = lazy.lazy_module('scanbot.server.tip_control')
 
 try: import pickle
 except: pass
@@ -66,7 +70,14 @@ class scanbot():
     
     autoInitSet  = False                                                        # Flag to indicate whether tip, sample, and clean metal locations have been initialised
     autoInitDemo = 0                                                            # 0 = live, 1 = demo
+    demoReplaySpeed = 4                                                         # Demo videos play back at this multiple of their frame rate
 
+    flatten = "plane"                                                           # Background subtraction used when rendering pngs. See napfit.flatten_modes
+    
+    settleTolerance = {"z"       : [20e-12, 0],                                 # Signals are stable when the spread of the last few readings is within [absolute, fraction of the reading]
+                       "current" : [2e-12, 0.2],
+                       "bias"    : [1e-3, 0]}
+    
     surveyParams  = []                                                          # Last survey params
     survey2Params = []                                                          # Last survey2 params
 
@@ -78,6 +89,7 @@ class scanbot():
 ###############################################################################
     def __init__(self,interface):
         self.interface = interface
+        self.pool      = connection_pool(lambda IP,PORT: tracing.instrument(nanonisTCP(IP, PORT))) # Persistent nanonisTCP sessions, one per port. Round trips are traced
         
 ###############################################################################
 # Data Acquisition
@@ -115,7 +127,7 @@ class scanbot():
         
         self.disconnect(NTCP)                                                   # Close the TCP connection
             
-    def survey(self,bias,n,startAt,suffix,xy,dx,px,sleepTime,stitch,survey_hk,classifier_hk,autotip,ox=0,oy=0,message="",enhance=False,reverse=False,iamauto=False):
+    def survey(self,bias,n,startAt,suffix,xy,dx,px,sleepTime,stitch,survey_hk,classifier_hk,autotip,pipeline=0,ox=0,oy=0,message="",enhance=False,reverse=False,iamauto=False):
         """
         This function carries out an autonomous survey within the scannable 
         area.
@@ -138,6 +150,9 @@ class scanbot():
                         shaping. See documentation for details.
         autotip : Analayse scan frames and automatically navigate the tip to 
                   a clean reference metal for tip shaping.
+        pipeline : Start the next scan as soon as the raw data has been 
+                   grabbed. Rendering, uploads, hk_survey and cloud uploads 
+                   run in the background while the next frame is acquired.
         ox : Absolute x-centre coordinate for the survey grid (m)
         oy : Absolute y-centre coordinate for the survey grid (m)
         message : (Zulip use only)
@@ -158,7 +173,7 @@ class scanbot():
             global_.running.clear()                                             # Free up the running flag
             return
         
-        self.surveyParams = [bias,n,startAt,suffix,xy,dx,px,sleepTime,stitch,survey_hk,classifier_hk,autotip]
+        self.surveyParams = [bias,n,startAt,suffix,xy,dx,px,sleepTime,stitch,survey_hk,classifier_hk,autotip,pipeline]
         
         scan  = Scan(NTCP)
         piezo = Piezo(NTCP)
@@ -195,103 +210,129 @@ class scanbot():
             px = int(np.ceil(px/16)*16)                                         # Pixels must be divisible by 16
             scan.BufferSet(pixels=px,lines=px)
         
-        stitchedSurvey = []
-        if(stitch == 1):
+        stitcher = None
+        if(stitch == 1):                                                        # Frames are blended into a mosaic on disk as they come in
             _,_,px,lines = scan.BufferGet()
-            stitchedSurvey = np.zeros((lines*n,px*n))*np.nan
+            Path(self.interface.module_dir + 'temp').mkdir(parents=True, exist_ok=True)
+            stitcher = mosaic(self.interface.module_dir + 'temp/' + suffix + '_stitch',frames,px,lines,flatten=self.flatten)
+        
+        postProcessor = None
+        if(pipeline):                                                           # Post-process frames in the background while the next one is scanned
+            onError = lambda e: self.interface.sendReply("Warning: survey post-processing failed: " + str(e),message=message)
+            postProcessor = workers.bounded_pool(workers=1,maxPending=2,name="survey",onError=onError)
+        
+        archive = None
+        if(self.interface.cloudPath):                                           # Every scan in the survey goes into one archive for the cloud database
+            archive = scan_archive(self.interface.module_dir + tempBasename + time.strftime("%Y%m%d-%H%M%S") + ".scans")
         
         callAutoTipShape = False
         classificationHistory = []
-        for idx,frame in enumerate(frames):
-            if(idx < startAt-1): continue
-            
-            self.interface.sendReply('Running scan ' + str(idx + 1) + '/' + str(n**2),message=message) # Send a message that the next scan is starting
-            
-            slept = 0
-            scan.FrameSet(*frame)                                               # Set the coordinates and size of the frame window in nanonis
-            scan.Action('start')                                                # Start the scan. default direction is "up"
-            while(slept < sleepTime):                                           # This loop makes running 'stop' more responsive
-                time.sleep(0.2)                                                 # Wait for drift to settle
-                slept += 0.2
+        try:
+            for idx,frame in enumerate(frames):
+                if(idx < startAt-1): continue
+                
+                self.interface.sendReply('Running scan ' + str(idx + 1) + '/' + str(n**2),message=message) # Send a message that the next scan is starting
+                
+                scan.FrameSet(*frame)                                           # Set the coordinates and size of the frame window in nanonis
+                scan.Action('start')                                            # Start the scan. default direction is "up"
+                restart = self.settleScan(scan,sleepTime)                       # Watch the first lines for piezo creep after moving the frame
                 if(self.checkEventFlags()): break                               # Check event flags
-            if(self.checkEventFlags()): break                                   # Check event flags
-            
-            timeoutStatus = 1
-            scan.Action('start')                                                # Start the scan. default direction is "up"
-            while(timeoutStatus):
-                timeoutStatus, _, filePath = scan.WaitEndOfScan(timeout=200)    # Wait until the scan finishes
+                
+                detector = None
+                if(autotip and not classifier_hk and not self.autoInitDemo):
+                    detector = utilities.tipChangeDetector()                    # Follows the scan as lines come in so a bad tip can be caught mid-scan
+                
+                timeoutStatus = 1
+                badTip = False
+                lastCheck = time.time()
+                if(restart): scan.Action('start')                               # Restart the scan now the drift has settled. default direction is "up"
+                while(timeoutStatus):
+                    timeoutStatus, _, filePath = scan.WaitEndOfScan(timeout=200) # Wait until the scan finishes
+                    if(self.checkEventFlags()): break                           # Check event flags
+                    if(detector and timeoutStatus and time.time() - lastCheck > 2): # Check the lines scanned so far every couple of seconds
+                        lastCheck = time.time()
+                        _,partialData,_ = scan.FrameDataGrab(14, 1)
+                        if(detector.update(partialData)["count"] > 5 and utilities.tipShapeDue(classificationHistory)):
+                            scan.Action('stop')                                 # No point finishing this scan
+                            badTip = True
+                            break
                 if(self.checkEventFlags()): break                               # Check event flags
-            if(self.checkEventFlags()): break                                   # Check event flags
                 
-            if(not filePath): time.sleep(0.2); continue                         # If user stops the scan, filePath will be blank, then go to the next scan
-            
-            _,scanData,_ = scan.FrameDataGrab(14, 1)                            # Grab the data within the scan frame. Channel 14 is . 1 is forward data direction
-            
-            dummyData = []
-            if(autotip):                                                        # If auto tip shaping = Yes, we need to classify the scan to determine if it's time to reshape the tip
-                if(self.autoInitDemo):                                          # Replace real scanData with dummy data if auto tip shape is on and the tip was initialised in demo mode
-                    try:
-                        pkpath = self.interface.module_dir + "../Dev/survey.pk"
-                        dummyData = pickle.load(open(pkpath,'rb'))
-                        scanData  = dummyData[idx]
-                    except:
+                if(badTip):
+                    self.interface.sendReply("Tip changes detected mid-scan. Stopping survey to reshape the tip.",message=message)
+                    callAutoTipShape = True
+                    break
+                    
+                if(not filePath): tracing.sleep(0.2); continue                  # If user stops the scan, filePath will be blank, then go to the next scan
+                
+                _,scanData,_ = scan.FrameDataGrab(14, 1)                        # Grab the data within the scan frame. Channel 14 is . 1 is forward data direction
+                
+                dummyData = []
+                if(autotip):                                                    # If auto tip shaping = Yes, we need to classify the scan to determine if it's time to reshape the tip
+                    if(self.autoInitDemo):                                      # Replace real scanData with dummy data if auto tip shape is on and the tip was initialised in demo mode
                         try:
-                            pkpath = self.interface.module_dir + "./Dev/survey.pk"
+                            pkpath = self.interface.module_dir + "../Dev/survey.pk"
                             dummyData = pickle.load(open(pkpath,'rb'))
                             scanData  = dummyData[idx]
                         except:
-                            self.interface.sendReply("Could not load demo data for survey. Please ensure the Dev folder is saved in ~/scanbot")
-
-                if(classifier_hk):
-                    try:
-                        classification = hk_classifier.run(scanData,filePath,classificationHistory) # Overwrite classification with the one from the hook
-                    except Exception as e:
-                        self.interface.sendReply("Warning: Call to survey hook hk_classifier.py failed:")
-                        self.interface.sendReply(str(e))
-                        self.interface.sendReply("Default Scanbot classifier will be used instead.")
-                        classification = utilities.classify(scanData,filePath,classificationHistory) # Obtain image classification
-                else:
-                    classification = utilities.classify(scanData,filePath,classificationHistory) # Obtain image classification
+                            try:
+                                pkpath = self.interface.module_dir + "./Dev/survey.pk"
+                                dummyData = pickle.load(open(pkpath,'rb'))
+                                scanData  = dummyData[idx]
+                            except:
+                                self.interface.sendReply("Could not load demo data for survey. Please ensure the Dev folder is saved in ~/scanbot")
+
+                    if(classifier_hk):
+                        try:
+                            classification = hk_classifier.run(scanData,filePath,classificationHistory) # Overwrite classification with the one from the hook
+                        except Exception as e:
+                            self.interface.sendReply("Warning: Call to survey hook hk_classifier.py failed:")
+                            self.interface.sendReply(str(e))
+                            self.interface.sendReply("Default Scanbot classifier will be used instead.")
+                            classification = utilities.classify(scanData,filePath,classificationHistory) # Obtain image classification
+                    else:
+                        classification = utilities.classify(scanData,filePath,classificationHistory,detector) # Obtain image classification. Only the lines the detector hasn't seen are processed
+                        
+                    classificationHistory.append(classification)
                     
-                classificationHistory.append(classification)
+                    print("Image classification: ",classification)
+                    
+                    if(classification["tipShape"] == 1):
+                        print("auto tip shaping initate!")
+                        callAutoTipShape = True
                 
-                print("Image classification: ",classification)
+                _,scanData,_ = scan.FrameDataGrab(self.channel, 1)              # Grab the data related to our focused channel
+                if(dummyData): scanData = dummyData[idx]                        # This happens when in demo mode
                 
-                if(classification["tipShape"] == 1):
-                    print("auto tip shaping initate!")
-                    callAutoTipShape = True
-            
-            _,scanData,_ = scan.FrameDataGrab(self.channel, 1)                  # Grab the data related to our focused channel
-            if(dummyData): scanData = dummyData[idx]                            # This happens when in demo mode
-
-            pngFilename,scanDataPlaneFit = self.makePNG(scanData, filePath,returnData=True,dpi=150) # Generate a png from the scan data
-            self.interface.sendPNG(pngFilename,notify=True,message=message)     # Send a png over zulip
-            
-            if(survey_hk):                                                      # call a custom python script
-                try:
-                    from hk_survey import run
-                    metaData = self.getMetaData(filePath)
-                    run(scanData,filePath,metaData)
-                except Exception as e:
-                    self.interface.sendReply("Warning: Call to survey hook hk_survey.py failed:")
-                    self.interface.sendReply(str(e))
-            
-            if(stitch):
-                row = (idx)//n
-                col = ((row)%2)*((n-1) - idx%n) + ((row+1)%2)*idx%n
-                stitchedSurvey[(n-1-row)*lines:(n-1-row)*lines+lines,px*col:px*col+px] = scanData
-            
-            if(self.interface.cloudPath):
-                metaData = self.getMetaData(filePath)
-                pklFile = utilities.pklDict(scanData,filePath,*metaData,comments="scanbot")
-                self.interface.uploadToCloud(pklFile)                           # Send data to cloud database
-            
-            if(self.checkEventFlags()): break                                   # Check event flags
-            if(callAutoTipShape): break
-
-        if(stitch == 1 and not np.isnan(stitchedSurvey).all()):
-            stitchFilepath = self.makePNG(stitchedSurvey,pngFilename = suffix + '_stitch.png',dpi=150*n, fit=False)
-            self.interface.sendPNG(stitchFilepath,notify=False,message=message) # Send a png over zulip
+                metaData = []
+                if(survey_hk or self.interface.cloudPath):
+                    metaData = self.getMetaData(filePath)                       # Grab this now, before the scan frame moves to the next position
+                
+                stitchArgs = []
+                if(stitcher): stitchArgs = [stitcher,frame]
+                
+                postProcessArgs = [scanData,filePath,metaData,survey_hk,stitchArgs,archive,message]
+                if(postProcessor): postProcessor.submit(self.surveyPostProcess,*postProcessArgs) # Blocks if the worker has fallen too far behind
+                else:              self.surveyPostProcess(*postProcessArgs)
+                
+                if(self.checkEventFlags()): break                               # Check event flags
+                if(callAutoTipShape): break
+        finally:
+            if(postProcessor):                                                  # Also when the scan raises. Don't leave the worker and its frames behind
+                postProcessor.drain()                                           # Wait for the last frames to be rendered and uploaded
+                postProcessor.shutdown()
+            
+            if(archive is not None):                                            # Send the scans that finished, even if the survey didn't
+                archive.close()
+                if(len(archive)): self.interface.uploadToCloud(archive.path)    # Send data to cloud database
+        
+        if(stitcher):
+            if(stitcher.tiles):
+                stitchFilepath = self.makePNG(stitcher.preview(),pngFilename = suffix + '_stitch.png', fit=False) # Downsampled so the png stays a sensible size
+                self.interface.sendPNG(stitchFilepath,notify=False,message=message) # Send a png over zulip
+                if(self.interface.run_mode == 'react'):
+                    stitcher.pyramid(self.interface.module_dir + 'temp/stitch/' + suffix) # Full resolution tiles for zoomable viewing. Served at /get_stitch/
+            stitcher.close()
         
         scan.PropsSet(series_name=basename)                                     # Put back the original basename
         self.disconnect(NTCP)                                                   # Close the TCP connection
@@ -307,9 +348,48 @@ class scanbot():
             global_.running.clear()                                             # Free up the running flag
             user_args = ['-run=survey', '-return=1', '-tipshape=1']
             self.interface.moveTipToClean(user_args=user_args)
+    
+    def surveyPostProcess(self,scanData,filePath,metaData,survey_hk,stitchArgs,archive=None,message=""):
+        """
+        Everything that happens to a survey frame after its raw data has been 
+        grabbed. This doesn't talk to the instrument so it can run in the 
+        background while the next frame is being acquired.
+
+        Parameters
+        ----------
+        scanData   : Raw data of the focused channel
+        filePath   : Path to the .sxm file
+        metaData   : Frame metadata from getMetaData (only needed for 
+                     hk_survey and cloud uploads)
+        survey_hk  : Flag to call hk_survey
+        stitchArgs : [stitcher, frame]. The mosaic and the frame's [x,y,w,h]
+                     so it can be placed by its real coordinates. Empty to
+                     skip stitching.
+        archive    : scan_archive the frame is saved to for the cloud 
+                     database. None to skip.
+        message    : (Zulip use only)
+
+        """
+        pngFilename,scanDataPlaneFit = self.makePNG(scanData, filePath,returnData=True) # Generate a png from the scan data
+        self.interface.sendPNG(pngFilename,notify=True,message=message)         # Send a png over zulip
+        
+        if(survey_hk):                                                          # call a custom python script
+            try:
+                from hk_survey import run
+                run(scanData,filePath,metaData)
+            except Exception as e:
+                self.interface.sendReply("Warning: Call to survey hook hk_survey.py failed:")
+                self.interface.sendReply(str(e))
+        
+        if(stitchArgs):
+            stitcher,frame = stitchArgs
+            stitcher.add(scanData,*frame)
+        
+        if(archive is not None):                                                # An empty archive is falsy
+            archive.append(scanData,filePath,*metaData,comments="scanbot")      # Uploaded to the cloud database when the survey finishes
         
     def survey2(self,bias,n,startAt,suffix,xy,dx,px,sleepTime,stitch,survey_hk,classifier_hk,autotip, # Survey params
-                     nx,ny,xStep,yStep,zStep,xyV,zV,xyF,zF,message=""):          # Move area params
+                     nx,ny,xStep,yStep,zStep,xyV,zV,xyF,zF,pipeline=0,message=""): # Move area params
         """
         This function acquires many surveys with a call to move_area between
         each one.
@@ -318,7 +398,7 @@ class scanbot():
         self.currentAction["action"] = "survey"
         
         self.survey2Params = [bias,n,startAt,suffix,xy,dx,px,sleepTime,stitch,survey_hk,classifier_hk,autotip, # Survey2 params
-                              nx,ny,xStep,yStep,zStep,xyV,zV,xyF,zF]
+                              nx,ny,xStep,yStep,zStep,xyV,zV,xyF,zF,pipeline]
     
         if(nx == 1): xStep = 0
         if(ny == 1): yStep = 0
@@ -341,11 +421,11 @@ class scanbot():
                 if(self.checkEventFlags()): break                               # Check event flags
                 
                 s = suffix + "_y" + str(y) + "_x" + str(x)
-                callAutoTipShape = self.survey(bias,n,startAt,s,xy,dx,px,sleepTime,stitch,survey_hk,classifier_hk,autotip,reverse=reverse,iamauto=True,message=message)
+                callAutoTipShape = self.survey(bias,n,startAt,s,xy,dx,px,sleepTime,stitch,survey_hk,classifier_hk,autotip,pipeline=pipeline,reverse=reverse,iamauto=True,message=message)
                 reverse = not reverse
                 
                 if(self.checkEventFlags()): break                               # Check event flags
-                time.sleep(2)
+                tracing.sleep(2)
                 
                 if(x == nx-1): continue                                         # Skip the move area after last survey in this row since we'll be moving in y next
                 
@@ -360,7 +440,7 @@ class scanbot():
                     global_.running.clear()
                     break
                 
-                time.sleep(sleepTime)
+                tracing.sleep(sleepTime)
             
             xdirection = not xdirection                                         # Change x direction to snake the grid
             
@@ -371,7 +451,7 @@ class scanbot():
             self.interface.sendReply("Moving " + str(yStep) + " steps in " + ydirection,message=message)
             self.moveArea(up=zStep,upV=zV,upF=zF,direction=ydirection,steps=yStep,dirV=xyV,dirF=xyF,zon=True)
             
-            time.sleep(sleepTime)
+            tracing.sleep(sleepTime)
             
         global_.running.clear()
         
@@ -379,7 +459,7 @@ class scanbot():
             user_args = ['-run=survey2', '-return=1', '-tipshape=1']
             self.interface.moveTipToClean(user_args=user_args)
     
-    def biasDep(self,nb,dcbias,tdc,dcSpeedRatio,pxdc,lxdc,bi,bf,px,lx,tlf,speedRatio,suffix,message=""):
+    def biasDep(self,nb,dcbias,tdc,dcSpeedRatio,pxdc,lxdc,bi,bf,px,lx,tlf,speedRatio,suffix,makeGIF=1,message=""):
         """
         This function initiates a set of bias dependent scans with the option 
         of performing drift correction.
@@ -404,6 +484,8 @@ class scanbot():
         tlf : Scan speed (time per line (s))
         speedRatio : Backward scan speed ratio
         suffix : Suffix appended to the filenames of the set of bias dep images
+        makeGIF : Animate the images as they're acquired. 0=No, 1=GIF, 2=MP4,
+                  3=WebM
         message : (Zulip use only)
 
         Returns
@@ -448,20 +530,19 @@ class scanbot():
         dxy   = np.array([dx,dy])
         ox,oy = np.array([0,0])
         
-        GIF       = []
+        GIF       = self.newAnimation(suffix,makeGIF)
         biasList  = np.linspace(bi,bf,nb)
-        initialDC = np.zeros((pxdc,pxdc))
+        dcReference = None
         for idx,bias in enumerate(biasList):
             self.interface.sendReply("Scan " + str(idx+1) + "/" + str(nb))
             if(abs(dcbias) > 0):                                                # If drift correction is turned on, take a drift correction image
-                time.sleep(0.25)
                 scanModule.BufferSet(pixels=pxdc,lines=lxdc)
                 scanModule.SpeedSet(fwd_line_time=tdc,speed_ratio=dcSpeedRatio)
                 
                 print("Ramping bias to " + str(dcbias) + " and taking drift correction image.")
                 self.rampBias(NTCP, dcbias)
                 if(self.checkEventFlags()): break                               # Check event flags
-                time.sleep(0.25)
+                self.settle(NTCP,"z",0.25)                                      # Let the tip height catch up with the new bias
                 
                 basename_dc = tempBasename + str(int(dcbias*100)/100) + "V-DC_"
                 scanModule.PropsSet(series_name=basename_dc)                    # Set the basename for drift correction images
@@ -472,8 +553,8 @@ class scanbot():
 
                 _,driftCorrection,_ = scanModule.FrameDataGrab(14, 1)
                 
-                if(np.sum(initialDC) == 0): initialDC = driftCorrection.copy()  # On the first run through, we will compare the initial drift correction frame with itself, so ox,oy = 0,0
-                ox,oy = utilities.getFrameOffset(initialDC,driftCorrection,dxy,theta=-scanFrame[4]) # Frame offset for drift correction. passing negative scan angle because nanonis is backwards
+                if(dcReference is None): dcReference = utilities.driftReference(driftCorrection) # On the first run through, we will compare the initial drift correction frame with itself, so ox,oy = 0,0
+                ox,oy = self.driftOffset(dcReference,driftCorrection,dxy,theta=-scanFrame[4],message=message) # Frame offset for drift correction. passing negative scan angle because nanonis is backwards
                 print("Frame offset correction offset: " + str([ox,oy]))
                 
                 scanFrame[0] -= ox
@@ -497,14 +578,13 @@ class scanbot():
             
             _,scanData,_ = scanModule.FrameDataGrab(self.channel, 1)            # 14 = z., 18 is Freq. shift
             pngFilename = self.makePNG(scanData, filePath)                      # Generate a png from the scan data
-            GIF.append(scanData)
+            if(GIF): GIF.append(self.interface.module_dir + pngFilename)        # Add the frame to the animation on disk before the png is sent off
             
             self.interface.sendPNG(pngFilename,notify=False,message=message)    # Send a png over zulip
             
-        time.sleep(0.25)
         scanModule.PropsSet(series_name=basename)                               # Put back the original basename
         
-        # self.interface.sendPNG(utilities.makeGif(GIF),notify=False,message=message)
+        self.finishAnimation(GIF,message=message)
         
         self.interface.sendReply("biasDep " + suffix + " complete.")
         
@@ -623,7 +703,7 @@ class scanbot():
             self.disconnect(NTCP)
             global_.running.clear()                                             # Free up the running flag
         
-        status, vx, vy, vz, _, _, _ = piezo.DriftCompGet()
+        status, vx, vy, vz = piezo.DriftCompGet()[:4]                           # Newer versions of Nanonis also return the saturation limit
         if not status:
             piezo.DriftCompSet(on=False, vx=0, vy=0, vz=0)
             
@@ -632,7 +712,7 @@ class scanbot():
         dxy = np.array([dx,dy])
         ox,oy = np.array([0,0])
         dzList = np.linspace(zi, zf, nz)
-        initialDC = np.zeros((dcpx,dcpx))
+        dcReference = None
         print("dzList: " + str(dzList))
         
         scanTime  = lx*(ft + bt)
@@ -641,7 +721,7 @@ class scanbot():
            scanTime  += 2*dclx*dct
            delayTime += 1.5
         
-        GIF = []
+        GIF = self.newAnimation(suffix,makeGIF)
         eta = len(dzList)*(scanTime + delayTime)
         completionTime = dt.now() + timedelta(seconds=eta)
         self.interface.sendReply("Starting zdep.. ETA: " + str(completionTime))
@@ -649,13 +729,11 @@ class scanbot():
             self.interface.sendReply("Scan " + str(idx+1) + "/" + str(len(dzList)))
             print("doing dz = " + str(dz*1e9) + " nm")
             if(abs(dcbias) > 0):                                                # If drift correction is turned on, take a drift correction image
-                time.sleep(0.25)
                 zController.OnOffSet(on=1)                                      # Turn on the controller to get reference
                 
-                time.sleep(0.25)
                 print("DC: Setpoint: " + str(dciset*1e12) + " pA")
                 zController.SetpntSet(setpoint=abs(dciset))                     # Update setpoint current in nanonis
-                time.sleep(0.25)
+                self.settle(NTCP,"z",0.25)
                 
                 print("DC: px,lx: " + str([dcpx,dclx]))
                 scanModule.BufferSet(pixels=dcpx,lines=dclx)
@@ -664,7 +742,7 @@ class scanbot():
                 
                 print("DC: Ramping bias: " + str(dcbias))
                 self.rampBias(NTCP, dcbias)
-                time.sleep(0.25)
+                self.settle(NTCP,"z",0.25)
                 
                 print("DC: Taking scan")
                 scanModule.PropsSet(series_name=tempBasename + str(dcbias) + "V-DC_") # Set the basename in nanonis for this survey
@@ -673,9 +751,9 @@ class scanbot():
                 if(not filePath): break                                         # If the scan was stopped before finishing, stop zdep
                 _,driftCorrection,_ = scanModule.FrameDataGrab(14, 1)
                 
-                if(np.sum(initialDC) == 0): initialDC = driftCorrection
+                if(dcReference is None): dcReference = utilities.driftReference(driftCorrection) # Reference spectrum is computed once for the whole series
                 print("Scan Angle: " + str(scanFrame[4]))
-                ox,oy = utilities.getFrameOffset(initialDC,driftCorrection,dxy,theta=-scanFrame[4]) # Frame offset for drift correction. passing negative scan angle because nanonis is backwards
+                ox,oy = self.driftOffset(dcReference,driftCorrection,dxy,theta=-scanFrame[4],message=message) # Frame offset for drift correction. passing negative scan angle because nanonis is backwards
                 print("DC: ox,oy: " + str([ox,oy]))
                 
                 scanFrame[0] -= ox
@@ -684,30 +762,27 @@ class scanbot():
                 
                 tipPos -= np.array([ox,oy])
                 
-            time.sleep(0.25)
             zController.OnOffSet(on=1)                                          # Turn on the controller to get reference
             print("CH: Moving tip: " + str(tipPos))
             folme.XYPosSet(tipPos[0], tipPos[1], Wait_end_of_move=True)
             
-            time.sleep(0.5)
             print("CH: Setpoint: " + str(iset*1e12) + " pA")
             zController.SetpntSet(setpoint=abs(iset))                           # Update setpoint current in nanonis
             
-            time.sleep(0.5)
             print("CH: Ramping to setpoint bias: " + str(bset) + " V")
             self.rampBias(NTCP, bset)
             
             zref = 0
-            time.sleep(0.5)
+            self.settle(NTCP,"z",1.5)                                           # Tip has moved and the setpoint changed. Wait for z before taking the reference
             for i in range(100):
                 zref += zController.ZPosGet()/100                               # Average 100 values of z position. This is the position zi and zf are relative to
-                time.sleep(0.01)                                                # 10 ms sample rate
+                tracing.sleep(0.01)                                             # 10 ms sample rate
             
             if('time' in previous_zref):
                 deltaz = zref - previous_zref['z']
                 deltat = (dt.now() - previous_zref['time']).total_seconds()
                 dvz = deltaz/deltat
-                status, vx, vy, vz, _, _, _ = piezo.DriftCompGet()              # the vz velocity
+                status, vx, vy, vz = piezo.DriftCompGet()[:4]                   # the vz velocity
                 print("deltaz/deltat = " + str(deltaz) + "/" + str(deltat))
                 print("vz,dvz,vz+dvz = " + str(vz) + "," + str(dvz) + "," + str(dvz + vz))
                 if(not -dcbias == 0):                                           # Only do this if dc is turned on
@@ -724,7 +799,7 @@ class scanbot():
             print("CH: Ramping bias: " + str(bias) + " V")
             self.rampBias(NTCP, bias, zhold=False)                              # zhold=False leaves the zhold setting as is during bias ramp (i.e. don't turn controller on after bias ramp complete)
             
-            time.sleep(0.25)
+            self.settle(NTCP,"current",0.25)                                    # Controller is off. Only the current responds to the new bias
             print("CH: moving to z=" + str(1e9*zref + 1e9*dz))
             zController.ZPosSet(zpos=zref + dz)                                 # Go to the next position
             
@@ -739,20 +814,18 @@ class scanbot():
             
             _,scanData,_ = scanModule.FrameDataGrab(18, 1)                      # 14 = z., 18 is Freq. shift
             pngFilename = self.makePNG(scanData, filePath)                      # Generate a png from the scan data
-            GIF.append(scanData)
+            if(GIF): GIF.append(self.interface.module_dir + pngFilename)        # Add the frame to the animation on disk before the png is sent off
             
             self.interface.sendPNG(pngFilename,notify=False,message=message)    # Send a png over zulip
             
         print("Finishing up.. turning controller on")
-        time.sleep(0.25)
         zController.OnOffSet(on=1)                                              # Turn on the controller
         
-        time.sleep(0.25)
         zController.SetpntSet(setpoint=abs(iset))                               # Update setpoint current in nanonis
-        time.sleep(0.25)
+        self.settle(NTCP,"z",0.75)
         scanModule.PropsSet(series_name=basename)                               # Put back the original basename
         
-        # self.interface.sendPNG(utilities.makeGif(GIF),notify=False,message=message)
+        self.finishAnimation(GIF,message=message)
         
         self.interface.sendReply("zdep " + suffix + " complete")
         
@@ -880,35 +953,29 @@ class scanbot():
         scanModule.PropsSet(series_name=tempBasename)                           # Set the basename in nanonis
         
         zController.OnOffSet(on=1)                                              # Turn on the controller to get reference
-        time.sleep(0.25)
         zController.SetpntSet(setpoint=abs(iset))                               # Update setpoint current in nanonis
-        time.sleep(0.5)
         self.rampBias(NTCP, bias=bset)
         
         zref = 0
-        time.sleep(0.5)
+        self.settle(NTCP,"z",1.25)                                              # Wait for z before taking the reference
         for i in range(100):
             zref += zController.ZPosGet()/100                                   # Average 100 values of z position. This is the position zi and zf are relative to
-            time.sleep(0.01)                                                    # 10 ms sample rate
+            tracing.sleep(0.01)                                                 # 10 ms sample rate
         
-        time.sleep(0.25)
         zController.OnOffSet(on=0)                                              # Turn off the controller
-        time.sleep(0.25)
         self.rampBias(NTCP, bias=bias)
-        time.sleep(0.5)
+        self.settle(NTCP,"z",0.75)
         zController.ZPosSet(zpos=zref + zset)                                   # Go to the setpoint
-        time.sleep(0.25)
+        self.settle(NTCP,"z",0.25)                                              # Wait for the tip to get there
         
         scanModule.Action('start',scan_direction=scanDir)
         while(True):  
             timeout,_,_= scanModule.WaitEndOfScan(timeout=int((ft+bt)*1000))
             if(self.checkEventFlags() or not timeout):                          # Check event flags
                 marks.LinesErase()
-                time.sleep(0.25)
                 zController.OnOffSet(on=1)                                      # Turn on the controller
-                time.sleep(0.25)
                 zController.SetpntSet(setpoint=abs(iset))                       # Update setpoint current in nanonis
-                time.sleep(0.25)
+                self.settle(NTCP,"z",0.75)
                 scanModule.PropsSet(series_name=basename)                       # Put back the original basename
                 self.interface.sendReply("registration " + suffix + " stopped")
                 self.disconnect(NTCP)                                           # Close the TCP connection
@@ -920,9 +987,9 @@ class scanbot():
             lines = sum(scanData > 0)
             if(lines > lz):
                 scanModule.Action('pause',scan_direction=scanDir)
-                time.sleep(1)
+                tracing.sleep(1)
                 zController.ZPosSet(zpos=zref+zset+dz)                          # Apply dz offset
-                time.sleep(1)
+                self.settle(NTCP,"z",1)                                         # Wait for the tip to get there
                 scanModule.Action('resume',scan_direction=scanDir)
                 break
             
@@ -933,12 +1000,10 @@ class scanbot():
         pngFilename = self.makePNG(scanData, filePath)                          # Generate a png from the scan data
         self.interface.sendPNG(pngFilename,notify=False,message=message)        # Send a png over zulip
             
-        time.sleep(0.25)
         zController.OnOffSet(on=1)                                              # Turn on the controller
         
-        time.sleep(0.25)
         zController.SetpntSet(setpoint=abs(iset))                               # Update setpoint current in nanonis
-        time.sleep(0.25)
+        self.settle(NTCP,"z",0.75)
         scanModule.PropsSet(series_name=basename)                               # Put back the original basename
         
         marks.LinesErase()
@@ -1057,13 +1122,12 @@ class scanbot():
         print("withdrawing")
         zController.Withdraw(wait_until_finished=True,timeout=3)                # Withdwar the tip
         print("withdrew")
-        time.sleep(0.25)
         
         if(not demo):
             motor.FreqAmpSet(upF,upV)                                               # Set the motor controller params appropriate for Z piezos
             motor.StartMove("Z+",up,wait_until_finished=True)                       # Retract the tip +Z direction
         print("Moving motor: Z+" + " " + str(up) + "steps")
-        time.sleep(0.5)
+        tracing.sleep(0.5)                                                      # Fixed wait. The tip is withdrawn so no signal we can read responds to the coarse step
         
         stepsAtATime = 10                                                       # Moving the motor across 10 steps at a time to be safe
         leftOver     = steps%stepsAtATime                                       # Continue moving motor a few steps if stes is not divisible by 10
@@ -1085,12 +1149,12 @@ class scanbot():
                                          + " while moving areas",message=message)
                 return False
                 
-            time.sleep(0.25)
+            tracing.sleep(0.25)                                                 # Let vibrations from the coarse step die down before the next one
         
         if(not demo):
             motor.StartMove(direction,leftOver,wait_until_finished=True)
         print("Moving motor: " + direction + " " + str(leftOver) + "steps")
-        time.sleep(0.5)
+        tracing.sleep(0.5)
         
         isSafe = self.safeCurrentCheck(NTCP,message=message)                    # Safe retract if current overload
         if(not isSafe):
@@ -1107,17 +1171,15 @@ class scanbot():
                 motor.FreqAmpSet(upF,upV)
         
             autoApproach.Open()
-            time.sleep(1)                                                       # Module needs time to open
+            tracing.sleep(1)                                                    # Module needs time to open
             autoApproach.OnOffSet(on_off=True)
             
-            while(autoApproach.OnOffGet()):
-                print("Still approaching...")
-                time.sleep(1)
-        
-            time.sleep(1)
+            print("Approaching...")
+            settle.waitUntil(lambda: not autoApproach.OnOffGet(),timeout=None,interval=0.25,name="approach")
+            
             if(zon): zController.OnOffSet(True)
-        
-            time.sleep(3)
+            
+            self.settle(NTCP,"z",4)                                             # Z creeps for a while after an approach
             self.interface.reactToMessage("sparkler")
         
         self.disconnect(NTCP)                                                   # Close the TCP connection
@@ -1164,13 +1226,14 @@ class scanbot():
         self.currentAction["action"] = "movetip"
         if(lightOnOff):                                                         # If we want to turn the light on
             try:
-                turn_on()                                                       # Call the hook to do so. Hook should return null if successful, otherwise it should throw an Exception
+                hk_light.turn_on()                                              # Call the hook to do so. Hook should return null if successful, otherwise it should throw an Exception
             except Exception as e:
                 self.interface.sendReply("Error calling hook hk_light.py to turn on light")
                 global_.running.clear()                                         # Free up the running flag
                 return str(e)
         
-        cap = utilities.getVideo(cameraPort,self.autoInitDemo)
+        cap = camera.camera_stream(utilities.getVideo(cameraPort,self.autoInitDemo),
+                                   average=11,replaySpeed=self.demoReplaySpeed if self.autoInitDemo else 0)
         ret,frame = utilities.getAveragedFrame(cap,n=1)                         # Read the first frame of the video to test camera feed
         if(not ret):
             self.interface.sendReply("Error finding camera feed. Check camera port.")
@@ -1197,34 +1260,39 @@ class scanbot():
         print("target",target)
         if(not len(target)): trackOnly = True
         
-        success = True
         targetHit = False
         previousPos = np.array([0,0])
         previousTime = time.time()
         # pk = []
         currentPos = tipPos.copy()
         
+        seq = 0
+        tracker = camera.tip_tracker(self.initialFrame,tipPos)                  # Only looks near where the tip is expected to be
+        display = np.empty_like(cap.latest()[1])
+        
+        controller = None
+        if(not trackOnly):                                                      # Motors and crash monitoring run on their own threads while this one tracks the tip
+            controller = tip_control.tip_controller(self,target,xStep,zStep,xV,zV,xF,zF,fresh=cap.fresh,demo=self.autoInitDemo).start()
+        
         while(cap.isOpened()):
-            if(not success):
-                self.interface.sendReply("Error moving area... tip crashed... stopping")
-                global_.running.clear()
-                break
+            seq = cap.wait(seq)                                                 # Next frame. The camera is read on its own thread
+            if(not seq): break
             
-            ret, frame = utilities.getAveragedFrame(cap,n=11,initialFrame=self.initialFrame.copy())
-            if(not ret): break
-        
-            currentPos = utilities.trackTip(frame,currentPos)
+            found = tracker.update(lambda region: cap.averaged(region=region))  # Running average of the last 11 frames, only where the tip is expected
+            if(found is not None): currentPos = found
+            if(tracker.lost > tracker.maxLost):
+                self.interface.sendReply("Lost track of the tip... stopping")
+                break
             
             # print(currentPos)
             
-            ret, frame = cap.read()
-            if(not ret): break
+            _,frame = cap.latest(out=display)                                   # Copy to draw on. The ring buffer is left alone
             rec = cv2.circle(frame, currentPos, radius=3, color=(0, 0, 255), thickness=-1)
             if(len(target)): rec = cv2.circle(rec, target, radius=3, color=(0, 255, 0), thickness=-1)
                 
             cv2.imshow('Frame',rec)
             
-            if cv2.waitKey(25) & 0xFF == ord('q'): break                        # Press Q on keyboard to  exit
+            if cv2.waitKey(1) & 0xFF == ord('q'): break                         # Press Q on keyboard to  exit. Frames are paced by the camera now
             if(self.checkEventFlags()): break                                   # Check event flags
             
             if(self.interface.run_mode == 'react'):
@@ -1239,29 +1307,19 @@ class scanbot():
                         previousTime = time.time()
 
             if(trackOnly): continue
-            
-            if(currentPos[1] > target[1]):                                      # First priority is to always keep the tip above this line
-                if(self.autoInitDemo):
-                    print("Moving up")
-                    continue
-                success = self.moveArea(up=zStep, upV=zV, upF=zF, direction="X+", steps=0, dirV=xV, dirF=xF, zon=False, approach=False)
-                continue
-            if(currentPos[0] < target[0]):
-                if(self.autoInitDemo):
-                    print("Moving right")
-                    continue
-                success = self.moveArea(up=10, upV=zV, upF=zF, direction="X+", steps=xStep, dirV=xV, dirF=xF, zon=False, approach=False)
-                continue
-            if(currentPos[0] > target[0]):
-                if(self.autoInitDemo):
-                    print("Moving left")
-                    continue
-                success = self.moveArea(up=10, upV=zV, upF=zF, direction="X-", steps=xStep, dirV=xV, dirF=xF, zon=False, approach=False)
-                continue
-            
-            targetHit = True
-            self.interface.sendReply("Target Hit!")
-            break                                                               # Target reached!
+            if(controller.done.is_set()): break                                 # Target hit, crash or error
+            if(not tracker.lost): controller.observe(currentPos,seq)            # Don't move on a stale position
+        
+        if(controller):
+            result = controller.stop()
+            if(result == "hit"):
+                targetHit = True
+                self.interface.sendReply("Target Hit!")
+            elif(result == "crash"):
+                self.interface.sendReply("Error moving area... tip crashed... stopping")
+                global_.running.clear()
+            elif(result != "stopped"):
+                self.interface.sendReply(result)
         
         cap.release()
         cv2.destroyAllWindows()
@@ -1505,7 +1563,7 @@ class scanbot():
         timeout = 0
         while(timeout < 30):
             if cv2.waitKey(25) & 0xFF == ord('q'): break                        # Press Q on keyboard to  exit
-            time.sleep(1)
+            tracing.sleep(1)
             timeout += 1
             
         cap.release()
@@ -1740,24 +1798,24 @@ class scanbot():
             scanModule.FrameSet(*frame)
             
             scanModule.Action(scan_action="start",scan_direction="up")          # Start an upward scan
-            for numSeconds in range(sleepTime):                                 # Sleep at one second intervals so we can still stop the routine without lag if we need to
-                time.sleep(1)
-                if(self.checkEventFlags()): break                               # Check event flags
+            restart = self.settleScan(scanModule,sleepTime)                     # Watch the first lines for piezo creep after moving the frame
             if(self.checkEventFlags()): break                                   # Check event flags
                 
-            scanModule.Action(scan_action="start",scan_direction="up")          # Restart an upward scan, hopefully image is less drifty now
+            if(restart): scanModule.Action(scan_action="start",scan_direction="up") # Restart an upward scan now the image is less drifty
             
+            monitor  = utilities.cleanMonitor(lxy=wh,threshold=0.3e-9,sensitivity=1) # Only looks at the lines scanned since the last check
             isClean  = True
             timedOut = True
             while(timedOut and isClean):                                        # Periodically check if the current scan is of a clean region
                 timedOut, _, filePath = scanModule.WaitEndOfScan(timeout=3000)  # Wait until the scan finishes or 3 sec, whichever occurs first
                 _,cleanImage,_ = scanModule.FrameDataGrab(14, 1)                # Image of the 'clean' surface
-                isClean = utilities.isClean(cleanImage,lxy=wh,threshold=0.3e-9,sensitivity=1) # Check if the scan so far is of a clean area
+                isClean = monitor.update(cleanImage)["clean"]                   # Check if the scan so far is of a clean area
             
             cleanImage = np.flipud(cleanImage)                                  # Flip because the scan direction is up
             if(not isClean):
                 scanModule.Action(scan_action='stop')
-                self.interface.sendReply("Bad area, moving scan frame")
+                result = monitor.result
+                self.interface.sendReply("Bad area (" + result["reason"] + " after " + str(result["line"]) + "/" + str(len(cleanImage)) + " lines), moving scan frame")
                 continue                                                        # Don't count the attempt if the area sucks
             
             if(not filePath): break                                             # If the scan was stopped before finishing, stop program
@@ -1770,10 +1828,9 @@ class scanbot():
             folme.XYPosSet(*tipCheckPos,Wait_end_of_move=True)                  # Move the tip to a clean place
             
             self.tipShapeProps(*tipCheckerProps)                                # Set the tip shaping properties up for the very light action
-            time.sleep(1)
             if(self.checkEventFlags()): break                                   # Check event flags
             self.tipShape()                                                     # Execute the light tip shape
-            time.sleep(1)
+            self.settle(NTCP,"z",1)                                             # Feedback is back on after the tip shape. Wait for z to recover
             if(self.checkEventFlags()): break                                   # Check event flags
             
             scanModule.Action(scan_action="start",scan_direction="up")          # Start an upward scan
@@ -1795,8 +1852,8 @@ class scanbot():
             symmetry,size,contour = utilities.assessTip(tipImprint,wh,tipCheckPos,True) # Assess the quality of the tip based on the imprint it leaves on the surface
             
             imprintFilename = "imprint_size--" + str(int(size*100)/100) + "_symm--" + str(int(symmetry*100)/100) + ".png"
-            imprintPNG = self.makePNG(tipImprint,pngFilename=imprintFilename)
-            self.interface.sendPNG(imprintPNG)
+            imprintPNG = self.makePNG(contour,pngFilename=imprintFilename)
+            self.interface.sendPNG(imprintPNG,meta={"size": str(int(size*100)/100), "sym": str(int(symmetry*100)/100)})
                 
             self.interface.sendReply("Imprint size: " + str(size) + "\nImprint symm: " + str(symmetry))
             
@@ -1834,10 +1891,9 @@ class scanbot():
                     self.interface.sendReply(str(e))
             
             self.tipShapeProps(*tipShapeProps)                                  # Set the tip shaping properties up to change the tip
-            time.sleep(1)
             if(self.checkEventFlags()): break                                   # Check event flags
             self.tipShape()                                                     # Execute the tip shape
-            time.sleep(1)
+            self.settle(NTCP,"z",1)                                             # Feedback is back on after the tip shape. Wait for z to recover
             if(self.checkEventFlags()): break                                   # Check event flags
             
             attempt += 1
@@ -1852,8 +1908,8 @@ class scanbot():
         
         try:                                                                    # Will fail if no images of the tip imprint were taken before process stopped
             imprintFilename = "imprint_size--" + str(int(size*100)/100) + "_symm--" + str(int(symmetry*100)/100) + "_final.png"
-            imprintPNG = self.makePNG(tipImprint,pngFilename=imprintFilename)
-            self.interface.sendPNG(imprintPNG)
+            imprintPNG = self.makePNG(contour,pngFilename=imprintFilename)
+            self.interface.sendPNG(imprintPNG,meta={"size": str(int(size*100)/100), "sym": str(int(symmetry*100)/100)})
         except: pass
         
         self.disconnect(NTCP)                                                   # Close the TCP connection
@@ -2025,6 +2081,128 @@ class scanbot():
         if(tipY < bottomLeft[1] or tipY > topRight[1]): return False
         return True
     
+    def newAnimation(self,name,makeGIF=1):
+        """
+        Start an animation that frames are appended to as they're acquired.
+
+        Parameters
+        ----------
+        name    : Filename without extension. Saved in module_dir/temp/
+        makeGIF : 0=No animation, 1=GIF, 2=MP4, 3=WebM
+
+        Returns
+        -------
+        writer : Animation writer. None if makeGIF=0
+
+        """
+        self.interface.animationPath = ""                                       # Don't serve the previous run's animation
+        extension = {1: ".gif", 2: ".mp4", 3: ".webm"}.get(makeGIF,"")
+        if(not extension): return None
+        
+        Path(self.interface.module_dir + 'temp').mkdir(parents=True, exist_ok=True)
+        writer = animation.openWriter(self.interface.module_dir + 'temp/' + name + extension)
+        if(isinstance(writer,animation.gif_writer)):                            # The GIF is valid after every append so it can be served while the routine runs
+            self.interface.animationPath = writer.path
+        return writer
+    
+    def finishAnimation(self,writer,message=""):
+        if(not writer or not writer.frames): return
+        writer.close()
+        self.interface.sendAnimation(writer.path,message=message)
+    
+    def driftOffset(self,dcReference,driftCorrection,dxy,theta=0,message=""):
+        """
+        Returns the drift of a drift correction frame relative to the 
+        reference frame. Matches that aren't confident enough to trust are 
+        rejected and no correction is applied.
+
+        Parameters
+        ----------
+        dcReference     : utilities.driftReference of the first drift 
+                          correction frame
+        driftCorrection : Latest drift correction frame
+        dxy             : Pixel size in x and y: [dx,dy]
+        theta           : Angle in degrees
+        message         : (Zulip use only)
+
+        Returns
+        -------
+        ox,oy : Offset to subtract from the scan frame
+
+        """
+        ox,oy,confidence = dcReference.offset(driftCorrection,dxy,theta=theta)
+        if(confidence < dcReference.minConfidence):
+            self.interface.sendReply("Warning: Drift correction rejected (confidence " + str(int(confidence*10)/10) + "). Scan frame not moved.",message=message)
+            return 0,0
+        
+        return ox,oy
+    
+    def settle(self,NTCP,signal,fallback,timeout=None):
+        """
+        Wait for a signal to stop changing after something on the instrument
+        has been changed. Replaces fixed sleeps: returns as soon as the signal
+        is stable (see settleTolerance) rather than always waiting the worst
+        case.
+
+        Parameters
+        ----------
+        NTCP     : Handle to NanonisTCP connection
+        signal   : 'z', 'current' or 'bias'
+        fallback : Fixed time that used to be slept here (s). Slept instead if
+                   the signal can't be read
+        timeout  : Longest to wait for the signal (s). Default: twice the
+                   fallback, at least 0.5 s
+
+        Returns
+        -------
+        stable : True if the signal settled before timing out
+
+        """
+        readers = {"z"       : lambda: ZController(NTCP).ZPosGet(),
+                   "current" : lambda: Current(NTCP).Get(),
+                   "bias"    : lambda: Bias(NTCP).Get()}
+        
+        if(timeout is None): timeout = max(2*fallback,0.5)
+        tolerance,relative = self.settleTolerance[signal]
+        stable,_ = settle.waitForStable(readers[signal],tolerance,timeout,relative=relative,fallback=fallback,name="settle " + signal)
+        return stable
+    
+    def settleScan(self,scan,timeout):
+        """
+        Watch the first lines of a scan that has just started after moving
+        the frame. Piezo creep shows up as a line-to-line shift that changes
+        as the scan goes on.
+
+        Parameters
+        ----------
+        scan    : nanonisTCP Scan module with the scan running
+        timeout : Longest to wait for the creep to settle (s). This is the
+                  old fixed settle time
+
+        Returns
+        -------
+        restart : True if the scan should be restarted because the lines
+                  scanned so far are distorted. False if the scan was clean
+                  from the start and can be kept.
+
+        """
+        if(timeout <= 0): return True                                           # Nothing to wait for. Restart straight away as before
+        
+        start = time.time()
+        while(time.time() - start < timeout):                                   # Polling also keeps 'stop' responsive
+            tracing.sleep(0.5)
+            if(self.checkEventFlags()): return False
+            
+            _,scanData,_ = scan.FrameDataGrab(14, 1)
+            settled,lines = settle.creepSettled(scanData)
+            if(settled):
+                print("Drift settled after " + str(lines) + " lines")
+                return lines > 0
+            
+            if(not scan.StatusGet()): return True                               # Finished before we could tell. Restart so there's a scan to wait for
+        
+        return True
+    
     def rampBias(self,NTCP,bias,dbdt=1,db=50e-3,zhold=True):
         """
         This function ramps the tip/sample bias from the current value to a
@@ -2055,18 +2233,21 @@ class scanbot():
         if(zhold): zController.OnOffSet(False)                                  # Turn off the z-controller if we need to
         
         if(bias < currentBias): db = -db                                        # flip the sign of db if we're going down in bias
-        for b in np.arange(currentBias,bias,db):                                # Change the bias according to step size
+        start = time.time()
+        for i,b in enumerate(np.arange(currentBias,bias,db)):                   # Change the bias according to step size
             if(b and abs(b) <= 10): biasModule.Set(b)                           # Set the tip bias in nanonis. skip b == 0
-            time.sleep(sleepTime)                                               # sleep a bit
+            tracing.sleep(max(0,start + (i + 1)*sleepTime - time.time()))       # Keep to dbdt. Time spent talking to nanonis counts towards the step
         
         biasModule.Set(bias)                                                    # Set the final bias in case the step size doesn't get us there nicely
         
         if(zhold): zController.OnOffSet(True)                                   # Turn the controller back on if we need to
         
-    def makePNG(self,scanData,filePath='',pngFilename='im.png',returnData=False,fit=True,process=True,dpi=150):
+    @tracing.traced("render")
+    def makePNG(self,scanData,filePath='',pngFilename='im.png',returnData=False,fit=True,process=True,scale=1):
         """
         This function generates a .png file from scanData. It replaces nan's 
-        with the mean value of scanData.
+        with the mean value of scanData. The image is written at the native 
+        resolution of scanData (one pixel per data point).
 
         Parameters
         ----------
@@ -2074,8 +2255,9 @@ class scanbot():
         filePath    : Save the png here
         pngFilename : .png filename
         returnData  : True: return the processed scanData
-        fit         : Subtract a plane fit from scanData before generating the .png
-        dpi         : Image dpi
+        fit         : Flatten scanData (see self.flatten) before generating the .png
+        process     : False: render scanData as-is (RGB images or raw data)
+        scale       : Integer upscale factor
 
         Returns
         -------
@@ -2083,25 +2265,19 @@ class scanbot():
         scanData    : Processed input data. Only returned if returnData=True.
 
         """
-        fig, ax = plt.subplots(1,1)
-        
         if(process):
-            mask = np.isnan(scanData)                                               # Mask the Nan's
-            scanData[mask == True] = np.nanmean(scanData)                           # Replace the Nan's with the mean so it doesn't affect the plane fit
             scanData -= np.nanmean(scanData)
-            if(fit): scanData = napfit.plane_fit_2d(scanData)                       # Flatten the image
-            vmin, vmax = napfit.filter_sigma(scanData)                              # cmap saturation
-        
-            ax.imshow(scanData, cmap='inferno', vmin=vmin, vmax=vmax)               # Plot
+            if(fit): scanData = napfit.flatten(scanData, self.flatten)          # Flatten the image. Nan's are ignored by the fit
+            mask = np.isnan(scanData)                                           # Mask the Nan's
+            scanData[mask == True] = np.nanmean(scanData)                       # Replace the Nan's with the mean so they don't affect the cmap saturation
+            vmin, vmax = napfit.filter_sigma(scanData)                          # cmap saturation
+            image = render.colourise(scanData, vmin=vmin, vmax=vmax, cmap='inferno')
         else:
-            ax.imshow(scanData)                                                     # Plot without processing
-
-        ax.axis('off')
+            image = render.colourise(scanData, cmap='viridis')                  # Render without processing
         
         if filePath: pngFilename = ntpath.split(filePath)[1] + '.png'
         
-        fig.savefig(self.interface.module_dir + pngFilename, dpi=dpi, bbox_inches='tight', pad_inches=0)
-        plt.close(fig)
+        render.writeImage(self.interface.module_dir + pngFilename, image, scale=scale)
         
         if(returnData): return pngFilename,scanData
         return pngFilename
@@ -2165,7 +2341,7 @@ class scanbot():
             self.interface.reactToMessage("pause")
             
             while global_.pause.is_set():
-                time.sleep(2)                                                   # Sleep for a bit
+                tracing.sleep(2)                                                # Sleep for a bit
                 if(not global_.running.is_set()):
                     self.interface.reactToMessage("stop_button")
                     self.disconnect(NTCP)
@@ -2248,7 +2424,10 @@ class scanbot():
 ###############################################################################
     def connect(self,creepIP=None,creepPORT=None):
         """
-        This function creats a nanonisTCP connection and returns the handle
+        This function leases a nanonisTCP connection from the connection pool
+        and returns the handle. Sessions stay open between calls so there is no
+        handshake or forced sleep when a port is reused. Calling connect from a
+        thread that already holds a connection returns the same handle.
 
         Parameters
         ----------
@@ -2261,26 +2440,25 @@ class scanbot():
                      [1] Error message if there was an error. 0 if not
 
         """
-        IP   = creepIP
-        PORT = creepPORT
-        try:                                                                    # Try to connect to nanonis via TCP
-            if(not IP):   IP   = self.interface.IP
-            if(not PORT): PORT = self.interface.portList.pop()
-            NTCP = nanonisTCP(IP, PORT)
-            return [NTCP,0]
-        except Exception as e:
-            if(len(self.interface.portList)): return [0,str(e)]                 # If there are ports available then return the exception message
-            return [0,"No ports available"]                                     # If no ports are available send this message
+        if(creepIP or creepPORT):                                               # Creep connections bypass the pool
+            try:
+                IP   = creepIP   or self.interface.IP
+                PORT = creepPORT or self.interface.portList[-1]
+                return [nanonisTCP(IP, PORT),0]
+            except Exception as e:
+                return [0,str(e)]
+        
+        return self.pool.acquire(self.interface.IP,self.interface.portList)     # Lease a session from the pool
     
-    def disconnect(self,NTCP):
+    def disconnect(self,NTCP,broken=False):
         """
-        Release the nanonisTCP connection and free up the port
+        Release the nanonisTCP connection back to the pool. The TCP connection
+        is kept open for the next call.
 
         Parameters
         ----------
-        NTCP : Connection handle
+        NTCP   : Connection handle
+        broken : Flag the connection as unusable so it is reopened next time
 
         """
-        NTCP.close_connection()                                                 # Close the TCP connection
-        self.interface.portList.append(NTCP.PORT)                               # Free up the port - put it back in the list of available ports
-        time.sleep(0.2)                                                         # Give nanonis a bit of time to close the connection before attempting to reconnect using the same port (from experience)
\ No newline at end of file
+        self.pool.release(NTCP,broken=broken)                                   # Free up the port - put the session back in the pool
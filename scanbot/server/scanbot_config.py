@@ -1,4 +1,7 @@
 from collections import OrderedDict
+import ipaddress
+import threading
+import os
 
 class scanbot_config():
     label       = 0
@@ -33,23 +36,227 @@ class scanbot_config():
                         # 'hk_commands'               : ['0']                         # Flag to look for customised commands in hk_commands
                       })
         
-        try:
-            with open(module_dir + 'scanbot_config.ini','r') as f:                  # Go through the config file to see what defaults need to be overwritten
-                line = "begin"
-                while(line):
-                    line = f.readline()[:-1]
-                    if(line.startswith('#')): print(line); continue                 # Comment
-                    if(not '=' in line):
-                        print("WARNING: invalid line in config file: " + line)
-                        continue
-                    key, value = line.split('=')                                    # Format for valid line is "Key=Value"
-                    if(not key in self.config):                                     # Key must be one of config keys
-                        print("WARNING: Invalid key in scanbot_config.ini: " + key)
-                        continue
-                    self.config[key][self.value] = value                            # Overwrite value
-        except Exception as e:
-            print(e)
+        values = readConfig(module_dir + 'scanbot_config.ini')                  # Go through the config file to see what defaults need to be overwritten
+        if(values is None):
             print("Config file not found, using defaults...")
+            values = {}
+        for key,value in values.items():
+            if(not key in self.config):                                         # Key must be one of config keys
+                print("WARNING: Invalid key in scanbot_config.ini: " + key)
+                continue
+            self.config[key][self.value] = value                                # Overwrite value
     
     def setConfig(self,config):
-        self.config = config
\ No newline at end of file
+        self.config = config
+def readConfig(filename):
+    """
+    Read a scanbot_config.ini file. File format is:
+        # comment
+        key1=value1
+        key2=value2
+
+    Returns
+    -------
+    values : {key: value} as strings, in the order they appear. None if the
+             file can't be read
+
+    """
+    try:
+        with open(filename,'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    
+    values = OrderedDict()
+    for line in lines:
+        if(not line.strip()): continue
+        if(line.startswith('#')): print(line); continue                         # Comment
+        if(not '=' in line):
+            print("WARNING: invalid line in config file: " + line)
+            continue
+        key, value = line.split('=',1)                                          # Format for valid line is "Key=Value"
+        values[key] = value
+    return values
+
+###############################################################################
+# Config service
+###############################################################################
+def toPorts(value):
+    ports = [int(port) for port in value.replace(',',' ').split()]
+    if(not ports): raise ValueError("no ports")
+    return ports
+
+def toIP(value):
+    ipaddress.ip_address(value)
+    return value
+
+def toList(value):
+    return value.split(',') if value else []
+
+class config_service():
+    """
+    Scanbot's settings, parsed and validated once and kept in memory. The
+    file is watched and changes are applied in place through the onChange
+    callback, so editing scanbot_config.ini (or saving it from the app)
+    doesn't restart anything. Running jobs carry on with the new values.
+
+    A config file with an invalid value is rejected as a whole and the
+    previous values are kept. So are the values of a file that onChange
+    couldn't apply, so it's tried again on the next reload.
+
+    """
+    validUploadMethods = ['path','zulip','firebase','no_upload']
+    interval = 1                                                                # Time between checks for changes to the file (s)
+    settings = OrderedDict(
+               # key                       : [default value,         type]
+               { 'zuliprc'                 : ['',                    str],      # Zulip rc file. See https://zulip.com/api/running-bots
+                 'zulip_stream'            : ['scanbot',             str],      # Default stream to send messages to
+                 'zulip_topic'             : ['live-stream',         str],      # Default topic to send messages to
+                 'upload_method'           : ['no_upload',           str],      # Ping data via this channel.
+                 'path'                    : ['sbData',              str],      # Path to save data (if upload_method=path)
+                 'firebase_credentials'    : ['',                    str],      # Credentials for firebase (if upload_method=firebase)
+                 'firebase_storage_bucket' : ['',                    str],      # Firebase bucket. Firebase path uses "path" key
+                 'port_list'               : ['6501,6502,6503,6504', toPorts],  # Ports (see nanonis => Main Options => TCP Programming Interface)
+                 'ip'                      : ['127.0.0.1',           toIP],     # IP of the pc controlling nanonis
+                 'creeplist'               : ['',                    str],      # IP addresses to creep
+                 'notify_list'             : ['',                    toList],   # Comma delimited zulip users to @notify when sending data
+                 'temp_calibration_curve'  : ['',                    str],      # Path to temp calibration curve (see nanonis Temperature modules)
+                 'topo_basename'           : ['',                    str],      # basename for topographic images
+                 'scp_path'                : ['',                    str],      # user@clouddatabase:path
+                 'safe_current'            : ['5e-9',                float],    # When the current goes above this threhold the tip is considered crashed. Used when controlling the course piezos
+                 'safe_retract_V'          : ['200',                 float],    # Voltage applied to the 'Z' piezo when retracting tip in case of crash
+                 'safe_retract_F'          : ['1500',                float],    # Frequency applied to the 'Z' piezo when retracting tip in case of crash
+                 'piezo_z_max_V'           : ['200',                 float],    # Maximum voltage that can be applied to the Z piezo
+                 'piezo_z_min_V'           : ['0',                   float],    # Minimum voltage that can be applied to the Z piezo
+                 'piezo_xy_max_V'          : ['130',                 float],    # Maximum voltage that can be applied to the X or Y piezos
+                 'piezo_xy_min_V'          : ['0',                   float],    # Minimum voltage that can be applied to the X or Y piezos
+                 'piezo_z_max_F'           : ['5000',                float],    # Maximum frequency that can be applied to the Z piezo
+                 'piezo_z_min_F'           : ['500',                 float],    # Minimum frequency that can be applied to the Z piezo
+                 'piezo_xy_max_F'          : ['5000',                float],    # Maximum frequency that can be applied to the X or Y piezos
+                 'piezo_xy_min_F'          : ['500',                 float],    # Minimum frequency that can be applied to the X or Y piezos
+                 'hk_commands'             : ['0',                   int]})     # Flag to look for customised commands in hk_commands
+    
+    def __init__(self,module_dir="./",onChange=None):
+        """
+        Parameters
+        ----------
+        module_dir : Directory scanbot_config.ini is in
+        onChange   : Callable onChange(changed) that applies the settings
+                     whose keys are in the list changed. Read the new values
+                     from this service. Raise if they couldn't be applied
+
+        """
+        self.filename = module_dir + 'scanbot_config.ini'
+        self.onChange = onChange
+        self.values   = {}                                                      # key: parsed value
+        self.mtime    = None                                                    # Modification time of the file when it was last read. None if it wasn't there
+        self.lock     = threading.RLock()
+        self.closed   = threading.Event()
+        self.thread   = None
+    
+    def __getitem__(self,key):
+        return self.values[key]
+    
+    def parse(self,values):
+        """
+        Convert and check the values read from the file. Settings missing
+        from the file take their default value.
+
+        Returns
+        -------
+        parsed : {key: value} for every setting. None if there was an error
+        error  : Error message. "" if there wasn't an error
+
+        """
+        for key in values:
+            if(not key in self.settings):
+                print("WARNING: Invalid key in scanbot_config.ini: " + key)
+        
+        parsed = {}
+        for key,(default,convert) in self.settings.items():
+            value = values.get(key,default)
+            try:
+                parsed[key] = convert(value)
+            except Exception as e:
+                return None,"Invalid " + key + " '" + value + "': " + str(e)
+        
+        method = parsed['upload_method']
+        if(not method in self.validUploadMethods):
+            return None,"Invalid upload_method '" + method + "'. Must be one of " + ", ".join(self.validUploadMethods)
+        if(method == 'zulip' and not parsed['zuliprc']):
+            return None,"zuliprc required for upload_method=zulip"
+        if(method in ['path','firebase'] and not parsed['path']):
+            return None,"Invalid path for upload_method=" + method
+        if(method == 'firebase' and not parsed['firebase_storage_bucket']):
+            return None,"Storage bucket must be provided for upload_method=firebase"
+        if(method in ['path','firebase'] and not parsed['path'].endswith('/')):
+            parsed['path'] += '/'
+        
+        return parsed,""
+    
+    def modified(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+    
+    def reload(self,force=False):
+        """
+        Read the file and apply any settings that changed.
+
+        Parameters
+        ----------
+        force : Read the file even if it hasn't been modified since last time
+
+        Returns
+        -------
+        changed : Keys of the settings that changed
+        error   : Error message if the file was rejected. "" if not
+
+        """
+        with self.lock:
+            mtime = self.modified()
+            if(self.values and mtime == self.mtime and not force): return [],""
+            
+            values = readConfig(self.filename)
+            if(values is None):
+                print("Config file not found, using defaults...")
+                values = {}
+            
+            parsed,error = self.parse(values)
+            self.mtime = mtime                                                  # Don't try a rejected file again until it's edited
+            if(error): return [],error
+            
+            changed = [key for key in parsed if not key in self.values or self.values[key] != parsed[key]]
+            previous,self.values = self.values,parsed
+            if(changed and self.onChange):
+                try:
+                    self.onChange(changed)
+                except Exception as e:
+                    self.values = previous                                      # Not applied. A forced reload tries every changed setting again
+                    return [],"Could not apply settings: " + str(e)
+            return changed,""
+    
+    def watch(self):
+        """
+        Start checking the file for changes in the background.
+
+        """
+        if(self.thread): return self
+        self.thread = threading.Thread(target=self.watcher,name="scanbot-config",daemon=True)
+        self.thread.start()
+        return self
+    
+    def watcher(self):
+        while(not self.closed.wait(self.interval)):
+            if(self.modified() == self.mtime): continue
+            try:
+                changed,error = self.reload()
+                if(error): print("WARNING: scanbot_config.ini not applied. " + error)
+                elif(changed): print("Applied changes to scanbot_config.ini: " + ", ".join(changed))
+            except Exception as e:
+                print("WARNING: scanbot_config.ini not applied. " + str(e))
+    
+    def close(self):
+        self.closed.set()
+        if(self.thread and self.thread is not threading.current_thread()): self.thread.join(2)
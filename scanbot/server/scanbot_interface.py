@@ -7,15 +7,21 @@ Created on Fri August 8 22:06:37 2022
 
 from scanbot.server.scanbot import scanbot
 from scanbot.server import global_
+from scanbot.server import nanonispyfit as napfit
+from scanbot.server.scheduler import job_scheduler
+from scanbot.server.scanbot_config import config_service, readConfig
+from scanbot.server.image_feed import image_feed
+from scanbot.server.uploader import upload_service
+from scanbot.server import tracing
+from scanbot.server import lazy
 
-import zulip
+zulip = lazy.lazy_module('zulip')                                               # Only needed for upload_method=zulip and zulip mode
 
 import os
 import sys
 import subprocess
 from pathlib import Path
 import shutil
-import time
 
 import ipaddress
 
@@ -24,7 +30,7 @@ import threading
 class scanbot_interface(object):
     bot_message = []
     bot_handler = []
-    validUploadMethods = ['path','zulip','firebase','no_upload']
+    validUploadMethods = config_service.validUploadMethods
     
 ###############################################################################
 # Constructor
@@ -37,6 +43,10 @@ class scanbot_interface(object):
         self.loadConfig()
         self.initGlobals()
         self.initCommandDict()
+        self.scheduler  = job_scheduler(self.launchJob,path=self.module_dir + 'scanbot_jobs.json')
+        self.imageFeed  = getattr(self,'imageFeed',None) or image_feed()        # Survives restart so connected clients keep their stream
+        self.animationPath = getattr(self,'animationPath',"")                   # Latest bias dep/zdep animation
+        self.uploader   = upload_service(self.module_dir + 'upload_spool/',self.uploadBatch,onFailure=self.uploadFailed)
     
 ###############################################################################
 # Initialisation
@@ -46,136 +56,115 @@ class scanbot_interface(object):
         Read in the scanbot_config.ini configuration file. File format is:
             key1=value1
             key2=value2
+        
+        The file is then watched and any settings that change are applied in
+        place (see applyConfig).
 
         """
         print("Loading scanbot_config.ini...")
-        initDict = {'zuliprc'                   : '',                           # Zulip rc file. See https://zulip.com/api/running-bots
-                    'zulip_stream'              : 'scanbot',                    # Default stream to send messages to
-                    'zulip_topic'               : 'live-stream',                # Default topic to send messages to
-                    'upload_method'             : 'no_upload',                  # Ping data via this channel.
-                    'path'                      : 'sbData',                     # Path to save data (if upload_method=path)
-                    'firebase_credentials'      : '',                           # Credentials for firebase (if upload_method=firebase)
-                    'firebase_storage_bucket'   : '',                           # Firebase bucket. Firebase path uses "path" key
-                    'port_list'                 : '6501,6502,6503,6504',        # Ports (see nanonis => Main Options => TCP Programming Interface)
-                    'ip'                        : '127.0.0.1',                  # IP of the pc controlling nanonis
-                    'creeplist'                 : '',                           # IP addresses to creep
-                    'notify_list'               : '',                           # Comma delimited zulip users to @notify when sending data
-                    'temp_calibration_curve'    : '',                           # Path to temp calibration curve (see nanonis Temperature modules)
-                    'topo_basename'             : '',                           # basename for topographic images
-                    'scp_path'                  : '',                           # user@clouddatabase:path
-                    'safe_current'              : '5e-9',                       # When the current goes above this threhold the tip is considered crashed. Used when controlling the course piezos
-                    'safe_retract_V'            : '200',                        # Voltage applied to the 'Z' piezo when retracting tip in case of crash
-                    'safe_retract_F'            : '1500',                       # Frequency applied to the 'Z' piezo when retracting tip in case of crash
-                    'piezo_z_max_V'             : '200',                        # Maximum voltage that can be applied to the Z piezo
-                    'piezo_z_min_V'             : '0',                          # Minimum voltage that can be applied to the Z piezo
-                    'piezo_xy_max_V'            : '130',                        # Maximum voltage that can be applied to the X or Y piezos
-                    'piezo_xy_min_V'            : '0',                          # Minimum voltage that can be applied to the X or Y piezos
-                    'piezo_z_max_F'             : '5000',                       # Maximum frequency that can be applied to the Z piezo
-                    'piezo_z_min_F'             : '500',                        # Minimum frequency that can be applied to the Z piezo
-                    'piezo_xy_max_F'            : '5000',                       # Maximum frequency that can be applied to the X or Y piezos
-                    'piezo_xy_min_F'            : '500',                        # Minimum frequency that can be applied to the X or Y piezos
-                    'hk_commands'               : '0'}                          # Flag to look for customised commands in hk_commands
-        
-        try:
-            with open(self.module_dir + 'scanbot_config.ini','r') as f:         # Go through the config file to see what defaults need to be overwritten
-                line = "begin"
-                while(line):
-                    line = f.readline()[:-1]
-                    if(line.startswith('#')): print(line); continue             # Comment
-                    if(not '=' in line):
-                        print("WARNING: invalid line in config file: " + line)
-                        continue
-                    key, value = line.split('=')                                # Format for valid line is "Key=Value"
-                    if(not key in initDict):                                    # Key must be one of initDict keys
-                        print("WARNING: Invalid key in scanbot_config.ini: " + key)
-                        continue
-                    initDict[key] = value                                       # Overwrite value
-        except:
-            print("Config file not found, using defaults...")
-        
-        self.zuliprc      = initDict['zuliprc']
-        self.zulipStream  = initDict['zulip_stream']
-        self.zulipTopic   = initDict['zulip_topic']
-        
-        self.path         = initDict['path']
-        
-        self.uploadMethod = initDict['upload_method']
-        
-        if(self.uploadMethod == 'zulip'):
-            if(not self.zuliprc):
-                raise Exception("Check config file. zuliprc require for upload_method=zulip")
-        
-        if(self.uploadMethod in ['path','firebase']):
-            if(not self.path):
-                raise Exception("Check config file. Invalid path for upload_method=" + self.uploadMethod)
-        
-        if(self.uploadMethod not in self.validUploadMethods):
-            raise Exception("Check config file. Invalid upload_method.\nMust be one of path, zulip, firebase")
-            
-        if(self.uploadMethod == 'path'):
-            Path(self.path).mkdir(parents=True, exist_ok=True)
-            if(not self.path.endswith('/')):
-                self.path += '/'
-        
-        self.firebaseCert = initDict['firebase_credentials']
-        self.firebaseStorageBucket = initDict['firebase_storage_bucket']
-        
-        if(self.uploadMethod == 'firebase'):
-            if(not self.firebaseStorageBucket):
-                raise Exception("Storage bucket must be provided for upload_method=firebase")
-            if(not self.path):
-                raise Exception("Storage path must be provided for upload_method=firebase")
-            if(not self.path.endswith('/')):
-                self.path += '/'
-            self.firebaseInit()
-        
-        if(self.setPortList(initDict['port_list'].replace(',',' ').split(' '))):
-            raise Exception("Check port_list in config file. Must be space or comma delimited.")
-            
-        if(self.setIP([initDict['ip']])):
-            raise Exception("Check config file... Invalid IP.")
-        
-        self.notifyUserList = []
-        if(initDict['notify_list']):
-            self.notifyUserList = initDict['notify_list'].split(',')
-        
         self.bot_message = []
         self.zulipClient = []
-        if(self.zuliprc):
-            self.zulipClient = zulip.Client(config_file=self.zuliprc)
-        
-        self.tempCurve = initDict['temp_calibration_curve']
-        
-        self.topoBasename = initDict['topo_basename']
-        
-        self.cloudPath = initDict['scp_path']
-        
-        self.scanbot.safeCurrent  = float(initDict['safe_current'])
-        self.scanbot.safeRetractV = float(initDict['safe_retract_V'])
-        self.scanbot.safeRetractF = float(initDict['safe_retract_F'])
-        
-        self.scanbot.zMaxV  = float(initDict['piezo_z_max_V'])
-        self.scanbot.zMinV  = float(initDict['piezo_z_min_V'])
-        self.scanbot.xyMaxV = float(initDict['piezo_xy_max_V'])
-        self.scanbot.xyMinV = float(initDict['piezo_xy_min_V'])
-        
-        self.scanbot.zMaxF  = float(initDict['piezo_z_max_F'])
-        self.scanbot.zMinF  = float(initDict['piezo_z_min_F'])
-        self.scanbot.xyMaxF = float(initDict['piezo_xy_max_F'])
-        self.scanbot.xyMinF = float(initDict['piezo_xy_min_F'])
-        
         self.hk_commands = []
-        if(int(initDict['hk_commands'])):
-           from hk_commands import hk_commands
-           self.hk_commands = hk_commands(self)
+        self.config = config_service(self.module_dir,onChange=self.applyConfig)
+        changed,error = self.config.reload()
+        if(error): raise Exception("Check config file. " + error)
+        self.config.watch()
         
         self.loadWhitelist()
+    
+    def applyConfig(self,changed):
+        """
+        Apply settings from the config service. Only the settings that
+        changed are touched (a port list set with set_portlist survives an
+        edit to the crash current), and nothing is restarted, so this is safe
+        to call while jobs are running: they pick up the new values the next
+        time they're read.
+
+        Parameters
+        ----------
+        changed : Keys of the settings that changed
+
+        Raises an exception listing the settings that couldn't be applied
+        once every step has been tried, so the config service keeps the
+        previous values and tries again on the next reload.
+
+        """
+        config = self.config
+        attributes = {'zuliprc'                 : [self,'zuliprc'],
+                      'zulip_stream'            : [self,'zulipStream'],
+                      'zulip_topic'             : [self,'zulipTopic'],
+                      'upload_method'           : [self,'uploadMethod'],
+                      'path'                    : [self,'path'],
+                      'firebase_credentials'    : [self,'firebaseCert'],
+                      'firebase_storage_bucket' : [self,'firebaseStorageBucket'],
+                      'port_list'               : [self,'portList'],            # The connection pool picks up the new ports/IP on its next lease
+                      'ip'                      : [self,'IP'],                  # Sessions in use are left alone until they're released
+                      'notify_list'             : [self,'notifyUserList'],
+                      'temp_calibration_curve'  : [self,'tempCurve'],
+                      'topo_basename'           : [self,'topoBasename'],
+                      'scp_path'                : [self,'cloudPath'],
+                      'safe_current'            : [self.scanbot,'safeCurrent'],
+                      'safe_retract_V'          : [self.scanbot,'safeRetractV'],
+                      'safe_retract_F'          : [self.scanbot,'safeRetractF'],
+                      'piezo_z_max_V'           : [self.scanbot,'zMaxV'],
+                      'piezo_z_min_V'           : [self.scanbot,'zMinV'],
+                      'piezo_xy_max_V'          : [self.scanbot,'xyMaxV'],
+                      'piezo_xy_min_V'          : [self.scanbot,'xyMinV'],
+                      'piezo_z_max_F'           : [self.scanbot,'zMaxF'],
+                      'piezo_z_min_F'           : [self.scanbot,'zMinF'],
+                      'piezo_xy_max_F'          : [self.scanbot,'xyMaxF'],
+                      'piezo_xy_min_F'          : [self.scanbot,'xyMinF']}
+        
+        for key in changed:
+            if(key in attributes): setattr(*attributes[key],config[key])
+        
+        if(self.uploadMethod == 'path' and set(changed) & {'upload_method','path'}):
+            Path(self.path).mkdir(parents=True, exist_ok=True)
+        
+        if(self.uploadMethod == 'firebase' and set(changed) & {'upload_method','firebase_credentials','firebase_storage_bucket'}):
+            self.firebaseInit()
+        
+        errors = []
+        if('zuliprc' in changed):
+            try:
+                self.zulipClient = []
+                if(self.zuliprc):
+                    self.zulipClient = zulip.Client(config_file=self.zuliprc)
+            except Exception as e:
+                errors.append("zuliprc: " + str(e))
         
+        if('hk_commands' in changed):
+            try:
+                self.hk_commands = []
+                if(config['hk_commands']):
+                   from hk_commands import hk_commands
+                   self.hk_commands = hk_commands(self)
+            except Exception as e:
+                errors.append("hk_commands: " + str(e))
+        
+        if(errors): raise Exception(". ".join(errors))
+    
+    def reloadConfig(self):
+        """
+        Re-read scanbot_config.ini now instead of waiting for the watcher to
+        notice it changed.
+
+        Returns
+        -------
+        error : Error message if the file was rejected. "" if not
+
+        """
+        changed,error = self.config.reload(force=True)
+        if(error): return "Config not applied. " + error
+        return ""
+    
     def firebaseInit(self):
         try:
             import firebase_admin
             from firebase_admin import credentials
             print("Initialising firebase app")
+            if(firebase_admin._apps):                                           # Settings changed. Replace the app set up with the old ones
+                firebase_admin.delete_app(firebase_admin.get_app())
             cred = credentials.Certificate(self.firebaseCert)                   # Your firebase credentials
             firebase_admin.initialize_app(cred, {
                 'storageBucket': self.firebaseStorageBucket                     # Your firebase storage bucket
@@ -207,13 +196,20 @@ class scanbot_interface(object):
                          'get_ip'           : lambda args: self.IP,             # Return the IP scanbot is configured to talk to
                          'set_portlist'     : self.setPortList,                 # Configure which ports scanbot can use when talking to Nanonis
                          'get_portlist'     : lambda args: self.portList,       # Return the list of ports scanbot is configured to use
+                         'get_connections'  : self.getConnections,              # Return connection pool metrics for the nanonis TCP sessions
                          'set_upload_method': self.setUploadMethod,             # Set which upload method to use when uploading pngs
                          'get_upload_method': lambda args: self.uploadMethod,   # View the upload method
+                         'get_uploads'      : self.getUploads,                  # Return the number of files waiting to be uploaded
+                         'get_trace'        : self.getTrace,                    # Break down where a job's time went. Optionally export a Chrome trace
+                         'reload_config'    : lambda args: self.reloadConfig() or "Config reloaded", # Apply changes to scanbot_config.ini now. Nothing is restarted
+                         'import_profile'   : lambda args: lazy.report(),       # How long startup took and which modules have been imported on first use
                          'add_user'         : self.addUser,                     # Add a user to the whitelist (by email - zulip only)
                          'get_users'        : lambda args: str(self.whitelist), # Get the list of users allowed to talk to scanbot (zulip only)
                          'set_path'         : self.setPath,                     # Changes the directory pngs are saved in. Creates the directory if it doesn't exist.
                          'get_path'         : lambda args: self.path,           # Path to save scan pngs (saves the channel of focus which can be set using plot_channel)
                          'plot_channel'     : self.plotChannel,                 # Read/select the current channel of focus
+                         'set_flatten'      : self.setFlatten,                  # Set the background subtraction applied to pngs (plane, line, parabolic, column, none)
+                         'get_flatten'      : lambda args: self.scanbot.flatten, # Return the background subtraction applied to pngs
                          'set_crash_safety' : self.setCrashSafety,              # Set the safety current, 'Z' piezo voltage, and 'Z' piezo retract frequency
                          'get_crash_safety' : self.getCrashSafety,              # Return the safe retract settings
                         # Data Acquisition
@@ -233,6 +229,14 @@ class scanbot_interface(object):
                          'move_tip_to_clean': self.moveTipToClean,              # Automatically move the tip from its current location to the clean metal target location.
                          'auto_tip_shape'   : self.autoTipShape,                # Routine that automatically prepares a nice tip. Assumes the substrate is a clean metal. Ag111 works best.
                         # Misc
+                        # Jobs
+                         'queue'            : self.queueJob,                    # Queue a command to run when the instrument is free. e.g. queue -p=1 survey -n=3
+                         'get_jobs'         : self.getJobs,                     # List queued, running and recent jobs
+                         'cancel_job'       : self.cancelJob,                   # Cancel a job by id. 'all' clears the queue
+                         'pause_job'        : self.pauseJob,                    # Pause the running job or hold a queued one
+                         'resume_job'       : self.resumeJob,                   # Resume a paused or held job
+                         'pause_queue'      : self.pauseQueue,                  # Stop queued jobs from starting
+                         'resume_queue'     : self.resumeQueue,                 # Let queued jobs start again
                          'stop'             : self.stop,                        # Interrupt whatever scanbot is doing. Also stops the current scan.
                          'quit'             : self._quit                        # Quits scanbot
         }
@@ -263,7 +267,8 @@ class scanbot_interface(object):
                     '-stitch':['0',        lambda x: float(x), "(int) Return the stitched survey after completion. 1: Yes, else No"],
                     '-hk_survey': ['0',    lambda x: int(x),   "(int) Flag to call a custom python script after each image. Script must be ~/scanbot/scanbot/hk_survey.py. 0=Don't call, 1=Call"],
                     '-hk_classifier': ['0',lambda x: int(x),   "(int) Flag to call a custom classifier after each image. Script must be ~/scanbot/scanbot/hk_classifier.py. Only called if -autotip=1. 0=Don't call, 1=Call"],
-                    '-autotip': ['0',      lambda x: int(x),   "(int) Automatic tip shaping. 0=off, 1=on"]}
+                    '-autotip': ['0',      lambda x: int(x),   "(int) Automatic tip shaping. 0=off, 1=on"],
+                    '-pipeline':['0',      lambda x: int(x),   "(int) Start the next scan while the previous frame is rendered and uploaded in the background. 0=off, 1=on"]}
         
         if(_help): return arg_dict
         
@@ -275,7 +280,7 @@ class scanbot_interface(object):
             args = self.unpackArgs(user_arg_dict)
         
         func = lambda : self.scanbot.survey(*args,message=self.bot_message.copy())
-        return self.threadTask(func)
+        return self.threadTask(func,command="survey",user_args=user_args)
     
     def survey2(self,user_args,_help=False,survey2Params=[]):
         arg_dict = {'-bias' : ['-default', lambda x: float(x), "(float) Scan bias"],
@@ -300,6 +305,7 @@ class scanbot_interface(object):
                     '-zV'    : ['180',     lambda x: float(x), "(float) Piezo voltage when moving motor steps in z direction"],
                     '-xyF'   : ['1100',    lambda x: float(x), "(float) Piezo frequency when moving motor steps in xy direction"],
                     '-zF'    : ['1100',    lambda x: float(x), "(float) Piezo frequency when moving motor steps in z direction"],
+                    '-pipeline':['0',      lambda x: int(x),   "(int) Start the next scan while the previous frame is rendered and uploaded in the background. 0=off, 1=on"],
                     }
         
         if(_help): return arg_dict
@@ -315,7 +321,7 @@ class scanbot_interface(object):
                 args[5] *= 1e-9
         
         func = lambda : self.scanbot.survey2(*args,message=self.bot_message.copy())
-        return self.threadTask(func)
+        return self.threadTask(func,command="survey2",user_args=user_args)
     
     def biasDep(self,user_args,_help=False):
         arg_dict = {'-n'   : ['5',          lambda x: int(x),   "(int) Number of images to take b/w initial and final bias"],
@@ -330,7 +336,8 @@ class scanbot_interface(object):
                     '-lx'  : ['0',          lambda x: int(x),   "(int) Number of lines in images. 0=same as px"],
                     '-tlf' : ['-default',   lambda x: float(x), "(float) Time per line (forward direction) (s)"],
                     '-tb'  : ['1',          lambda x: float(x), "(float) Backward direction speed multiplier. E.g. 1=same speed, 2=twice as fast, 0.5=half speed"],
-                    '-s'   : ['sb-biasdep', lambda x: str(x),   "(str) Suffix for the set of bias dep sxm files"]}
+                    '-s'   : ['sb-biasdep', lambda x: str(x),   "(str) Suffix for the set of bias dep sxm files"],
+                    '-gif' : ['1',          lambda x: int(x),   "(int) Turn scans into an animation as they're acquired. 0=No, 1=GIF, 2=MP4, 3=WebM"]}
         
         if(_help): return arg_dict
         
@@ -340,7 +347,7 @@ class scanbot_interface(object):
         args = self.unpackArgs(user_arg_dict)
         
         func = lambda : self.scanbot.biasDep(*args,message=self.bot_message.copy())
-        return self.threadTask(func)
+        return self.threadTask(func,command="bias_dep",user_args=user_args)
         
     def zdep(self,user_args,_help=False):
         arg_dict = {'-zi'       : ['-10e-12',  lambda x: float(x), "(float) Initial tip lift from setpoint (m)"],
@@ -359,7 +366,7 @@ class scanbot_interface(object):
                     '-lx'       : ['0',        lambda x: int(x),   "(int) Number of lines for constant height image. 0=same as -px"],
                     '-dclx'     : ['0',        lambda x: int(x),   "(int) Number of lines for drift correction image. 0=same as -dcpx"],
                     '-s'        : ['sb-zdep',  lambda x: str(x),   "(str) Suffix at the end of autosaved sxm files"],
-                    '-gif'      : ['1',        lambda x: int(x),   "(int) Turn scans into a gif after completion. 0=No,1=Yes"]}
+                    '-gif'      : ['1',        lambda x: int(x),   "(int) Turn scans into an animation as they're acquired. 0=No, 1=GIF, 2=MP4, 3=WebM"]}
         
         if(_help): return arg_dict
         
@@ -369,7 +376,7 @@ class scanbot_interface(object):
         args = self.unpackArgs(user_arg_dict)
         
         func = lambda : self.scanbot.zdep(*args,message=self.bot_message.copy())
-        return self.threadTask(func)
+        return self.threadTask(func,command="zdep",user_args=user_args)
     
     def registration(self,user_args,_help=False):
         arg_dict = {'-zset'     : ['0',        lambda x: float(x), "(float) Initial tip lift from setpoint (m)"],
@@ -393,7 +400,7 @@ class scanbot_interface(object):
         args = self.unpackArgs(user_arg_dict)
         
         func = lambda : self.scanbot.registration(*args,message=self.bot_message.copy())
-        return self.threadTask(func)
+        return self.threadTask(func,command="afm_registration",user_args=user_args)
     
 ###############################################################################
 # Tip Actions
@@ -474,7 +481,7 @@ class scanbot_interface(object):
             return self.scanbot.autoInit(*args,message=self.bot_message.copy())
         
         func = lambda : self.scanbot.autoInit(*args,message=self.bot_message.copy())
-        return self.threadTask(func)
+        return self.threadTask(func,command="auto_init",user_args=user_args)
     
     def moveTipToSample(self,user_args,_help=False):
         return self.moveTipToTarget(user_args,_help=_help,target="sample")
@@ -507,7 +514,7 @@ class scanbot_interface(object):
         args = self.unpackArgs(user_arg_dict)
         
         func = lambda : self.scanbot.moveTipToTarget(*args,target=target)
-        return self.threadTask(func)
+        return self.threadTask(func,command="move_tip_to_" + target,user_args=user_args)
         
     def autoTipShape(self,user_args,_help=False):
         arg_dict = {'-n'    : ['10',        lambda x: int(x),   "(int) Max number of tip shapes to perform"],
@@ -533,7 +540,7 @@ class scanbot_interface(object):
             args[5] *= 1e-9
         
         func = lambda : self.scanbot.autoTipShape(*args,message=self.bot_message.copy())
-        return self.threadTask(func)
+        return self.threadTask(func,command="auto_tip_shape",user_args=user_args)
     
 ###############################################################################
 # Configuration
@@ -641,6 +648,21 @@ class scanbot_interface(object):
         args = self.unpackArgs(user_arg_dict)
         return self.scanbot.plotChannel(*args)
     
+    def setFlatten(self,flatten,_help=False):
+        arg_dict = {'' : ['plane', lambda x: str(x), "(string) Background subtraction applied to pngs. One of " + ', '.join(napfit.flatten_modes)]}
+        
+        if(_help): return arg_dict
+        
+        if(len(flatten) != 1): self.reactToMessage('cross_mark'); return
+        
+        flatten = flatten[0].lower()
+        if(not flatten in napfit.flatten_modes):
+            self.reactToMessage('cross_mark')
+            return "Invalid flattening. Available modes:\n" + "\n".join(napfit.flatten_modes)
+        
+        self.scanbot.flatten = flatten
+        self.reactToMessage('all_good')
+    
     def getStatus(self,user_args,_help=False):
         return ("Running flag: " + global_.running.is_set() + "\n" +
                 "Pause flag:   " + global_.pause.is_set())
@@ -670,6 +692,135 @@ class scanbot_interface(object):
         message += "Safe retract Frequency: " + str(self.scanbot.safeRetractF) + " Hz\n"
         return message
         
+###############################################################################
+# Jobs
+###############################################################################
+    queueable = ['survey','survey2','bias_dep','zdep','afm_registration',      # Commands that can be put on the job queue
+                 'move_tip_to_sample','move_tip_to_clean','auto_tip_shape']
+    
+    def queueJob(self,user_args,_help=False):
+        arg_dict = {'-p'    : ['0', lambda x: int(x), "(int) Priority. Higher priority jobs start first"],
+                    '-hold' : ['0', lambda x: int(x), "(int) Queue the job held so it doesn't start until resume_job is run. 1=Yes, 0=No"],
+                    ''      : ['',  0,                "(string) Command to queue followed by its arguments. One of " + ', '.join(self.queueable)]}
+        
+        if(_help): return arg_dict
+        
+        options = []
+        while(user_args and user_args[0].startswith('-')):                      # Queue options come before the command
+            options.append(user_args[0])
+            user_args = user_args[1:]
+        
+        if(not user_args): return "Missing command.\nRun ```help queue``` if you're unsure."
+        command,args = user_args[0].lower(),user_args[1:]
+        
+        error,user_arg_dict = self.userArgs({key: value for key,value in arg_dict.items() if key},options)
+        if(error): return error + "\nRun ```help queue``` if you're unsure."
+        
+        priority,hold = self.unpackArgs(user_arg_dict)
+        
+        error = self.validateJob(command,args)
+        if(error): return error
+        
+        jobID = self.scheduler.submit(command,args,priority=priority,hold=hold)
+        reply = "Queued job " + str(jobID) + ": " + " ".join(user_args) + (" (held)" if hold else "")
+        if(self.scheduler.paused): reply += "\nQueue is paused. Run resume_queue to start it."
+        return reply
+    
+    def validateJob(self,command,user_args):
+        """
+        Check a command can be queued and that its arguments are valid now 
+        rather than finding out when it starts.
+
+        Returns
+        -------
+        error : Error message. Empty string if the job is valid
+
+        """
+        if(not command in self.queueable):
+            return "Can't queue " + command + ". Commands that can be queued:\n" + "\n".join(self.queueable)
+        
+        arg_dict = self.commands[command](user_args,_help=True)
+        error,_  = self.userArgs(arg_dict,user_args)
+        if(error): return error + "\nRun ```help " + command + "``` if you're unsure."
+        return ""
+    
+    def getJobs(self,user_args=[],_help=False):
+        arg_dict = {'-all' : ['0', lambda x: int(x), "(int) Include finished jobs. 1=Yes, 0=No"]}
+        
+        if(_help): return arg_dict
+        
+        error,user_arg_dict = self.userArgs(arg_dict,user_args)
+        if(error): return error + "\nRun ```help get_jobs``` if you're unsure."
+        
+        showAll = self.unpackArgs(user_arg_dict)[0]
+        
+        jobs = self.scheduler.status()
+        if(not showAll): jobs = [job for job in jobs if job["status"] in ["queued","held","running","paused"]]
+        if(not jobs): return "No jobs"
+        
+        lines = []
+        for job in jobs:
+            line = str(job["id"]) + ": " + job["command"] + " " + " ".join(job["args"])
+            line += " [" + job["status"] + (", p=" + str(job["priority"]) if job["priority"] else "") + "]"
+            if(job["error"]): line += " " + job["error"]
+            lines.append(line)
+        if(self.scheduler.paused): lines.append("Queue paused. Run resume_queue to continue.")
+        return "\n".join(lines)
+    
+    def cancelJob(self,user_args,_help=False):
+        arg_dict = {'' : ['', 0, "(int) ID of the job to cancel. 'all' cancels every job that hasn't started"]}
+        
+        if(_help): return arg_dict
+        
+        if(len(user_args) != 1): self.reactToMessage('cross_mark'); return
+        
+        if(user_args[0].lower() == 'all'):
+            return "Cancelled " + str(self.scheduler.cancelQueue()) + " queued jobs"
+        
+        try:
+            jobID = int(user_args[0])
+        except:
+            self.reactToMessage('cross_mark')
+            return "Invalid job id: " + user_args[0]
+        
+        status = self.scheduler.cancel(jobID)
+        if(status is None): return "No job with id " + str(jobID)
+        if(status in ["running","paused"]): self.stopTask()                      # Stop the routine. The queue carries on
+        self.reactToMessage('all_good')
+    
+    def pauseJob(self,user_args,_help=False):
+        return self.jobAction(user_args,_help,self.scheduler.hold,"pause_job")
+    
+    def resumeJob(self,user_args,_help=False):
+        return self.jobAction(user_args,_help,self.scheduler.resume,"resume_job")
+    
+    def jobAction(self,user_args,_help,action,name):
+        arg_dict = {'' : ['', 0, "(int) ID of the job. Defaults to the current job"]}
+        
+        if(_help): return arg_dict
+        
+        jobID = self.scheduler.current
+        try:
+            if(user_args): jobID = int(user_args[0])
+        except:
+            self.reactToMessage('cross_mark')
+            return "Invalid job id: " + user_args[0]
+        
+        if(jobID is None or action(jobID) is None):
+            self.reactToMessage('cross_mark')
+            return "Can't " + name.replace('_',' ') + " " + str(jobID)
+        self.reactToMessage('all_good')
+    
+    def pauseQueue(self,user_args=[],_help=False):
+        if(_help): return {}
+        self.scheduler.pauseQueue(True)
+        self.reactToMessage('all_good')
+    
+    def resumeQueue(self,user_args=[],_help=False):
+        if(_help): return {}
+        self.scheduler.pauseQueue(False)
+        self.reactToMessage('all_good')
+        
 ###############################################################################
 # Comms
 ###############################################################################
@@ -774,58 +925,122 @@ class scanbot_interface(object):
             }
         self.zulipClient.add_reaction(react_request)                            # API call to react to the message
         
-    def sendPNG(self,pngFilename,notify=True,message=""):
-        notifyString = ""
-        if(notify):
-            for user in self.notifyUserList:
-                notifyString += "@**" + user + "** "
-            
+    def sendPNG(self,pngFilename,notify=True,message="",meta={}):
+        """
+        Send a png to the user via the configured upload method. The upload
+        happens in the background. In react mode the png is also published to
+        the image feed straight away.
+
+        Parameters
+        ----------
+        pngFilename : Filename of the png in module_dir
+        notify      : Notify the users in notifyUserList (zulip only)
+        message     : (Zulip use only)
+        meta        : Extra information published with the image
+
+        """
         # path = os.getcwd() + '/' + pngFilename
         path = self.module_dir + pngFilename
         
         if(self.run_mode == 'react'):
-            timestamp = time.time()
-            Path(self.module_dir + 'temp').mkdir(parents=True, exist_ok=True)
-            shutil.copy(path,self.module_dir + 'temp/' + str(timestamp) + '_' + pngFilename)
-        
-        if(self.uploadMethod == 'zulip'):
-            if(self.bot_handler):
-                upload = self.bot_handler.upload_file_from_path(str(path))
-                uploaded_file_reply = "[{}]({})".format(path.name, upload["uri"])
-                self.sendReply(notifyString + pngFilename,message)
-                self.sendReply(uploaded_file_reply,message)
-            else:
-                result = ""
-                with open(str(path), "rb") as fp:
-                    result = self.zulipClient.upload_file(fp)
-
-                if(result):
-                    self.zulipClient.send_message(
-                        {
-                            "type": "stream",
-                            "to": self.zulipStream,
-                            "topic": self.zulipTopic,
-                            "content": "[" + str(path) + "]({})".format(result["uri"]),
-                        }
-                    )
-            os.remove(path)
-            
-        if(self.uploadMethod == 'firebase'):
-            from firebase_admin import storage
-            bucket = storage.bucket()
-            blob   = bucket.blob(self.path + pngFilename)
-            blob.upload_from_filename(str(path))
-        
-            url = blob.generate_signed_url(expiration=9999999999)
-            self.sendReply(notifyString + "[" + pngFilename + "](" + url + ")",message)
-            os.remove(path)
-        
-        if(self.uploadMethod == 'path'):
-            os.replace(path, self.path + pngFilename)
-            self.sendReply(notifyString + self.path + pngFilename)
+            with open(path,'rb') as f:
+                self.imageFeed.publish(pngFilename,f.read(),meta)               # Pushed to the front-end as soon as it's published
         
         if(self.uploadMethod == "no_upload"):
             os.remove(path)
+            return
+        
+        self.uploader.enqueue(path,self.uploadMethod,destination=self.path,notify=notify,message=message) # Uploaded in the background so acquisition doesn't wait on the network
+    
+    def uploadBatch(self,method,destination,items):
+        """
+        Upload a batch of files. Called from the upload service's workers.
+        Files are uploaded one by one where the method requires it but the
+        user gets one message per batch.
+
+        Parameters
+        ----------
+        method      : zulip, firebase, path or scp
+        destination : Upload path, firebase storage prefix or scp target
+        items       : Upload items (see upload_service)
+
+        Returns
+        -------
+        failed : Items that didn't upload
+
+        """
+        if(method == 'scp'):
+            result = subprocess.run(["scp","-r"] + [item["file"] for item in items] + [destination],capture_output=True) # -r for scan archives
+            if(result.returncode):
+                raise Exception(result.stderr.decode(errors='replace').strip() or "scp exited with code " + str(result.returncode))
+            return []
+        
+        notifyString = ""
+        if(items[0]["notify"]):
+            for user in self.notifyUserList:
+                notifyString += "@**" + user + "** "
+        
+        message = items[0]["message"]
+        failed  = []
+        links   = []
+        for item in items:
+            try:
+                if(method == 'zulip'):
+                    if(self.bot_handler): result = self.bot_handler.upload_file_from_path(item["file"])
+                    else:
+                        with open(item["file"], "rb") as fp:
+                            result = self.zulipClient.upload_file(fp)
+                    if(not result or "uri" not in result):
+                        raise Exception(str(result.get("msg","Upload failed") if result else "Upload failed"))
+                    links.append("[" + item["filename"] + "](" + result["uri"] + ")")
+                
+                if(method == 'firebase'):
+                    from firebase_admin import storage
+                    blob = storage.bucket().blob(destination + item["filename"])
+                    blob.upload_from_filename(item["file"])
+                    url  = blob.generate_signed_url(expiration=9999999999)
+                    links.append("[" + item["filename"] + "](" + url + ")")
+                
+                if(method == 'path'):
+                    shutil.move(item["file"], destination + item["filename"])
+                    links.append(destination + item["filename"])
+                    
+            except Exception as e:
+                item["error"] = str(e)
+                failed.append(item)
+        
+        if(links):
+            reply = notifyString + "\n".join(links)
+            if(method == 'zulip' and not self.bot_handler):
+                self.zulipClient.send_message({"type": "stream", "to": self.zulipStream, "topic": self.zulipTopic, "content": reply})
+            elif(method == 'path'):
+                self.sendReply(reply)
+            else:
+                self.sendReply(reply,message)
+        
+        return failed
+    
+    def uploadFailed(self,item):
+        self.sendReply("Error uploading " + item["filename"] + " after " + str(item["attempts"]) + 
+                       " attempts: " + item["error"] + "\nThe file has been kept in " + self.module_dir + "upload_spool/failed/")
+    
+    def sendAnimation(self,path,message=""):
+        """
+        Make a finished animation available. In react mode the front-end
+        downloads it from /get_gif. Otherwise it's sent like a png.
+
+        Parameters
+        ----------
+        path    : Full path to the animation
+        message : (Zulip use only)
+
+        """
+        self.animationPath = path
+        if(self.run_mode == 'react'): return
+        
+        filename = os.path.basename(path)
+        shutil.copyfile(path, self.module_dir + filename)                       # sendPNG sends from module_dir and removes the file
+        self.sendPNG(filename,notify=False,message=message)
             
 ###############################################################################
 # Misc
@@ -835,17 +1050,79 @@ class scanbot_interface(object):
     
     def testConnection(self):
         status = True
+        NTCP,connection_error = self.scanbot.connect()                          # Connect to nanonis via TCP
+        if(connection_error): return False
         try:
-            from nanonisTCP.Bias import Bias
-            NTCP,connection_error = self.scanbot.connect()                      # Connect to nanonis via TCP
+            from scanbot.server.scanbot import Bias
             biasModule = Bias(NTCP)
             bias = biasModule.Get()
-            self.scanbot.disconnect(NTCP)
         except:
             status = False
-
+        
+        self.scanbot.disconnect(NTCP,broken=not status)                         # Reopen the session next time if it didn't respond
         return status
+    
+    def getConnections(self,user_args,_help=False):
+        arg_dict = {}
+        
+        if(_help): return arg_dict
+        
+        metrics = self.scanbot.pool.metrics()
+        message  = "Ports:            " + str(metrics['ports'])  + "\n"
+        message += "Open sessions:    " + str(metrics['open'])   + "\n"
+        message += "Idle / busy:      " + str(metrics['idle'])   + " / " + str(metrics['busy']) + "\n"
+        message += "Leases:           " + str(metrics['leases']) + " (" + str(metrics['nested']) + " nested, " + str(metrics['reused']) + " reused)\n"
+        message += "Connects:         " + str(metrics['connects'])   + "\n"
+        message += "Reconnects:       " + str(metrics['reconnects']) + "\n"
+        message += "Failures:         " + str(metrics['failures'])   + "\n"
+        message += "Reclaimed leases: " + str(metrics['reclaimed'])  + "\n"
+        message += "Waits for a port: " + str(metrics['waits']) + " (" + str(int(metrics['waitTime']*1000)) + " ms total)\n"
+        return message
+
+    def getUploads(self,user_args,_help=False):
+        arg_dict = {}
+        
+        if(_help): return arg_dict
+        
+        failedDir = self.module_dir + 'upload_spool/failed/'
+        failed = len(os.listdir(failedDir)) if os.path.isdir(failedDir) else 0
+        message  = "Waiting to upload: " + str(self.uploader.pending()) + "\n"
+        message += "Given up on:       " + str(failed) + " (kept in " + failedDir + ")\n"
+        return message
 
+    def getTrace(self,user_args,_help=False):
+        arg_dict = {'-job' : ['-1', lambda x: int(x), "(int) Job to break down. -1 for the current or most recent job"],
+                    '-o'   : ['',   lambda x: str(x), "(str) Also save a Chrome trace (chrome://tracing or ui.perfetto.dev) of the job to this file"]}
+        
+        if(_help): return arg_dict
+        
+        error,user_arg_dict = self.userArgs(arg_dict,user_args)
+        if(error): return error + "\nRun ```help get_trace``` if you're unsure."
+        
+        jobID,path = self.unpackArgs(user_arg_dict)
+        
+        summary = tracing.tracer.summary()
+        if(jobID >= 0 and jobID not in summary): return "No trace for job " + str(jobID)
+        if(jobID < 0):
+            jobID = self.scheduler.current
+            if(jobID not in summary): jobID = max(summary,default=None)         # Current job hasn't been traced. Most recent one that has
+        if(jobID is None): return "Nothing has been traced yet"
+        
+        job = summary[jobID]
+        message = "Job " + str(jobID) + ": " + job["command"] + " (" + ("%.1f" % job["wall"]) + " s" + ("" if job["finish"] else ", running") + ")\n"
+        for category,duration in sorted(job["phases"].items(),key=lambda x: -x[1]):
+            if(category == "job"): continue
+            message += "  " + category.ljust(10) + ("%.1f s" % duration).rjust(10) + ("%.0f%%" % (100*duration/max(job["wall"],1e-9))).rjust(6) + "\n"
+        if(job["background"]):
+            message += "Background: " + ", ".join(category + " " + ("%.1f s" % duration) for category,duration in job["background"].items()) + "\n"
+        
+        message += "Slowest steps (total):\n"
+        for name,stats in sorted(job["spans"].items(),key=lambda x: -x[1]["total"])[:8]:
+            message += "  " + name.ljust(28) + str(stats["count"]).rjust(6) + " x " + ("%.3f s" % stats["mean"]).rjust(9) + " = " + ("%.1f s" % stats["total"]) + "\n"
+        
+        if(path): message += "Trace saved to " + tracing.tracer.export(path,jobID) + "\n"
+        return message
+    
     def stop(self,user_args=[],_help=False):
         arg_dict = {'-s' : ['1', lambda x: int(x), "(int) Stop scan in progress. 1=Yes"]}
         
@@ -856,23 +1133,34 @@ class scanbot_interface(object):
         
         args = self.unpackArgs(user_arg_dict)
         
+        self.scheduler.halt()                                                   # Cancel the current job and pause the queue so the next job doesn't start
+        self.stopTask(stopScan=args[0])
+        
+    def stopTask(self,stopScan=1):
         if(global_.running.is_set()):
             global_.running.clear()
             global_.pause.clear()
             
-            if(args[0] == 1): self.scanbot.stop()
+            if(stopScan == 1): self.scanbot.stop()
             
             global_.tasks.join()
         else:
-            if(args[0] == 1): self.scanbot.stop()
+            global_.pause.clear()
+            if(stopScan == 1): self.scanbot.stop()
             
-    def threadTask(self,func,override=False):
+    def threadTask(self,func,override=False,command="",user_args=[]):
         if(override): self.stop()
-        if global_.running.is_set(): return "Error: something already running"
-        global_.running.set()
-        t = threading.Thread(target=func)
-        global_.tasks = t
-        t.start()
+        return self.scheduler.start(func,command=command,user_args=user_args)
+    
+    def launchJob(self,command,user_args):
+        """
+        Called by the scheduler to start a queued job.
+
+        """
+        self.sendReply("Starting job: " + command + " " + " ".join(user_args))
+        reply = self.commands[command](user_args)
+        if(reply): self.sendReply("Job " + command + ": " + str(reply))
+        return reply
         
     def _help(self,args):
         if(not len(args)):
@@ -938,19 +1226,18 @@ class scanbot_interface(object):
         return args
     
     def uploadToCloud(self,filename):
-        if(not filename.endswith(".pkl")): return filename
-        try:
-            subprocess.run(["scp", filename, self.cloudPath])
-            os.remove(filename)
-        except Exception as e:
-            self.sendReply("Error uploading file to cloud with command\nscp " +
-                           filename + " " + self.cloudPath + "\n\n" + str(e))
+        if(not filename.endswith(".pkl") and not os.path.isdir(filename)): return filename
+        self.uploader.enqueue(filename,'scp',destination=self.cloudPath)        # Batched into one scp with anything else waiting to go
     
     def _quit(self,arg_dict=[]):
         sys.exit()
 
     def restart(self,run_mode,module_dir="./"):
         self.stop(user_args=[])
+        self.config.close()
+        self.scheduler.close()
+        self.uploader.close(wait=False)                                         # Whatever hasn't gone yet is picked up from the spool
+        self.scanbot.pool.close()                                               # Close the persistent nanonis sessions before re-initialising
         self.__init__(run_mode=run_mode,module_dir=module_dir)
 
 ###############################################################################
@@ -958,50 +1245,47 @@ class scanbot_interface(object):
 ###############################################################################
 handler_class = scanbot_interface                                                   # Used by zulip-run-bot
 
-finish = False
-    
-if('-z' in sys.argv and not finish):
-    rcfile = ''
-    try:
-        with open('scanbot_config.ini','r') as f:                                   # Go through the config file to see what defaults need to be overwritten
-            line = "begin"
-            while(line):
-                line = f.readline()[:-1]
-                key, value = line.split('=')                                        # Format for valid line is "Key=Value"
-                if(key == 'zuliprc'):                                               # Look for the bot rc file
-                    rcfile = value
-                    break
-    except:
+def runZulip():
+    """
+    Run Scanbot as a zulip bot. The bot's rc file is read from
+    scanbot_config.ini in the working directory.
+
+    """
+    values = readConfig('scanbot_config.ini')
+    if(values is None):
         print("scanbot_config.ini not found.")
         sys.exit()
     
+    rcfile = values.get('zuliprc','')                                           # Look for the bot rc file
     if(not rcfile):
         print("zulip bot rc file not in scanbot_config.ini")
         sys.exit()
     
     os.system("zulip-run-bot scanbot_interface.py --config=" + rcfile)
-    finish = True
-    
-if('-c' in sys.argv and not finish):
-    print("Console mode: type 'exit' to end scanbot")
-    go = True
-    handler_class = scanbot_interface(run_mode='c')
-    while(go):
-        message = input("User: ")
-        if(message == 'exit'):
-            break
-        handler_class.handle_message(message)
-    
-    finish = True
 
-if('-react' in sys.argv and not finish):
-    go = True
-    handler_class = scanbot_interface(run_mode='react')
-    while(go):
+def runConsole(run_mode='c'):
+    """
+    Read commands from the terminal until the user types exit.
+
+    """
+    if(run_mode == 'c'): print("Console mode: type 'exit' to end scanbot")
+    handler = scanbot_interface(run_mode=run_mode)
+    while(True):
         message = input("User: ")
         if(message == 'exit'):
             break
-        handler_class.handle_message(message)
-    
-    finish = True
-    
\ No newline at end of file
+        handler.handle_message(message)
+
+def run(argv):
+    """
+    Start Scanbot in the mode given on the command line. Nothing runs when
+    this module is imported. scanbot -c and scanbot -z come through here from
+    server.app_, and running this file directly still works as before.
+
+    """
+    if('-z' in argv):       runZulip()
+    elif('-c' in argv):     runConsole('c')
+    elif('-react' in argv): runConsole('react')
+
+if __name__ == '__main__':
+    run(sys.argv)
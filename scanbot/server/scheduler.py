@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:21:48 2026
+
+Job queue for instrument routines (survey, bias_dep, zdep, auto_tip_shape,
+etc.).
+"""
+
+from scanbot.server import global_
+from scanbot.server import tracing
+
+import json
+import os
+import threading
+import time
+
+class job_scheduler():
+    """
+    Routines that drive the instrument run one at a time. They still
+    coordinate through global_.running and global_.pause: a routine holds the
+    instrument while global_.running is set and stops when it's cleared.
+
+    Every routine started through the interface becomes a job with an ID and
+    a status. Commands can also be queued with a priority. Queued jobs are
+    started by a dispatcher thread, highest priority first then in order of
+    submission, as soon as the instrument is free. Queued jobs are saved to
+    disk so they survive a restart (they come back held).
+
+    Job status is one of:
+        queued    : Waiting for the instrument
+        held      : On the queue but won't start until resumed
+        running   : Holding the instrument
+        paused    : Running but paused (global_.pause)
+        done      : Finished
+        failed    : Raised an exception or couldn't be started
+        cancelled : Cancelled by the user or by stop
+
+    """
+    maxHistory = 50                                                             # Number of finished jobs to remember
+
+    def __init__(self,launcher,path=""):
+        """
+        Parameters
+        ----------
+        launcher : Callable launcher(command,user_args) that runs a command.
+                   Returns a reply string (an error if the command couldn't
+                   start).
+        path     : Path to the json file queued jobs are saved in. Empty
+                   string disables persistence.
+
+        """
+        self.launcher    = launcher
+        self.path        = path
+        self.jobs        = {}                                                   # id: job dictionary
+        self.threads     = {}                                                   # id: number of live threads belonging to the job
+        self.owners      = {}                                                   # thread ident: id of the job the thread belongs to
+        self.nextID      = 1
+        self.current     = None                                                 # id of the job that last took the instrument
+        self.dispatching = None                                                 # [thread ident, job id] while a queued job is being launched
+        self.paused      = False                                                # Queue paused. Queued jobs won't start until resumed
+        self.closed      = False
+        self.lock        = threading.Condition(threading.RLock())
+
+        self.load()
+
+        self.dispatcher = threading.Thread(target=self.dispatch,name="scanbot-scheduler",daemon=True)
+        self.dispatcher.start()
+
+    def submit(self,command,user_args=[],priority=0,hold=False):
+        """
+        Put a command on the queue.
+
+        Parameters
+        ----------
+        command   : Interface command name (e.g. survey, bias_dep)
+        user_args : Arguments exactly as they'd be passed to the command
+        priority  : Higher priority jobs start first
+        hold      : Queue the job held. It won't start until resumed
+
+        Returns
+        -------
+        jobID : ID of the new job
+
+        """
+        with self.lock:
+            job = self.newJob(command,user_args,priority,status="held" if hold else "queued")
+            self.save()
+            self.lock.notify_all()
+            return job["id"]
+
+    def start(self,func,command="",user_args=[]):
+        """
+        Run func on a new thread as a job. Called by the interface whenever a
+        routine is started.
+
+        If the calling thread belongs to a running job (e.g. survey handing
+        over to move_tip_to_clean) the new thread is part of that job. If
+        the dispatcher is launching a queued job, the thread becomes that
+        job. Otherwise a new job is created for it.
+
+        Returns
+        -------
+        error : Error message if the instrument is busy. None otherwise
+
+        """
+        ident = threading.get_ident()
+        with self.lock:
+            if(global_.running.is_set()): return "Error: something already running"
+
+            if(ident in self.owners):
+                jobID = self.owners[ident]
+            elif(self.dispatching and self.dispatching[0] == ident):
+                jobID = self.dispatching[1]
+            else:
+                jobID = self.newJob(command,user_args,status="running",persist=False)["id"]
+
+            job = self.jobs[jobID]
+            if(job["status"] != "paused"): job["status"] = "running"
+            if(not job["started"]): job["started"] = time.time()
+            self.current = jobID
+
+            global_.running.set()
+            t = threading.Thread(target=self.run,args=(jobID,func),name="scanbot-job-" + str(jobID))
+            global_.tasks = t
+            self.threads[jobID] = self.threads.get(jobID,0) + 1
+            t.start()
+
+    def run(self,jobID,func):
+        ident = threading.get_ident()
+        with self.lock:
+            self.owners[ident] = jobID
+
+        error = ""
+        try:
+            with tracing.tracer.job(jobID,self.jobs[jobID]["command"]):
+                func()
+        except Exception as e:
+            error = str(e)
+            print("Job " + str(jobID) + " failed: " + error)
+            if(self.current == jobID): global_.running.clear()                  # Free up the running flag. The routine didn't get the chance to free it
+        finally:
+            with self.lock:
+                del self.owners[ident]
+                self.threads[jobID] -= 1
+                job = self.jobs[jobID]
+                if(error): job["error"] = error
+                if(not self.threads[jobID]):                                    # Last thread belonging to this job
+                    del self.threads[jobID]
+                    job["finished"] = time.time()
+                    if(job["status"] != "cancelled"): job["status"] = "failed" if job["error"] else "done"
+                    self.trim()
+                self.lock.notify_all()
+
+    def dispatch(self):
+        """
+        Dispatcher loop. Starts the next queued job whenever the instrument
+        is free.
+
+        """
+        with self.lock:
+            while(not self.closed):
+                job = self.nextJob()
+                if(not job):
+                    self.lock.wait(1)                                           # Timeout catches routines that free the running flag without a thread finishing
+                    continue
+
+                job["status"] = "running"
+                self.dispatching = [threading.get_ident(),job["id"]]
+                self.save()
+                self.lock.release()                                             # The launcher can talk to the network (e.g. replies to zulip). Don't hold up status, cancel, etc. meanwhile
+                try:
+                    error = self.launcher(job["command"],list(job["args"]))
+                except Exception as e:
+                    error = str(e)
+                finally:
+                    self.lock.acquire()
+                    self.dispatching = None
+
+                if(not job["started"]):                                         # Command returned without starting a routine
+                    job["finished"] = time.time()
+                    if(error): job["error"] = str(error)
+                    if(job["status"] == "running"): job["status"] = "failed" if error else "done"
+
+    def nextJob(self):
+        if(self.paused or self.threads or global_.running.is_set()): return None # Instrument is busy
+        queued = [job for job in self.jobs.values() if job["status"] == "queued"]
+        if(not queued): return None
+        return max(queued,key=lambda job: (job["priority"],-job["id"]))
+
+    def cancel(self,jobID):
+        """
+        Cancel a job.
+
+        Returns
+        -------
+        status : Status of the job before it was cancelled. The caller needs
+                 to stop the routine if the job was running or paused. None
+                 if the job doesn't exist.
+
+        """
+        with self.lock:
+            job = self.jobs.get(jobID)
+            if(not job): return None
+            status = job["status"]
+            if(status in ["queued","held","running","paused"]):
+                job["status"] = "cancelled"
+                if(status in ["queued","held"]): job["finished"] = time.time()
+                self.save()
+            return status
+
+    def cancelQueue(self):
+        """
+        Cancel every job that hasn't started.
+
+        Returns
+        -------
+        count : Number of jobs cancelled
+
+        """
+        with self.lock:
+            count = 0
+            for job in self.jobs.values():
+                if(job["status"] in ["queued","held"]):
+                    job["status"]   = "cancelled"
+                    job["finished"] = time.time()
+                    count += 1
+            self.save()
+            return count
+
+    def hold(self,jobID):
+        """
+        Pause a job. Running jobs are paused via global_.pause (the routine
+        pauses the scan at its next checkEventFlags). Queued jobs are held.
+
+        Returns
+        -------
+        status : New status of the job. None if it couldn't be paused
+
+        """
+        with self.lock:
+            job = self.jobs.get(jobID)
+            if(not job): return None
+            if(job["status"] == "running" and jobID == self.current):
+                global_.pause.set()
+                job["status"] = "paused"
+            elif(job["status"] == "queued"):
+                job["status"] = "held"
+                self.save()
+            else:
+                return None
+            return job["status"]
+
+    def resume(self,jobID):
+        """
+        Resume a paused or held job.
+
+        Returns
+        -------
+        status : New status of the job. None if it couldn't be resumed
+
+        """
+        with self.lock:
+            job = self.jobs.get(jobID)
+            if(not job): return None
+            if(job["status"] == "paused"):
+                global_.pause.clear()
+                job["status"] = "running"
+            elif(job["status"] == "held"):
+                job["status"] = "queued"
+                self.save()
+                self.lock.notify_all()
+            else:
+                return None
+            return job["status"]
+
+    def pauseQueue(self,paused=True):
+        with self.lock:
+            self.paused = paused
+            self.lock.notify_all()
+
+    def halt(self):
+        """
+        Called when everything is stopped (stop command, safe retract,
+        restart). The current job is marked cancelled and, if there's anything
+        waiting, the queue is paused so the next job doesn't start straight
+        away.
+
+        """
+        with self.lock:
+            if(any(job["status"] == "queued" for job in self.jobs.values())): self.paused = True
+            job = self.jobs.get(self.current)
+            if(job and job["status"] in ["running","paused"] and self.threads.get(job["id"])):
+                job["status"] = "cancelled"
+
+    def status(self,jobID=None):
+        """
+        Returns
+        -------
+        jobs : List of job dictionaries (copies), most recent last. Just the
+               one job if jobID is passed in.
+
+        """
+        with self.lock:
+            if(jobID is not None):
+                job = self.jobs.get(jobID)
+                return dict(job) if job else None
+            return [dict(job) for job in self.jobs.values()]
+
+    def queued(self):
+        with self.lock:
+            return sorted([dict(job) for job in self.jobs.values() if job["status"] in ["queued","held"]],
+                          key=lambda job: (-job["priority"],job["id"]))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    def newJob(self,command,user_args,priority=0,status="queued",persist=True):
+        job = {"id"        : self.nextID,
+               "command"   : command,
+               "args"      : list(user_args),
+               "priority"  : int(priority),
+               "status"    : status,
+               "persist"   : persist,                                           # Only jobs submitted to the queue are saved
+               "submitted" : time.time(),
+               "started"   : None,
+               "finished"  : None,
+               "error"     : ""}
+        self.jobs[self.nextID] = job
+        self.nextID += 1
+        return job
+
+    def trim(self):
+        finished = [jobID for jobID,job in self.jobs.items() if job["status"] in ["done","failed","cancelled"]]
+        for jobID in finished[:-self.maxHistory]:
+            del self.jobs[jobID]
+
+    def save(self):
+        if(not self.path): return
+        queued = [job for job in self.jobs.values() if job["persist"] and job["status"] in ["queued","held"]]
+        try:
+            if(not queued):
+                if(os.path.isfile(self.path)): os.remove(self.path)
+                return
+            tmp = self.path + ".tmp"
+            with open(tmp,'w') as f:
+                json.dump(queued,f,indent=1)
+            os.replace(tmp,self.path)                                           # Don't leave a half written queue behind if we die mid-write
+        except Exception as e:
+            print("Could not save job queue: " + str(e))
+
+    def load(self):
+        if(not self.path or not os.path.isfile(self.path)): return
+        try:
+            with open(self.path,'r') as f:
+                saved = json.load(f)
+        except Exception as e:
+            print("Could not load job queue: " + str(e))
+            return
+
+        for job in saved:
+            job = self.newJob(job["command"],job["args"],job.get("priority",0),status="held") # The instrument may not be where it was. Wait for the user to resume
+            print("Restored job " + str(job["id"]) + ": " + job["command"] + " " + " ".join(job["args"]) + " (held)")
+        self.save()
@@ -1,32 +1,30 @@
-from flask import Flask, request, send_from_directory
+from scanbot.server import lazy
+from flask import Flask, request, send_from_directory, send_file, Response
 from flask_cors import CORS
-from scanbot.server.scanbot_interface import scanbot_interface
+from scanbot.server.scanbot_interface import scanbot_interface, run
 from scanbot.server.scanbot_config import scanbot_config
 from scanbot.server import global_
+from scanbot.server import tracing
 import numpy as np
 import os
 import shutil
 from pathlib import Path
-from PIL import Image
 import base64
+import io
+import json
+import mimetypes
 import sys
 import pickle
 import webbrowser
 from threading import Timer
 import argparse
 
+Image = lazy.lazy_module('PIL.Image')
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--version', action='version', version='scanbot 4.2.0', help='show the version number and exit')
 parser.add_argument('-c', '--terminal', action='store_true', help='run scanbot in terminal')
 parser.add_argument('-z', '--zulip',    action='store_true', help='run scanbot in terminal')
-args = parser.parse_args()
-
-module_dir = str(os.path.dirname(os.path.abspath(__file__))).replace('\\','/')
-if(not module_dir.endswith('/')): module_dir += '/'
-
-run_mode = 'react'
-if(args.terminal):  run_mode = 'c'
-if(args.zulip):     run_mode = 'z'
 
 # if(run_mode == 'react'):
 # pyinstaller --onefile --icon=..\App\public\favicon.ico --add-data "..\App\build;static" --name scanbot_v4.1 server.py
@@ -43,7 +41,7 @@ else:
     app.module_dir = str(os.path.dirname(os.path.abspath(__file__))).replace('\\','/')
     if(not app.module_dir.endswith('/')): app.module_dir += '/'
 
-scanbot = scanbot_interface(run_mode='react',module_dir=app.module_dir)
+scanbot = None                                                                  # The interface. Created by app_ so importing this module doesn't start anything
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -147,6 +145,7 @@ def run_go_to_target():
 
     target   = data['target']
     userArgs = data['userArgs']
+    seq      = scanbot.imageFeed.seq
     if(target == 'sample'):
         error = scanbot.moveTipToSample(user_args=userArgs)
 
@@ -157,11 +156,7 @@ def run_go_to_target():
         print("ERROR:",error)
         return {"status": error}, 503
     
-    try:
-        shutil.rmtree('./temp')
-    except:
-        pass
-    
+    scanbot.imageFeed.clear(upTo=seq)                                           # Drop images from previous runs
     return {"status": "success"}, 200
 
 @app.route('/scanbot_config')
@@ -172,13 +167,19 @@ def get_config():
 @app.route('/save_config', methods=['POST'])
 def save_config():
     config = request.json['config']
+    values = {line['parameter']: line['value'][scanbot_config.value] for line in config if line['value'][scanbot_config.value]}
+
+    _,error = scanbot.config.parse(values)                                      # Check before writing so a bad value never replaces a good file
+    if(error): return {"status": "Config not applied. " + error}, 400
 
-    with open(app.module_dir + 'scanbot_config.ini', 'w') as file:
-        for line in config:
-            if(not line['value'][scanbot_config.value]): continue
-            file.write(line['parameter'] + '=' + line['value'][scanbot_config.value] + '\n')
+    filename = app.module_dir + 'scanbot_config.ini'
+    with open(filename + '.tmp', 'w') as file:
+        for key,value in values.items():
+            file.write(key + '=' + value + '\n')
+    os.replace(filename + '.tmp', filename)                                     # The config watcher never sees a half written file
 
-    scanbot.restart(run_mode='react',module_dir=app.module_dir)
+    error = scanbot.reloadConfig()                                              # Changed settings are applied in place. Running jobs carry on
+    if(error): return {"status": error}, 400
 
     # Maybe have something like scanbot.errors where errors can be stored with varying priority levels (i.e. 1=code failure, 2=warning, etc.)
 
@@ -187,87 +188,113 @@ def save_config():
 @app.route('/run_survey', methods=['POST'])
 def run_survey():
     userArgs = request.json['userArgs']
+    seq   = scanbot.imageFeed.seq
     error = scanbot.survey2(user_args=userArgs)
     if(error):
         return {"status": error}, 503
 
-    try:
-        shutil.rmtree(app.module_dir + 'temp')
-    except:
-        pass
+    scanbot.imageFeed.clear(upTo=seq)                                           # Drop images from previous runs
     return {"status": "success"}, 200
 
 @app.route('/run_biasdep', methods=['POST'])
 def run_biasdep():
     userArgs = request.json['userArgs']
+    seq   = scanbot.imageFeed.seq
     error = scanbot.biasDep(user_args=userArgs)
     if(error):
         return {"status": error}, 503
 
-    try:
-        shutil.rmtree(app.module_dir + 'temp')
-    except:
-        pass
+    scanbot.imageFeed.clear(upTo=seq)                                           # Drop images from previous runs
     return {"status": "success"}, 200
 
 @app.route('/run_autotipshape', methods=['POST'])
 def run_autotipshape():
     userArgs = request.json['userArgs']
+    seq   = scanbot.imageFeed.seq
     error = scanbot.autoTipShape(user_args=userArgs)
     if(error):
         return {"status": error}, 503
-    try:
-        shutil.rmtree(app.module_dir + 'temp')
-    except:
-        pass
+
+    scanbot.imageFeed.clear(upTo=seq)                                           # Drop images from previous runs
     return {"status": "success"}, 200
 
 @app.route('/get_imprint_score')
 def get_imprint_score():
-    files = sorted([file for file in Path(app.module_dir + 'temp').iterdir() if file.suffix == '.png'], key=os.path.getmtime)
-    latestFile = str(files[-1].name)
-    size = latestFile.split("size--")[1].split("_")[0]
-    symm = latestFile.split("symm--")[1].split(".png")[0]
+    frame = scanbot.imageFeed.latest(key="size")
+    if(not frame):
+        return {"status": 'not found'}, 404
     running = global_.running.is_set()
-    return {"size": size,"sym": symm, "running": running}, 200
+    return {"size": frame["meta"]["size"],"sym": frame["meta"]["sym"], "running": running}, 200
     
 
 @app.route('/image_updates', methods=['POST'])
 def check_survey_updates():
     timestamp = request.json['timestamp']
+    frame = scanbot.imageFeed.latest()
+    if(frame and frame["timestamp"]*1000 > timestamp):
+        return sendFrame(frame)
+    
+    return {"status": 'not found'}, 404
+
+@app.route('/image_stream')
+def image_stream():
+    """
+    Server-sent events. An 'image' event is pushed as soon as a new image is
+    published. Clients resume from the Last-Event-ID header (sent
+    automatically by EventSource on reconnect) or ?after=<seq>.
+    """
+    after = request.headers.get('Last-Event-ID', request.args.get('after', scanbot.imageFeed.seq))
     try:
-        files = sorted([file for file in Path(app.module_dir + 'temp').iterdir() if file.suffix == '.png'], key=os.path.getmtime)
-        latestFile = str(files[-1].name)
-        try:
-            latestTimestamp = float(latestFile.split('_')[0])*1000
-            if(latestTimestamp > timestamp):
-                temp_dir = getDir(app.module_dir + 'temp')
-                return send_from_directory(temp_dir, str(files[-1].name), as_attachment=True)
-        except Exception as e:
-            print(e)
-        
-        return {"status": 'not found'}, 404
+        after = int(after)
     except:
-        pass
+        after = scanbot.imageFeed.seq
+    
+    def stream(seq):
+        yield "retry: 2000\n\n"
+        while True:
+            frames = scanbot.imageFeed.wait(seq, timeout=15)
+            if(not frames):
+                yield ": keepalive\n\n"                                         # Stops proxies closing an idle connection
+                continue
+            for frame in frames:
+                seq = frame["seq"]
+                yield "id: " + str(seq) + "\nevent: image\ndata: " + json.dumps(frameInfo(frame)) + "\n\n"
+    
+    return Response(stream(after), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-    return {"status": 'not found'}, 404
+@app.route('/get_image/<int:seq>')
+def get_image(seq):
+    frame = scanbot.imageFeed.get(seq)
+    if(not frame):
+        return {"status": 'not found'}, 404
+    return sendFrame(frame)
 
 @app.route('/get_gif')
 def get_gif():
+    path = scanbot.animationPath
+    if(path and os.path.isfile(path)):                                          # Animation built up on disk while the routine ran
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        return send_file(path, mimetype=mimetype, as_attachment=True, download_name='GIF' + os.path.splitext(path)[1], conditional=True)
+    if(path):
+        return {"status": 'not found'}, 404                                     # No frames appended yet
+    
     frames = []
-    files = sorted([file for file in Path(app.module_dir + 'temp').iterdir() if file.suffix == '.png'], key=os.path.getmtime)
-    for file in files:
-        if(str(file.name).endswith('.png')):
-            im = Image.open(file)
-            frames.append(im.copy())
+    for frame in scanbot.imageFeed.since(0):
+        im = Image.open(io.BytesIO(frame["data"]))
+        frames.append(im.copy())
             
     if(frames):
-        frames[0].save(app.module_dir + 'temp/GIF.gif', format="GIF", append_images=frames, save_all=True, duration=500, loop=0)
-        temp_dir = getDir(app.module_dir + 'temp')
-        return send_from_directory(temp_dir, 'GIF.gif', as_attachment=True)
+        gif = io.BytesIO()
+        frames[0].save(gif, format="GIF", append_images=frames, save_all=True, duration=500, loop=0)
+        gif.seek(0)
+        return send_file(gif, mimetype='image/gif', as_attachment=True, download_name='GIF.gif')
             
     return {"status": 'not found'}, 404
 
+@app.route('/get_stitch/<path:filename>')
+def get_stitch(filename):
+    return send_from_directory(app.module_dir + 'temp/stitch', filename)        # <suffix>/pyramid.json and <suffix>/<level>/<row>_<col>.png
+
 @app.route('/get_state')
 def get_running():
     running = global_.running.is_set()
@@ -276,10 +303,9 @@ def get_running():
 
 @app.route('/remove_temp')
 def remove_temp():
-    try:
-        shutil.rmtree(app.module_dir + 'temp')
-    except:
-        pass
+    scanbot.imageFeed.clear()
+    shutil.rmtree(app.module_dir + 'temp', ignore_errors=True)
+    scanbot.animationPath = ""
     return {"status": "success"}, 200
 
 @app.route('/stop')
@@ -287,6 +313,89 @@ def stop():
     scanbot.stop(user_args=[])
     return {"status": "success"}, 200
 
+@app.route('/get_jobs')
+def get_jobs():
+    return {"jobs": scanbot.scheduler.status(), "paused": scanbot.scheduler.paused}, 200
+
+@app.route('/queue_job', methods=['POST'])
+def queue_job():
+    command  = request.json['command']
+    userArgs = request.json.get('userArgs',[])
+    priority = request.json.get('priority',0)
+    error = scanbot.validateJob(command,userArgs)
+    if(error):
+        return {"status": error}, 400
+    jobID = scanbot.scheduler.submit(command,userArgs,priority=int(priority))
+    return {"status": "success", "id": jobID}, 200
+
+@app.route('/cancel_job', methods=['POST'])
+def cancel_job():
+    reply = scanbot.cancelJob(user_args=[str(request.json['id'])])
+    if(reply and reply.startswith("No job")):
+        return {"status": reply}, 404
+    return {"status": "success"}, 200
+
+@app.route('/pause_job', methods=['POST'])
+def pause_job():
+    reply = scanbot.pauseJob(user_args=[str(request.json['id'])])
+    if(reply): return {"status": reply}, 409
+    return {"status": "success"}, 200
+
+@app.route('/resume_job', methods=['POST'])
+def resume_job():
+    reply = scanbot.resumeJob(user_args=[str(request.json['id'])])
+    if(reply): return {"status": reply}, 409
+    return {"status": "success"}, 200
+
+@app.route('/pause_queue')
+def pause_queue():
+    scanbot.pauseQueue()
+    return {"status": "success"}, 200
+
+@app.route('/resume_queue')
+def resume_queue():
+    scanbot.resumeQueue()
+    return {"status": "success"}, 200
+
+@app.route('/get_trace')
+def get_trace():
+    """
+    Where each job's time went. ?job=<id> for a single job.
+    """
+    jobID   = request.args.get('job', type=int)
+    summary = tracing.tracer.summary(jobID)
+    if(jobID is not None and not summary):
+        return {"status": 'not found'}, 404
+    return {"jobs": {str(k): v for k,v in summary.items()}}, 200
+
+@app.route('/get_trace_file')
+def get_trace_file():
+    """
+    Chrome trace of every span (or just ?job=<id>). Open it in
+    chrome://tracing or https://ui.perfetto.dev
+    """
+    jobID = request.args.get('job', type=int)
+    trace = json.dumps(tracing.tracer.chromeTrace(jobID)).encode()
+    name  = 'scanbot_trace' + ('_job' + str(jobID) if jobID is not None else '') + '.json'
+    return send_file(io.BytesIO(trace), mimetype='application/json', as_attachment=True, download_name=name)
+
+@app.route('/import_profile')
+def import_profile():
+    """
+    How long startup took and which modules have been imported on first use
+    """
+    return {"status": lazy.report()}, 200
+
+def frameInfo(frame):
+    return {"seq"       : frame["seq"],
+            "timestamp" : frame["timestamp"]*1000,                              # ms, same as the timestamps the front-end sends
+            "filename"  : frame["filename"],
+            "url"       : "/get_image/" + str(frame["seq"]),
+            "meta"      : frame["meta"]}
+
+def sendFrame(frame):
+    return send_file(io.BytesIO(frame["data"]), mimetype='image/png', as_attachment=True, download_name=frame["filename"])
+
 def getDir(path):
     if getattr(sys, 'frozen', False):
         # If running as a PyInstaller executable, the base directory is the directory of the executable
@@ -300,27 +409,38 @@ def getDir(path):
 def open_browser():
     webbrowser.open_new('http://127.0.0.1:5000/')
 
-# Running app
-if __name__ == '__main__':
-    Timer(1, open_browser).start()
-    app.run(debug=False)
+lazy.mark("import")
 
 def app_(test=False,tmp_path=""):
+    global scanbot
+    args = parser.parse_args([] if test else None)                              # Tests are run with pytest's command line
+    
+    run_mode = 'react'
+    if(args.terminal):  run_mode = 'c'
+    if(args.zulip):     run_mode = 'z'
     print("RUNMODE",run_mode)
     
     if(run_mode == 'c'):
-        scanbot_interface(run_mode=run_mode, module_dir=module_dir)
+        run(['-c'])
         exit()
 
     if(run_mode == 'z'):
-        scanbot_interface(run_mode=run_mode, module_dir=module_dir)
+        run(['-z'])
         exit()
         
     if(test):
         app.module_dir = str(tmp_path)
         if(not app.module_dir.endswith('/')): app.module_dir += '/'
-        scanbot.restart(run_mode='react',module_dir=app.module_dir)
-        return app
+    
+    with lazy.stage("interface"):
+        if(scanbot): scanbot.restart(run_mode='react',module_dir=app.module_dir)
+        else:        scanbot = scanbot_interface(run_mode='react',module_dir=app.module_dir)
+    
+    if(test): return app
     
     Timer(1, open_browser).start()
-    app.run(debug=False)
\ No newline at end of file
+    app.run(debug=False)
+
+# Running app
+if __name__ == '__main__':
+    app_()
\ No newline at end of file
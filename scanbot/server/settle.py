@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:36:52 2026
+
+Adaptive waits. Instead of sleeping for a fixed time after changing
+something on the instrument, poll the signal that responds to the change
+and carry on as soon as it has stopped moving.
+"""
+
+from scanbot.server import tracing
+
+import numpy as np
+import time
+
+def waitForStable(read,tolerance,timeout,relative=0,window=5,interval=0.02,fallback=None,name="settle"):
+    """
+    Poll a signal until the last few readings agree with each other.
+
+    Parameters
+    ----------
+    read      : Callable that returns the current value of the signal
+    tolerance : The signal is stable when the spread (max - min) of the last
+                window readings is no more than this...
+    relative  : ...plus this fraction of the size of the latest reading
+    timeout   : Give up waiting after this long (s)
+    window    : Number of readings that need to agree
+    interval  : Time between readings (s)
+    fallback  : Fixed time to sleep instead if the signal can't be read (s).
+                Defaults to timeout
+    name      : Name of the wait in the trace
+
+    Returns
+    -------
+    stable : True if the signal settled. False if it timed out or couldn't be
+             read
+    value  : Mean of the last window readings. None if it couldn't be read
+
+    """
+    with tracing.span(name,"settle"):
+        readings = []
+        start = time.time()
+        try:
+            while(True):
+                readings.append(read())
+                readings = readings[-window:]
+                if(len(readings) == window):
+                    spread = max(readings) - min(readings)
+                    if(spread <= tolerance + relative*abs(readings[-1])): return True,float(np.mean(readings))
+                if(time.time() - start > timeout): return False,float(np.mean(readings))
+                time.sleep(interval)
+        except Exception as e:
+            print("Could not read signal to settle on (" + str(e) + "). Waiting a fixed time instead")
+            time.sleep(max(0,(timeout if fallback is None else fallback) - (time.time() - start)))
+            return False,None
+
+def waitUntil(condition,timeout,interval=0.1,name="wait"):
+    """
+    Poll condition() until it's true.
+
+    Returns
+    -------
+    met : True if the condition was met before timing out
+
+    """
+    with tracing.span(name,"settle"):
+        start = time.time()
+        while(not condition()):
+            if(timeout is not None and time.time() - start > timeout): return False
+            time.sleep(interval)
+        return True
+
+def lineShifts(scanData,maxShift=8):
+    """
+    Lateral shift between consecutive scan lines, in the order they were
+    scanned. While the piezo is still creeping after the frame has moved the
+    shift changes from line to line. Once it has settled the shift is
+    constant (zero, or whatever the thermal drift is).
+
+    Parameters
+    ----------
+    scanData : Raw scan data. Lines that haven't been scanned yet are nan
+    maxShift : Largest shift looked for (pixels)
+
+    Returns
+    -------
+    shifts : Shift of each scanned line relative to the one scanned before it
+             (pixels). Empty if fewer than two lines have been scanned.
+
+    """
+    rows = np.flatnonzero(~np.isnan(scanData).any(axis=1))
+    if(len(rows) < 2): return np.array([])
+    if(rows[0] > 0): rows = rows[::-1]                                          # Scanning up. The bottom line was scanned first
+    lines = scanData[rows].astype(np.float64)
+    lines = lines - lines.mean(axis=1,keepdims=True)
+    lines = np.diff(lines,axis=1)                                               # Correlate on slopes so the tilt of the surface doesn't dominate
+
+    width  = lines.shape[1]
+    n      = 1 << int(np.ceil(np.log2(2*width)))
+    spec   = np.fft.rfft(lines,n=n,axis=1)
+    xcor   = np.fft.irfft(spec[1:]*np.conj(spec[:-1]),n=n,axis=1)               # Each line against the one before it
+    lags   = np.r_[0:maxShift + 1,-maxShift:0]
+    xcor   = xcor[:,lags]
+    peak   = np.argmax(xcor,axis=1)
+
+    left   = xcor[np.arange(len(peak)),(peak - 1) % len(lags)]
+    centre = xcor[np.arange(len(peak)),peak]
+    right  = xcor[np.arange(len(peak)),(peak + 1) % len(lags)]
+    denom  = left - 2*centre + right
+    sub    = np.where(denom != 0,0.5*(left - right)/np.where(denom == 0,1,denom),0) # Parabolic sub-pixel peak
+    return lags[peak] + sub
+
+def creepSettled(scanData,window=16,tolerance=0.15):
+    """
+    Decide whether the scan has got past the piezo creep that follows moving
+    the frame.
+
+    Parameters
+    ----------
+    scanData  : Raw scan data. Lines that haven't been scanned yet are nan
+    window    : Lines used to estimate the drift rate
+    tolerance : Largest change in line-to-line shift between the last two
+                windows that still counts as settled (pixels per line)
+
+    Returns
+    -------
+    settled : None if there aren't enough lines to tell yet. Otherwise
+              whether the drift rate has stopped changing
+    lines   : Number of lines it took to settle (0 if it was settled from the
+              start)
+
+    """
+    shifts = lineShifts(scanData)
+    if(len(shifts) < 2*window): return None,0
+
+    rates = np.array([np.median(shifts[i:i + window]) for i in range(0,len(shifts) - window + 1,window)])
+    changes = np.abs(np.diff(rates))
+    if(changes[-1] > tolerance): return False,0
+    unsettled = np.flatnonzero(changes > tolerance)
+    return True,0 if not len(unsettled) else window*(unsettled[-1] + 2)
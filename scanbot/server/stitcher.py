@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:02:37 2026
+
+Streaming survey stitcher. Frames are blended into a mosaic on disk as they
+arrive so a large survey never has to fit in memory.
+"""
+
+from scanbot.server import nanonispyfit as napfit
+from scanbot.server import render
+from scanbot.server import tracing
+from scanbot.server import lazy
+
+from functools import lru_cache
+import numpy as np
+import json
+import os
+
+cv2 = lazy.lazy_module('cv2')
+
+@lru_cache(maxsize=8)
+def featherWeights(shape,feather):
+    """
+    Blending weights for a tile. Weights ramp up linearly over the first
+    feather pixels from each edge so overlapping tiles fade into each other.
+
+    """
+    lines,px = shape
+    ramp = lambda n: np.minimum(np.minimum(np.arange(n) + 1,np.arange(n)[::-1] + 1),max(1,feather)).astype(np.float32)
+    weights = np.minimum.outer(ramp(lines),ramp(px))
+    weights.flags.writeable = False                                             # Shared between calls
+    return weights
+
+class mosaic():
+    """
+    Mosaic of survey frames backed by two memory-mapped float32 arrays: the
+    weighted sum of every tile and the sum of the weights. The stitched image
+    is sum/weight. Pixels no tile has covered are NaN.
+
+    Frames are placed by their real coordinates (centre x,y and size w,h in
+    m, as passed to FrameSet), so overlapping frames, offsets and reversed
+    surveys all land in the right place. Frame rotation isn't supported.
+
+    """
+    def __init__(self,path,frames,pixels,lines,feather=16,flatten="plane"):
+        """
+        Parameters
+        ----------
+        path    : Path prefix for the mosaic files (path_sum.npy,
+                  path_weight.npy)
+        frames  : List of every frame [x,y,w,h] that will be added (m). Sets
+                  the extent of the mosaic
+        pixels  : Pixels per frame. Sets the resolution of the mosaic
+        lines   : Lines per frame
+        feather : Width of the blending ramp at the edge of each tile (px)
+        flatten : Background subtraction applied to each tile before it's
+                  added. See nanonispyfit.flatten_modes
+
+        """
+        frames = np.array(frames,dtype=float)
+        self.path    = path
+        self.dx      = frames[0,2]/pixels                                       # Pixel size (m)
+        self.dy      = frames[0,3]/lines
+        self.xmin    = np.min(frames[:,0] - frames[:,2]/2)
+        self.ymax    = np.max(frames[:,1] + frames[:,3]/2)
+        self.feather = feather
+        self.flatten = flatten
+        self.tiles   = 0
+
+        cols = int(np.ceil((np.max(frames[:,0] + frames[:,2]/2) - self.xmin)/self.dx - 1e-6))
+        rows = int(np.ceil((self.ymax - np.min(frames[:,1] - frames[:,3]/2))/self.dy - 1e-6))
+        self.shape = (rows,cols)
+
+        self.sum    = np.lib.format.open_memmap(path + '_sum.npy',   mode='w+',dtype=np.float32,shape=self.shape)
+        self.weight = np.lib.format.open_memmap(path + '_weight.npy',mode='w+',dtype=np.float32,shape=self.shape)
+
+    @tracing.traced("render")
+    def add(self,scanData,x,y,w,h):
+        """
+        Blend a frame into the mosaic.
+
+        Parameters
+        ----------
+        scanData : Frame data (lines,pixels). NaNs (e.g. an incomplete scan)
+                   are left out
+        x,y,w,h  : Frame centre and size (m)
+
+        """
+        tile = np.array(scanData,dtype=np.float32)
+        if(np.isnan(tile).all()): return
+
+        if(self.flatten != "none"): tile = napfit.flatten(tile,self.flatten)
+        tile -= np.nanmedian(tile)                                              # Level each tile so neighbours blend
+
+        size = (int(round(w/self.dx)),int(round(h/self.dy)))
+        if(size != (tile.shape[1],tile.shape[0])):                              # Frame resolution differs from the mosaic's
+            tile = cv2.resize(tile,size,interpolation=cv2.INTER_AREA)
+
+        row = int(round((self.ymax - (y + h/2))/self.dy))                       # Row 0 is the top of the mosaic (largest y)
+        col = int(round((x - w/2 - self.xmin)/self.dx))
+
+        r0,c0 = max(row,0),max(col,0)
+        r1,c1 = min(row + tile.shape[0],self.shape[0]),min(col + tile.shape[1],self.shape[1])
+        if(r1 <= r0 or c1 <= c0): return                                        # Outside the mosaic
+
+        weights = featherWeights(tile.shape,self.feather)[r0-row:r1-row,c0-col:c1-col]
+        tile    = tile[r0-row:r1-row,c0-col:c1-col]
+        valid   = ~np.isnan(tile)
+        weights = np.where(valid,weights,0)
+
+        self.sum[r0:r1,c0:c1]    += np.where(valid,tile,0)*weights
+        self.weight[r0:r1,c0:c1] += weights
+        self.tiles += 1
+
+    @tracing.traced("render")
+    def preview(self,maxSize=2048):
+        """
+        Returns the stitched image downsampled so its longest side is at most
+        maxSize. The mosaic is read in strips so it never has to be loaded
+        all at once.
+
+        """
+        factor = max(1,int(np.ceil(max(self.shape)/maxSize)))
+        return self.downsample(factor)
+
+    def downsample(self,factor):
+        rows  = self.shape[0]//factor
+        cols  = self.shape[1]//factor
+        out   = np.full((max(rows,1),max(cols,1)),np.nan,dtype=np.float32)
+        strip = max(1,4096//factor)*factor                                      # Rows read at a time
+        for r in range(0,rows*factor,strip):
+            s = self.blockSum(self.sum[r:r + strip,:cols*factor],factor)
+            w = self.blockSum(self.weight[r:r + strip,:cols*factor],factor)
+            with np.errstate(invalid='ignore',divide='ignore'):
+                out[r//factor:r//factor + len(s)] = np.where(w > 0,s/w,np.nan)
+        return out
+
+    def blockSum(self,a,factor):
+        rows,cols = a.shape[0]//factor,a.shape[1]//factor
+        return np.asarray(a[:rows*factor]).reshape(rows,factor,cols,factor).sum(axis=(1,3))
+
+    @tracing.traced("render")
+    def pyramid(self,path,tileSize=256,cmap='inferno'):
+        """
+        Write the mosaic as an image pyramid for zoomable viewing. Level 0 is
+        full resolution and each level after it is half the size of the one
+        before, down to a single tile. Tiles are png files path/level/row_col.png.
+        path/pyramid.json describes the levels.
+
+        Every level uses the same colour scale, taken from the preview.
+
+        Returns
+        -------
+        info : Contents of pyramid.json
+
+        """
+        vmin,vmax = self.colourScale()
+        levels = []
+        sum_,weight = self.sum,self.weight
+        level = 0
+        while(True):
+            os.makedirs(os.path.join(path,str(level)),exist_ok=True)
+            rows,cols = sum_.shape
+            for r in range(0,rows,tileSize):
+                s = np.asarray(sum_[r:r + tileSize])
+                w = np.asarray(weight[r:r + tileSize])
+                with np.errstate(invalid='ignore',divide='ignore'):
+                    strip = np.where(w > 0,s/w,np.nan)
+                for c in range(0,cols,tileSize):
+                    filename = os.path.join(path,str(level),str(r//tileSize) + "_" + str(c//tileSize) + ".png")
+                    render.renderImage(filename,strip[:,c:c + tileSize],vmin=vmin,vmax=vmax,cmap=cmap)
+            levels.append({"level": level, "rows": rows, "cols": cols,
+                           "tileRows": int(np.ceil(rows/tileSize)), "tileCols": int(np.ceil(cols/tileSize))})
+            if(rows <= tileSize and cols <= tileSize): break
+
+            rows,cols = (rows + 1)//2,(cols + 1)//2                             # Halve, padding odd edges
+            sum_   = self.halve(sum_,rows,cols)
+            weight = self.halve(weight,rows,cols)
+            level += 1
+
+        info = {"tileSize": tileSize, "dx": self.dx, "dy": self.dy,
+                "xmin": self.xmin, "ymax": self.ymax, "levels": levels}
+        with open(os.path.join(path,"pyramid.json"),'w') as f:
+            json.dump(info,f,indent=1)
+        return info
+
+    def halve(self,a,rows,cols):
+        out = np.zeros((rows,cols),dtype=np.float32)
+        for r in range(0,rows,2048):
+            block = np.zeros((2*min(2048,rows - r),2*cols),dtype=np.float32)
+            src   = np.asarray(a[2*r:2*r + block.shape[0]])
+            block[:src.shape[0],:src.shape[1]] = src
+            out[r:r + block.shape[0]//2] = self.blockSum(block,2)
+        return out
+
+    def colourScale(self):
+        preview = self.preview()
+        data = preview[~np.isnan(preview)]
+        if(not data.size): return 0,1
+        return napfit.filter_sigma(data)
+
+    def close(self,remove=True):
+        """
+        Release the memory maps. The mosaic files are deleted unless remove
+        is False.
+
+        """
+        self.sum.flush(); self.weight.flush()
+        del self.sum, self.weight
+        if(remove):
+            for suffix in ['_sum.npy','_weight.npy']:
+                try:
+                    os.remove(self.path + suffix)
+                except OSError:
+                    pass
@@ -0,0 +1,85 @@
+import pytest
+import numpy as np
+from scanbot.server.archive import scan_archive
+from scanbot.server.nanonis_sim import nanonis_sim
+from scanbot.server.scanbot_interface import scanbot_interface
+from scanbot.server import global_
+
+def scan(seed, shape=(32,48), dtype=np.float32):
+    return np.random.default_rng(seed).normal(size=shape).astype(dtype)
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_archive_round_trip(tmp_path, compress):
+    """
+    Test that scans and their metadata read back exactly, in the same format
+    as the pickles from pklDict, after the archive is reopened
+    """
+    archive = scan_archive(str(tmp_path / "survey.scans"), compress=compress, chunkSize=10000)
+    for n in range(4):
+        archive.append(scan(n), "C:/data/im" + str(n) + ".sxm", 1e-9*n, 2e-9, 20e-9, 20e-9, 0, 48, 32, comments="scanbot")
+    archive.close()
+
+    chunks = sorted(p.name for p in (tmp_path / "survey.scans").glob("chunk_*.bin"))
+    if(not compress): assert len(chunks) == 4                                   # 6 kB scans don't share a 10 kB chunk
+
+    reopened = scan_archive(str(tmp_path / "survey.scans"))
+    assert len(reopened) == 4
+    record = reopened[2]
+    assert record["sxm"] == "im2.sxm"
+    assert (record["x"], record["pixels"], record["lines"], record["comments"]) == (2e-9, 48, 32, "scanbot")
+    assert record["data"].dtype == np.float32
+    np.testing.assert_array_equal(record["data"], scan(2))
+    if(not compress): assert isinstance(record["data"], np.memmap)
+    assert reopened.find("im3.sxm") == 3
+
+def test_archive_recovers_from_partial_write(tmp_path):
+    """
+    Test that a half written index line is dropped and that appending after
+    reopening still works
+    """
+    path = tmp_path / "survey.scans"
+    archive = scan_archive(str(path))
+    archive.append(scan(0), "im0.sxm", 0, 0, 1, 1, 0, 48, 32)
+    archive.close()
+    with open(path / "index.jsonl", "a") as f:
+        f.write('{"sxm": "im1.sx')
+
+    archive = scan_archive(str(path))
+    assert len(archive) == 1
+    archive.append(scan(1,(16,16),np.float64), "im1.sxm", 0, 0, 1, 1, 0, 16, 16)
+    archive.close()
+
+    reopened = scan_archive(str(path))
+    assert [record["sxm"] for record in reopened] == ["im0.sxm","im1.sxm"]
+    np.testing.assert_array_equal(reopened[1]["data"], scan(1,(16,16),np.float64))
+
+def test_survey_that_raises_uploads_its_scans(tmp_path):
+    """
+    Test that a survey that fails part way still closes its archive and
+    uploads the scans that finished
+    """
+    (tmp_path / "scanbot_config.ini").write_text("scp_path=user@host:scans\n")
+    with nanonis_sim(ports=[0,0], timeScale=200, lineTime=0.1, pixels=64, lines=64, seed=1) as sim:
+        interface = scanbot_interface(run_mode='c', module_dir=str(tmp_path) + '/')
+        interface.IP       = sim.IP
+        interface.portList = sim.ports
+
+        uploads = []
+        interface.uploadToCloud = uploads.append
+        getMetaData,calls = interface.scanbot.getMetaData,[]
+        def failing(filePath):
+            calls.append(filePath)
+            if(len(calls) == 2): raise OSError("Connection lost")               # Second frame
+            return getMetaData(filePath)
+        interface.scanbot.getMetaData = failing
+
+        assert not interface.survey(["-n=2", "-xy=20e-9", "-st=0"])
+        global_.tasks.join(60)
+        assert not global_.tasks.is_alive()
+        interface.uploader.close(wait=False)
+        interface.scheduler.close()
+        interface.config.close()
+        interface.scanbot.pool.close()
+
+    assert len(uploads) == 1
+    assert len(scan_archive(uploads[0])) == 1
@@ -0,0 +1,125 @@
+import pytest
+import numpy as np
+import time
+import cv2
+from scanbot.server.camera import camera_stream, tip_tracker
+from scanbot.server import utilities
+
+class fakeCapture():
+    """
+    Stands in for cv2.VideoCapture. Frame i is filled with the value i and
+    the capture ends after a fixed number of frames
+    """
+    def __init__(self, frames=100, shape=(24,32,3), fps=0):
+        self.frames   = frames
+        self.shape    = shape
+        self.fps      = fps
+        self.count    = 0
+        self.released = False
+
+    def read(self, image=None):
+        if(self.count >= self.frames): return False, None
+        if(image is None): image = np.empty(self.shape, dtype=np.uint8)
+        image[...] = self.count % 256
+        self.count += 1
+        return True, image
+
+    def get(self, prop):
+        return self.fps
+
+    def release(self):
+        self.released = True
+
+def tipFrame(col, row, shape=(480,640)):
+    """
+    Camera frame with a tip coming down from the top with its apex at
+    (col, row) on a dark background
+    """
+    frame = np.full(shape + (3,), 20, dtype=np.uint8)
+    cv2.fillPoly(frame, [np.array([[col - 40,0],[col + 40,0],[col,row]])], (230,230,230))
+    return frame
+
+def test_boxcar_average():
+    """
+    Test that the running average covers exactly the last n frames that have
+    been read and that the caller's buffer is reused
+    """
+    cap = fakeCapture(frames=40)
+    stream = camera_stream(cap, size=16, average=5)
+    while(stream.isOpened()): stream.read()                                     # Drain the stream
+
+    out = np.zeros((24,32,3), dtype=np.float32)
+    average = stream.averaged(out=out)
+    assert average is out
+    assert average == pytest.approx(np.mean([35,36,37,38,39]))
+    assert stream.latest()[0] == 40
+    assert (stream.latest()[1] == 39).all()
+    assert not stream.latest()[1].flags.writeable                               # Views into the ring buffer can't be drawn on
+    stream.release()
+    assert cap.released
+
+def test_stream_is_a_video_capture():
+    """
+    Test that the stream can be handed to the existing tip tracking helpers
+    in place of a cv2.VideoCapture
+    """
+    stream = camera_stream(fakeCapture(frames=30, fps=200), replaySpeed=1)
+    ret,frame = utilities.getAveragedFrame(stream, n=3)
+    assert ret and frame.dtype == np.float32 and frame.shape == (24,32,3)
+    ret,frame = utilities.getAveragedFrame(stream, n=100)                       # More frames than there are
+    assert not ret and not stream.isOpened()
+    stream.release()
+
+def test_replay_is_paced():
+    """
+    Test that video files are played back at a multiple of their frame rate
+    and that fresh() skips frames from before a move
+    """
+    stream = camera_stream(fakeCapture(frames=1000, fps=50), replaySpeed=2)     # 100 frames per second
+    seq = stream.wait()
+    fresh = stream.fresh()
+    assert fresh == seq + 10
+    start = time.time()
+    assert stream.wait(fresh) > fresh
+    assert 0.05 < time.time() - start < 0.5
+    stream.release()
+
+def test_tip_tracker_follows_tip_in_roi():
+    """
+    Test that a moving tip is tracked from the ROI alone, that the result
+    agrees with the full frame trackTip and that the ROI is much smaller
+    than the frame
+    """
+    initialFrame = np.full((480,640,3), 20, dtype=np.float32)
+    tracker = tip_tracker(initialFrame, [200,150])
+    for step in range(40):
+        col,row = 200 + 4*step, 150 + 2*step
+        frame = tipFrame(col, row)
+        tipPos = tracker.update(lambda region: frame[region])
+        assert tipPos == pytest.approx([col,row], abs=1)
+
+    full = utilities.trackTip(utilities.backgroundDifference(initialFrame, frame), tipPos)
+    assert tipPos == pytest.approx(full, abs=1)
+    assert tracker.searches == 0
+    rows,cols = tracker.roi
+    assert (rows.stop - rows.start)*(cols.stop - cols.start) < 0.1*480*640
+
+def test_tip_tracker_falls_back_to_full_frame():
+    """
+    Test that the whole frame is searched when the tip isn't in the ROI,
+    that it's picked up again after a jump and that a blank frame loses it
+    """
+    initialFrame = np.full((480,640,3), 20, dtype=np.float32)
+    tracker = tip_tracker(initialFrame, [200,150])
+    frame = tipFrame(200, 150)
+    assert tracker.update(lambda region: frame[region]) == pytest.approx([200,150], abs=1)
+
+    frame = tipFrame(450, 350)                                                  # Jumped well outside the ROI
+    assert tracker.update(lambda region: frame[region]) is None
+    assert tracker.lost == 1 and tracker.searches == 1
+    assert tracker.update(lambda region: frame[region]) == pytest.approx([450,350], abs=1)
+    assert tracker.lost == 0
+
+    blank = np.full((480,640,3), 20, dtype=np.uint8)
+    for i in range(3): assert tracker.update(lambda region: blank[region]) is None
+    assert tracker.lost == 3
@@ -0,0 +1,128 @@
+import pytest
+import threading
+from types import SimpleNamespace
+from nanonisTCP import nanonisTCP
+from nanonisTCP.Bias import Bias
+from scanbot.server.nanonis_sim import nanonis_sim
+from scanbot.server.connection_pool import connection_pool
+from scanbot.server.scanbot_interface import scanbot_interface
+
+@pytest.fixture
+def sim():
+    with nanonis_sim(ports=[0,0], timeScale=200, coverage=0) as sim:
+        yield sim
+
+@pytest.fixture
+def pool(sim):
+    pool = connection_pool(nanonisTCP, waitTimeout=0.5)
+    pool.reconnectDelay = 0
+    yield pool
+    pool.close()
+
+def inThread(target):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(target()))
+    thread.start()
+    thread.join(5)
+    return result[0]
+
+def test_reentrant_lease(sim, pool):
+    """
+    Test that a thread that already holds a session gets the same one back
+    and only gives it up after the outermost release
+    """
+    NTCP,error = pool.acquire(sim.IP, sim.ports)
+    assert not error
+    nested,error = pool.acquire(sim.IP, sim.ports)
+    assert nested is NTCP
+
+    pool.release(nested)
+    assert pool.metrics()["busy"] == 1                                          # Still held by the outer lease
+    pool.release(NTCP)
+    assert pool.metrics()["busy"] == 0 and pool.metrics()["idle"] == 1
+    assert pool.metrics()["nested"] == 1 and pool.metrics()["connects"] == 1
+
+def test_threads_get_different_ports(sim, pool):
+    """
+    Test that a second thread gets a session on another port, and that a
+    third has to wait and gives up when every port is busy
+    """
+    NTCP,_ = pool.acquire(sim.IP, sim.ports)
+
+    def lease():
+        other,error = pool.acquire(sim.IP, sim.ports)
+        port = other.PORT
+        third = inThread(lambda: pool.acquire(sim.IP, sim.ports))
+        pool.release(other)
+        return port,third
+
+    port,third = inThread(lease)
+    assert port != NTCP.PORT and port in sim.ports
+    assert third == [0,"No ports available"]
+    assert pool.metrics()["waits"] == 0                                         # Gave up rather than got a port after waiting
+    pool.release(NTCP)
+
+def test_broken_session_reopened(sim, pool):
+    """
+    Test that a session released as broken and a session whose socket was
+    closed under it are both reopened on the next lease
+    """
+    NTCP,_ = pool.acquire(sim.IP, sim.ports)
+    pool.release(NTCP, broken=True)
+    NTCP,_ = pool.acquire(sim.IP, sim.ports)
+    assert pool.metrics()["connects"] == 2
+    pool.release(NTCP)
+
+    NTCP.s.close()                                                              # Stale socket. Fails the health check
+    reopened,error = pool.acquire(sim.IP, sim.ports)
+    assert not error and reopened is NTCP
+    assert pool.metrics()["reconnects"] == 1
+    assert Bias(reopened).Get() == pytest.approx(sim.bias)                      # Usable again
+    pool.release(reopened)
+
+def test_nested_broken_release_deferred(sim, pool):
+    """
+    Test that a nested lease released as broken doesn't close the session
+    under the outer lease, and that it's reopened once the outer lease is
+    released
+    """
+    NTCP,_ = pool.acquire(sim.IP, sim.ports)
+    nested,_ = pool.acquire(sim.IP, sim.ports)
+    pool.release(nested, broken=True)
+    assert Bias(NTCP).Get() == pytest.approx(sim.bias)                          # Outer frame still has a working session
+    assert pool.metrics()["busy"] == 1
+
+    pool.release(NTCP)
+    assert pool.metrics()["busy"] == 0 and pool.metrics()["idle"] == 0
+    NTCP,error = pool.acquire(sim.IP, sim.ports)
+    assert not error and pool.metrics()["connects"] == 2
+    pool.release(NTCP)
+
+def test_dead_thread_lease_reclaimed(sim, pool):
+    """
+    Test that a session held by a thread that finished without releasing it
+    goes back to the pool
+    """
+    leaked = inThread(lambda: pool.acquire(sim.IP, sim.ports)[0])
+    assert pool.metrics()["busy"] == 1
+
+    NTCP,_ = pool.acquire(sim.IP, sim.ports)
+    assert NTCP is leaked
+    assert pool.metrics()["reclaimed"] == 1
+    pool.release(NTCP)
+
+def test_get_connections(sim, pool):
+    """
+    Test that get_connections reports the pool's metrics
+    """
+    NTCP,_ = pool.acquire(sim.IP, sim.ports)
+    pool.acquire(sim.IP, sim.ports)
+
+    interface = SimpleNamespace(scanbot=SimpleNamespace(pool=pool))
+    message = scanbot_interface.getConnections(interface, [])
+    assert "Ports:            " + str(sim.ports) in message
+    assert "Idle / busy:      0 / 1" in message
+    assert "Leases:           2 (1 nested, 0 reused)" in message
+    assert scanbot_interface.getConnections(interface, [], _help=True) == {}
+    pool.release(NTCP)
+    pool.release(NTCP)
@@ -0,0 +1,51 @@
+import pytest
+import sys
+from unittest import mock
+from scanbot.server import lazy
+
+def test_import_deferred_until_use():
+    """
+    Test that a lazy module isn't imported until something on it is used and
+    that the import is recorded
+    """
+    sys.modules.pop('colorsys', None)
+    colorsys = lazy.lazy_module('colorsys')
+    assert 'colorsys' not in sys.modules
+    assert "not loaded yet" in repr(colorsys)
+    assert "colorsys" in lazy.report().split("Not needed yet:")[1]
+
+    assert colorsys.rgb_to_hsv(1,0,0) == (0,1,1)
+    assert 'colorsys' in sys.modules
+    assert 'colorsys' in lazy.loads
+    assert "colorsys" not in lazy.report().split("Not needed yet:")[1]
+
+def test_patch_through_proxy():
+    """
+    Test that mock.patch on a lazy module's attribute patches the real module
+    """
+    json = lazy.lazy_module('json')
+    with mock.patch.object(json, 'dumps', lambda x: "patched"):
+        assert sys.modules['json'].dumps(1) == "patched"
+    assert json.dumps(1) == "1"
+
+def test_missing_module_raises_on_use():
+    """
+    Test that a module that isn't installed (e.g. an optional hook) doesn't
+    fail until it's used
+    """
+    missing = lazy.lazy_module('scanbot_hook_that_does_not_exist')
+    with pytest.raises(ImportError):
+        missing.run()
+    with pytest.raises(ImportError):                                            # Tried again each time
+        missing.run()
+
+def test_report_lists_stages():
+    """
+    Test that startup stages show up in the report
+    """
+    with lazy.stage("test stage"):
+        pass
+    lazy.mark("test mark", 0.25)
+    report = lazy.report()
+    assert "test stage:" in report
+    assert "test mark: 250 ms" in report
@@ -0,0 +1,88 @@
+import pytest
+import numpy as np
+from nanonisTCP import nanonisTCP
+from nanonisTCP.Scan import Scan
+from nanonisTCP.Motor import Motor
+from nanonisTCP.Current import Current
+from nanonisTCP.FolMe import FolMe
+from nanonisTCP.TipShaper import TipShaper
+from scanbot.server.nanonis_sim import nanonis_sim
+from scanbot.server import utilities
+
+@pytest.fixture
+def sim():
+    with nanonis_sim(ports=[0,0], timeScale=200, lineTime=0.1, pixels=64, lines=64, coverage=0) as sim:
+        yield sim
+
+@pytest.fixture
+def ntcp(sim):
+    connection = nanonisTCP(sim.IP, sim.ports[0])
+    yield connection
+    connection.close_connection()
+
+def test_scan(sim, ntcp):
+    """
+    Test that a scan fills in line by line, ends with a file path and that a
+    stopped scan ends without one
+    """
+    scan = Scan(ntcp)
+    scan.BufferSet(pixels=64, lines=64)
+    scan.PropsSet(series_name="test_")
+    scan.FrameSet(0, 0, 20e-9, 20e-9)
+
+    scan.Action('start', 'up')
+    timedOut,_,_ = scan.WaitEndOfScan(timeout=10)
+    _,partial,direction = scan.FrameDataGrab(14, 1)
+    assert timedOut
+    assert direction == "up"
+    assert np.isnan(partial[-1]).all() and not np.isnan(partial[0]).any()       # Rows are in the order they were scanned
+
+    timedOut,_,filePath = scan.WaitEndOfScan()
+    _,data,_ = scan.FrameDataGrab(14, 1)
+    assert not timedOut
+    assert filePath.endswith("test_001.sxm")
+    assert data.shape == (64,64) and not np.isnan(data).any()
+
+    scan.Action('start', 'down')
+    scan.Action('stop')
+    _,_,filePath = scan.WaitEndOfScan()
+    assert filePath == ""
+    assert sim.stats["commands"]["Scan.FrameDataGrab"] == 2
+
+def test_crash_and_retract(sim, ntcp):
+    """
+    Test that a crash keeps the current high until the tip has been
+    retracted far enough
+    """
+    sim.crashProbability = 1
+    motor,current = Motor(ntcp),Current(ntcp)
+
+    motor.StartMove("X+", 10, wait_until_finished=True)
+    assert current.Get() == pytest.approx(sim.crashCurrent)
+
+    steps = 0
+    while(abs(current.Get()) > 5e-9):
+        motor.StartMove("Z+", 50, wait_until_finished=True)
+        steps += 50
+        assert steps < 1000
+    assert steps >= 50
+
+def test_tip_shape_imprint(sim, ntcp):
+    """
+    Test that the tip shaper leaves an imprint that shows up in the next scan
+    and can be measured
+    """
+    scan,folme,tipShaper = Scan(ntcp),FolMe(ntcp),TipShaper(ntcp)
+    sim.tip = {"radius": 0.4e-9, "asymmetry": 0, "offset": 0}
+    scan.FrameSet(30e-9, 0, 10e-9, 10e-9)                                       # Between step edges
+    folme.XYPosSet(31e-9, 1e-9, Wait_end_of_move=True)
+    tipShaper.Start(wait_until_finished=True, timeout=-1)
+
+    scan.Action('start', 'down')
+    scan.WaitEndOfScan()
+    _,data,_ = scan.FrameDataGrab(14, 1)
+
+    row,col = np.unravel_index(np.argmax(data), data.shape)
+    assert abs(col - 38) <= 2 and abs(row - 25) <= 2                            # 1 nm right of and above the centre of a 10 nm frame
+    symmetry,size = utilities.assessTip(data, 10e-9, [0,0])
+    assert size > 0 and symmetry > 0.5
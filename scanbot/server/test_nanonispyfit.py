@@ -0,0 +1,70 @@
+import pytest
+import numpy as np
+from scanbot.server import nanonispyfit as napfit
+
+def tilted(shape, seed=0):
+    x, y = np.indices(shape)
+    noise = np.random.default_rng(seed).normal(0, 0.05, shape)
+    return 2.5 + 0.3*x - 0.07*y + noise
+
+@pytest.mark.parametrize("shape", [(64,64), (48,128), (128,48)])
+def test_plane_fit_matches_leastsq(shape):
+    """
+    Test that the closed-form plane fit agrees with the original iterative fit
+    for square and non-square frames
+    """
+    data   = tilted(shape)
+    legacy = data - napfit._return_plane(napfit._fitplane_leastsq(data), data)
+    fast   = napfit.plane_fit_2d(data)
+
+    assert np.allclose(fast, legacy, atol=1e-5)
+
+def test_plane_fit_ignores_nans():
+    """
+    Test that nan's (e.g. an incomplete frame) are excluded from the fit and
+    preserved in the output
+    """
+    data = tilted((64,64))
+    data[40:] = np.nan
+
+    flat = napfit.plane_fit_2d(data)
+
+    assert np.isnan(flat[40:]).all()
+    assert np.nanstd(flat) < 0.1
+
+def test_plane_fit_keeps_float32():
+    """
+    Test that float32 input isn't promoted
+    """
+    data = tilted((32,32)).astype(np.float32)
+    assert napfit.plane_fit_2d(data).dtype == np.float32
+
+@pytest.mark.parametrize("order", [1, 2, 3])
+def test_row_poly_fit_matches_polyfit(order):
+    """
+    Test that the batched row fit matches a per-row np.polyfit on a 
+    non-square frame
+    """
+    data = np.random.default_rng(1).normal(size=(40,70))
+    x    = np.arange(70)
+    ref  = np.array([row - np.polyval(np.polyfit(x,row,order),x) for row in data])
+
+    assert np.allclose(napfit.row_poly_fit(data, order=order), ref)
+
+def test_row_poly_fit_partial_rows():
+    """
+    Test that nan's in a row are ignored by that row's fit and that columns
+    can be flattened the same way as rows
+    """
+    data = np.random.default_rng(2).normal(size=(30,50))
+    data[5,10:30] = np.nan
+    data[7]       = np.nan
+
+    flat  = napfit.row_poly_fit(data, order=1)
+    valid = ~np.isnan(data[5])
+    x     = np.arange(50)[valid]
+    ref   = data[5,valid] - np.polyval(np.polyfit(x,data[5,valid],1),x)
+
+    assert np.allclose(flat[5,valid], ref)
+    assert np.isnan(flat[7]).all()
+    assert np.allclose(napfit.row_poly_fit(data, axis=0), napfit.row_poly_fit(data.T).T, equal_nan=True)
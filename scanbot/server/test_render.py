@@ -0,0 +1,56 @@
+import pytest
+import numpy as np
+import cv2
+import matplotlib
+from matplotlib import colors
+from scanbot.server import render
+
+def reference(data, vmin=None, vmax=None, cmap='inferno'):
+    """
+    What matplotlib draws for data (imshow/imsave): normalise, then map
+    through the colormap. Returned in BGR order
+    """
+    norm = colors.Normalize(vmin=vmin, vmax=vmax)
+    rgba = matplotlib.colormaps[cmap](norm(np.ma.masked_invalid(data)), bytes=True)
+    return rgba[:,:,2::-1]
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_matches_matplotlib(dtype):
+    """
+    Test that colourised data matches matplotlib's inferno pixel for pixel,
+    including values right on the edges of the colormap bins
+    """
+    rng  = np.random.default_rng(0)
+    data = (rng.normal(size=(128,128))*1e-10).astype(dtype)
+    lo,hi = data.min(),data.max()
+    data[0] = lo + (hi - lo)*np.arange(0,256,2)/256                             # Right on the bin edges
+    assert (render.colourise(data) == reference(data)).all()
+
+    vmin,vmax = np.percentile(data, [5,95])                                     # Saturated values
+    assert (render.colourise(data, vmin, vmax) == reference(data, vmin, vmax)).all()
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_nan_padded_frame(dtype):
+    """
+    Test that a partially scanned (nan padded) frame matches matplotlib where
+    there's data and is black where there isn't
+    """
+    rng  = np.random.default_rng(1)
+    data = rng.normal(size=(64,64)).astype(dtype)
+    data[40:] = np.nan
+
+    image = render.colourise(data)
+    assert (image[:40] == reference(data)[:40]).all()
+    assert (image[40:] == 0).all()
+
+def test_upscale_is_pixel_exact(tmp_path):
+    """
+    Test that upscaled pngs are exact blocks of the colourised pixels
+    """
+    data = np.random.default_rng(2).normal(size=(32,48))
+    filename = render.renderImage(str(tmp_path / "frame.png"), data, scale=3)
+
+    image = cv2.imread(filename)
+    assert image.shape == (96,144,3)
+    assert (image == np.repeat(np.repeat(reference(data), 3, axis=0), 3, axis=1)).all()
+    assert (cv2.imread(render.renderImage(str(tmp_path / "small.png"), data)) == reference(data)).all()
@@ -0,0 +1,101 @@
+import time
+import os
+from scanbot.server.scanbot_config import config_service, readConfig, scanbot_config
+
+def write(tmp_path, lines):
+    with open(tmp_path / "scanbot_config.ini", 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+def test_read_config(tmp_path):
+    """
+    Test that comments, blank lines and bad lines are skipped and that values
+    can contain '='
+    """
+    write(tmp_path, ["# comment", "", "ip=10.0.0.1", "not a setting", "scp_path=user@host:dir=1"])
+    values = readConfig(str(tmp_path / "scanbot_config.ini"))
+    assert values == {"ip": "10.0.0.1", "scp_path": "user@host:dir=1"}
+    assert readConfig(str(tmp_path / "missing.ini")) is None
+
+    sbConfig = scanbot_config(module_dir=str(tmp_path) + "/")
+    assert sbConfig.config["ip"][scanbot_config.value] == "10.0.0.1"
+
+def test_typed_values(tmp_path):
+    """
+    Test that values are converted to their types and that settings not in
+    the file take their defaults
+    """
+    write(tmp_path, ["port_list=6501, 6502", "safe_current=2e-9", "upload_method=path", "path=" + str(tmp_path / "data")])
+    config = config_service(str(tmp_path) + "/")
+    changed,error = config.reload()
+    assert not error
+    assert set(changed) == set(config_service.settings)                         # Everything is new the first time
+    assert config["port_list"] == [6501,6502]
+    assert config["safe_current"] == 2e-9
+    assert config["ip"] == "127.0.0.1"
+    assert config["path"].endswith("data/")
+
+def test_invalid_file_keeps_values(tmp_path):
+    """
+    Test that a file with a bad value is rejected as a whole
+    """
+    write(tmp_path, ["ip=10.0.0.1"])
+    config = config_service(str(tmp_path) + "/")
+    config.reload()
+
+    write(tmp_path, ["ip=10.0.0.2", "safe_current=lots"])
+    changed,error = config.reload(force=True)
+    assert "safe_current" in error and not changed
+    assert config["ip"] == "10.0.0.1"
+
+    write(tmp_path, ["upload_method=zulip"])
+    changed,error = config.reload(force=True)
+    assert "zuliprc" in error
+
+def test_watcher_applies_changed_keys(tmp_path):
+    """
+    Test that editing the file calls onChange with only the keys that
+    changed, without anything being reloaded when nothing changed
+    """
+    applied = []
+    write(tmp_path, ["ip=10.0.0.1", "safe_current=5e-9"])
+    config = config_service(str(tmp_path) + "/", onChange=applied.append)
+    config.interval = 0.05
+    config.reload()
+    config.watch()
+
+    mtime = config.mtime
+    write(tmp_path, ["ip=10.0.0.1", "safe_current=1e-9"])
+    os.utime(tmp_path / "scanbot_config.ini", ns=(mtime + 10**9, mtime + 10**9)) # Make sure the modification time moves on coarse clocks
+
+    start = time.time()
+    while(len(applied) < 2 and time.time() - start < 5): time.sleep(0.01)
+    config.close()
+
+    assert applied[1] == ["safe_current"]
+    assert config["safe_current"] == 1e-9
+    assert config.reload() == ([],"")                                           # Not modified since
+
+def test_failed_apply_keeps_values(tmp_path):
+    """
+    Test that values onChange couldn't apply aren't kept, and that a forced
+    reload tries them again
+    """
+    applied,failing = [],[]
+    def onChange(changed):
+        if(failing): raise IOError("zuliprc not found")
+        applied.append(changed)
+
+    write(tmp_path, ["safe_current=1e-9"])
+    config = config_service(str(tmp_path) + "/", onChange=onChange)
+    config.reload()
+
+    failing.append(True)
+    write(tmp_path, ["safe_current=3e-9"])
+    changed,error = config.reload(force=True)
+    assert "zuliprc not found" in error and not changed
+    assert config["safe_current"] == 1e-9                                       # Still what was applied
+
+    failing.clear()
+    changed,error = config.reload(force=True)
+    assert not error and changed == ["safe_current"]
+    assert applied[-1] == ["safe_current"] and config["safe_current"] == 3e-9
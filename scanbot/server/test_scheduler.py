@@ -0,0 +1,108 @@
+import pytest
+import threading
+import time
+from scanbot.server import global_
+from scanbot.server.scheduler import job_scheduler
+
+@pytest.fixture
+def scheduler(tmp_path):
+    global_.running = threading.Event()
+    global_.pause   = threading.Event()
+    started = []
+    gates   = {}
+
+    def routine(command):
+        gates[command].wait(5)
+        global_.running.clear()                                                 # Routines free up the running flag when they finish
+
+    def launcher(command,user_args):
+        started.append(command)
+        gates[command] = threading.Event()
+        return s.start(lambda: routine(command),command,user_args)
+
+    s = job_scheduler(launcher,path=str(tmp_path / "jobs.json"))
+    s.started = started
+    s.gates   = gates
+    yield s
+    for gate in gates.values(): gate.set()
+    s.close()
+
+def wait_for(condition,timeout=5):
+    start = time.time()
+    while(not condition()):
+        assert time.time() - start < timeout
+        time.sleep(0.01)
+
+def test_queue_runs_by_priority(scheduler):
+    """
+    Test that queued jobs run one at a time, highest priority first
+    """
+    scheduler.pauseQueue(True)
+    low  = scheduler.submit("survey",["-n=2"])
+    high = scheduler.submit("zdep",[],priority=5)
+    scheduler.pauseQueue(False)
+
+    wait_for(lambda: scheduler.started == ["zdep"])
+    assert scheduler.status(high)["status"] == "running"
+    assert scheduler.status(low)["status"]  == "queued"
+
+    scheduler.gates["zdep"].set()
+    wait_for(lambda: scheduler.started == ["zdep","survey"])
+    assert scheduler.status(high)["status"] == "done"
+
+    scheduler.gates["survey"].set()
+    wait_for(lambda: scheduler.status(low)["status"] == "done")
+
+def test_busy_instrument_rejects_adhoc_jobs(scheduler):
+    """
+    Test that a routine started directly still gets an error while another
+    routine holds the instrument
+    """
+    gate  = threading.Event()
+    error = scheduler.start(lambda: gate.wait(5),"survey",[])
+    assert error is None
+    assert scheduler.start(lambda: None,"zdep",[]) == "Error: something already running"
+    gate.set()
+
+def test_queue_is_restored_held(scheduler,tmp_path):
+    """
+    Test that queued jobs are saved and come back held after a restart
+    """
+    scheduler.pauseQueue(True)
+    scheduler.submit("bias_dep",["-n=3"],priority=2)
+
+    restored = job_scheduler(lambda command,user_args: None,path=str(tmp_path / "jobs.json"))
+    jobs = restored.queued()
+    restored.close()
+
+    assert [(job["command"],job["args"],job["priority"],job["status"]) for job in jobs] == [("bias_dep",["-n=3"],2,"held")]
+
+def test_status_while_launching(tmp_path):
+    """
+    Test that the queue can be read and changed while the launcher is still
+    busy (e.g. sending a reply over the network)
+    """
+    global_.running = threading.Event()
+    global_.pause   = threading.Event()
+    launching = threading.Event()
+    release   = threading.Event()
+
+    def launcher(command,user_args):
+        launching.set()
+        release.wait(5)
+        return "Error: no routine started"
+
+    s = job_scheduler(launcher,path=str(tmp_path / "jobs.json"))
+    slow  = s.submit("survey",[])
+    other = s.submit("zdep",[])
+    assert launching.wait(5)
+
+    start = time.time()
+    assert s.status(slow)["status"] == "running"
+    assert s.cancel(other) == "queued"
+    assert time.time() - start < 1                                              # Didn't wait for the launcher
+
+    release.set()
+    wait_for(lambda: s.status(slow)["status"] == "failed")
+    assert s.status(slow)["error"] == "Error: no routine started"
+    s.close()
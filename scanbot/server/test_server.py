@@ -253,6 +253,34 @@ def test_save_config(client,tmp_path):
     
     config_saved = os.path.isfile(tmp_path / "scanbot_config.ini")
     assert config_saved
+    assert not os.path.exists(tmp_path / "scanbot_config.ini.tmp")              # Written to the side and moved into place
+
+def test_save_config_in_place(client,tmp_path):
+    """
+    Test that saving the config applies the changes without restarting the
+    interface and that an invalid config is rejected
+    """
+    from scanbot.server.server import scanbot
+
+    scheduler = scanbot.scheduler
+    config = [{"parameter": "safe_current",
+               "value": ['Crash Current (A)', '', 'safety', '2e-9']},
+              {"parameter": "port_list",
+               "value": ['TCP Ports', '', 'tcp', '6501,6502']}]
+    start = time.time()
+    response = client.post('/save_config', json={"config":config})
+    assert response.status_code == 200
+    assert time.time() - start < 0.5
+    assert scanbot.scheduler is scheduler                                       # Not restarted
+    assert scanbot.scanbot.safeCurrent == 2e-9
+    assert scanbot.portList == [6501,6502]
+
+    config[0]["value"][3] = "lots"
+    response = client.post('/save_config', json={"config":config})
+    assert response.status_code == 400
+    assert scanbot.scanbot.safeCurrent == 2e-9
+    with open(tmp_path / "scanbot_config.ini") as f:
+        assert "safe_current=2e-9" in f.read().splitlines()                     # The valid file wasn't overwritten
 
 def test_run_survey(client,tmp_path):
     """
@@ -337,3 +365,58 @@ def test_run_bias_dep(client):
 
     filename = content_disposition.split('filename=')[1].strip('"')
     assert filename.endswith('.gif')
+    assert response.data.startswith(b'GIF89a')
+    
+    response = client.get('/get_gif', headers={"Range": "bytes=0-5"})        # The animation is served from disk so partial downloads work
+    assert response.status_code == 206
+    assert response.data == b'GIF89a'
+
+def test_gif_served_while_running(client,tmp_path):
+    """
+    Test that a new animation replaces the previous run's and that the GIF is
+    served from disk as soon as it has a frame
+    """
+    from scanbot.server.server import scanbot
+
+    stale = tmp_path / "stale.gif"
+    stale.write_bytes(b'GIF89a stale')
+    scanbot.animationPath = str(stale)
+
+    writer = scanbot.scanbot.newAnimation("running",makeGIF=1)
+    assert scanbot.animationPath == writer.path
+    assert client.get('/get_gif').status_code == 404                            # Nothing appended yet
+
+    writer.append(np.zeros((16,16,3),dtype=np.uint8))
+    response = client.get('/get_gif')
+    assert response.status_code == 200
+    assert response.data.startswith(b'GIF89a') and response.data.endswith(b';')
+
+    assert scanbot.scanbot.newAnimation("off",makeGIF=0) is None
+    assert scanbot.animationPath == ""
+
+def test_image_stream(client):
+    """
+    Test that published images are pushed to the event stream and can be
+    downloaded by sequence number
+    """
+    from scanbot.server.server import scanbot
+
+    png = cv2.imencode('.png', np.zeros((8,8,3),dtype=np.uint8))[1].tobytes()
+    seq = scanbot.imageFeed.publish('stream_test.png', png, {"size": "1.0"})
+
+    response = client.get('/image_stream?after=' + str(seq-1), buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+
+    events = ""
+    for chunk in response.response:
+        events += chunk.decode() if isinstance(chunk, bytes) else chunk
+        if('event: image' in events): break
+    response.close()
+
+    assert 'id: ' + str(seq) in events
+    assert '"filename": "stream_test.png"' in events
+
+    response = client.get('/get_image/' + str(seq))
+    assert response.status_code == 200
+    assert response.data == png
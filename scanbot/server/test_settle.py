@@ -0,0 +1,64 @@
+import pytest
+import numpy as np
+import time
+from scipy import ndimage
+from scanbot.server import settle
+
+def creepScan(amplitude, lines=128, seed=0):
+    """
+    Scan of a random surface where each line is shifted a bit more than the
+    last, by an amount that decays like piezo creep
+    """
+    rng     = np.random.default_rng(seed)
+    surface = ndimage.gaussian_filter(rng.normal(size=(lines + 200,400)), 2)
+    shift   = np.cumsum(amplitude*np.exp(-np.arange(lines)/15))
+    x       = np.arange(400)
+    scan    = np.array([np.interp(np.arange(lines) + 100 + s, x, surface[100 + i]) for i,s in enumerate(shift)])
+    return scan + rng.normal(scale=0.02, size=scan.shape)
+
+def test_wait_for_stable_returns_early():
+    """
+    Test that the wait ends as soon as the signal stops changing rather than
+    at the timeout
+    """
+    start = time.time()
+    read  = lambda: 1e-9*np.exp(-(time.time() - start)/0.05)                    # Settles within ~0.3 s
+
+    stable,value = settle.waitForStable(read, 1e-12, timeout=5, interval=0.01)
+    assert stable
+    assert value == pytest.approx(0, abs=5e-12)
+    assert time.time() - start < 1
+
+def test_wait_for_stable_falls_back_to_fixed_sleep():
+    """
+    Test that a signal that can't be read is replaced by the fixed sleep and
+    one that never settles times out
+    """
+    def read(): raise ConnectionError("gone")
+
+    start = time.time()
+    assert settle.waitForStable(read, 1, timeout=5, fallback=0.2) == (False, None)
+    assert 0.2 <= time.time() - start < 1
+
+    noisy = np.random.default_rng(0)
+    stable,_ = settle.waitForStable(lambda: noisy.normal(), 0.01, timeout=0.2, interval=0.01)
+    assert not stable
+
+def test_creep_settled():
+    """
+    Test that creep is seen in the lines scanned after a frame move, that a
+    clean scan can be kept and that unscanned (nan) lines are ignored
+    """
+    creep = creepScan(1.5)
+    clean = creepScan(0)
+
+    assert settle.lineShifts(creep)[0] == pytest.approx(-1.5, abs=0.5)
+    assert settle.creepSettled(creep[:32]) == (None, 0)                         # Not enough lines to tell
+    assert settle.creepSettled(creep[:48])[0] is False
+    settled,lines = settle.creepSettled(creep)
+    assert settled and lines > 0
+    assert settle.creepSettled(clean) == (True, 0)
+
+    partial = np.full_like(clean, np.nan)
+    partial[-64:] = clean[-64:]                                                 # Scanning up: the bottom lines come first
+    assert settle.creepSettled(partial) == (True, 0)
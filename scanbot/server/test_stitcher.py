@@ -0,0 +1,48 @@
+import numpy as np
+from scipy import ndimage
+from scanbot.server.stitcher import mosaic
+
+def surface(shape=(96,160), seed=0):
+    return ndimage.gaussian_filter(np.random.default_rng(seed).normal(size=shape), 3)
+
+def test_frames_are_placed_by_coordinates(tmp_path):
+    """
+    Test that overlapping frames taken in any order land back on the surface
+    they were cut from
+    """
+    truth  = surface()
+    frames = [[-1.5e-9, 2e-9, 8e-9, 8e-9], [1.5e-9, 2e-9, 8e-9, 8e-9],             # 64 px frames at 1 px = 0.125 nm, offset by 24 px
+              [1.5e-9,-2e-9, 8e-9, 8e-9], [-1.5e-9,-2e-9, 8e-9, 8e-9]]          # Snaked, like a survey
+
+    stitcher = mosaic(str(tmp_path / "m"), frames, 64, 64, flatten="none")
+    assert stitcher.shape == (96, 88)
+    for x,y,w,h in frames:
+        row = int(round((6e-9 - (y + h/2))/0.125e-9))
+        col = int(round((x - w/2 + 5.5e-9)/0.125e-9))
+        stitcher.add(truth[row:row+64, col:col+64], x, y, w, h)
+
+    stitched = stitcher.downsample(1)
+    stitcher.close()
+
+    expected = truth[:,:88] - np.median(truth[:64,:64])                         # Each tile is levelled by its median
+    assert not np.isnan(stitched).any()
+    assert np.corrcoef(stitched.ravel(), expected.ravel())[0,1] > 0.99
+
+def test_preview_and_pyramid(tmp_path):
+    """
+    Test the preview is downsampled and the pyramid halves down to one tile
+    """
+    frames = [[x*10e-9, 0, 10e-9, 10e-9] for x in range(3)]
+    stitcher = mosaic(str(tmp_path / "m"), frames, 200, 100, flatten="plane")
+    for n,frame in enumerate(frames):
+        stitcher.add(surface((100,200), n), *frame)
+
+    assert stitcher.shape == (100, 600)
+    assert stitcher.preview(maxSize=300).shape == (50, 300)
+
+    info = stitcher.pyramid(str(tmp_path / "pyramid"), tileSize=128)
+    stitcher.close()
+
+    assert [(level["rows"], level["cols"]) for level in info["levels"]] == [(100,600), (50,300), (25,150), (13,75)]
+    assert (tmp_path / "pyramid" / "0" / "0_4.png").exists()
+    assert not (tmp_path / "m_sum.npy").exists()
@@ -0,0 +1,88 @@
+import pytest
+import numpy as np
+import time
+from nanonisTCP import nanonisTCP
+from nanonisTCP.Current import Current
+from scanbot.server.nanonis_sim import nanonis_sim
+from scanbot.server.connection_pool import connection_pool
+from scanbot.server.tip_control import tip_controller
+
+class fakeScanbot():
+    """
+    The parts of scanbot the controller uses, against the simulator
+    """
+    zMinF,zMaxF,zMinV,zMaxV     = 500, 2500, 1, 300
+    xyMinF,xyMaxF,xyMinV,xyMaxV = 500, 2500, 1, 200
+    safeCurrent = 5e-9
+
+    def __init__(self, sim):
+        self.sim      = sim
+        self.pool     = connection_pool(nanonisTCP)
+        self.retracts = 0
+
+    def connect(self):
+        return self.pool.acquire(self.sim.IP, self.sim.ports)
+
+    def disconnect(self, NTCP):
+        self.pool.release(NTCP)
+
+    def safeCurrentCheck(self, NTCP):
+        self.retracts += 1
+        return abs(Current(NTCP).Get()) < self.safeCurrent
+
+def camera(sim):
+    """
+    Where the tip shows up on the camera for the simulator's motor position:
+    half a pixel per step sideways and a fifth of a pixel per step up
+    """
+    with sim.lock:
+        x,_,z = sim.motorPos
+    return np.array([100 + 0.5*x, 300 - 0.2*z])
+
+def drive(controller, sim, timeout=20):
+    """
+    Stand in for the tracking loop. Report the tip position every few ms
+    """
+    frames = [0]
+    controller.fresh = lambda: frames[0]
+    controller.start()
+    start = time.time()
+    while(not controller.done.is_set() and time.time() - start < timeout):
+        frames[0] += 1
+        controller.observe(camera(sim), frames[0])
+        time.sleep(0.005)
+    return controller.stop()
+
+def test_controller_reaches_target():
+    """
+    Test that the tip goes up first, then across, that the target is hit and
+    that measuring the step size makes it take far fewer moves than fixed
+    steps would
+    """
+    with nanonis_sim(ports=[0,0], timeScale=20, coverage=0) as sim:
+        scanbot = fakeScanbot(sim)
+        controller = tip_controller(scanbot, [250,280], xStep=20, zStep=20, xV=100, zV=100, xF=1000, zF=1000)
+        assert drive(controller, sim) == "hit"
+        scanbot.pool.close()
+
+    tipPos = camera(sim)
+    assert tipPos[1] <= 280 and abs(tipPos[0] - 250) <= controller.tolerance
+    assert controller.moves[0][0] == "Z+"
+    assert controller.pxPerStep["X+"] == pytest.approx(0.5, rel=0.1)
+    sideways = [move for move in controller.moves if move[0] != "Z+" or move[1] != controller.liftSteps]
+    assert len(sideways) < 10                                                   # 20 with fixed steps (100 up and 300 across in 20s)
+
+def test_controller_stops_on_crash():
+    """
+    Test that a crash during a sideways move is picked up while the motors
+    are still moving, stops them part way and ends in the safe retract
+    """
+    with nanonis_sim(ports=[0,0], timeScale=1, coverage=0, crashProbability=1) as sim:
+        sim.zOn = False
+        scanbot = fakeScanbot(sim)
+        controller = tip_controller(scanbot, [250,300], xStep=200, zStep=20, xV=100, zV=100, xF=500, zF=500)
+        assert drive(controller, sim) == "crash"
+        assert controller.moves[-1] == ("X+",200)
+        assert 0 <= sim.motorPos[0] < 200                                       # Stopped before all 200 steps were taken
+        assert scanbot.retracts == 1
+        scanbot.pool.close()
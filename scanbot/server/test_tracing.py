@@ -0,0 +1,90 @@
+import pytest
+import threading
+import time
+from nanonisTCP import nanonisTCP
+from nanonisTCP.Scan import Scan
+from scanbot.server.nanonis_sim import nanonis_sim
+from scanbot.server.tracing import span_tracer
+from scanbot.server import workers
+
+def test_job_phases():
+    """
+    Test that time is split by the outermost spans on the job's thread and
+    that nested spans aren't counted twice
+    """
+    tracer = span_tracer()
+    with tracer.job(1,"survey"):
+        tracer.sleep(0.05)
+        with tracer.span("classify","analysis"):
+            with tracer.span("update","analysis"):
+                time.sleep(0.02)
+        time.sleep(0.02)
+
+    job = tracer.summary()[1]
+    assert job["command"] == "survey"
+    assert job["phases"]["sleep"]    == pytest.approx(0.05, abs=0.02)
+    assert job["phases"]["analysis"] == pytest.approx(0.02, abs=0.02)
+    assert job["phases"]["other"]    == pytest.approx(0.02, abs=0.02)
+    assert sum(job["phases"].values()) == pytest.approx(job["wall"])
+    assert job["spans"]["update"]["count"] == 1
+
+def test_background_work_belongs_to_job():
+    """
+    Test that work handed to a background pool is counted against the job
+    that submitted it, separately from the job's own phases
+    """
+    tracer = span_tracer()
+    pool = workers.bounded_pool(workers=1)
+    with tracer.job(7,"bias_dep"):
+        future = pool.executor.submit(tracer.bind(tracer.traced("render","makePNG")(time.sleep)),0.03)
+        future.result()
+    threading.Thread(target=tracer.traced("render","makePNG")(time.sleep),args=(0.01,)).start() # No job. Not counted
+
+    job = tracer.summary()[7]
+    assert job["background"]["render"] == pytest.approx(0.03, abs=0.02)
+    assert "render" not in job["phases"]
+    pool.shutdown()
+
+def test_tcp_round_trips():
+    """
+    Test that round trips over an instrumented session are recorded by
+    command and that waiting on a scan is its own category
+    """
+    tracer = span_tracer()
+    with nanonis_sim(ports=[0], timeScale=200, lineTime=0.1, pixels=32, lines=32, coverage=0) as sim:
+        NTCP = tracer.instrument(nanonisTCP(sim.IP, sim.ports[0]))
+        scan = Scan(NTCP)
+        with tracer.job(2,"survey"):
+            scan.Action('start', 'up')
+            scan.WaitEndOfScan()
+            scan.FrameDataGrab(14, 1)
+        NTCP.close_connection()
+
+    job = tracer.summary(2)[2]
+    assert set(job["spans"]) == {"Scan.Action", "Scan.WaitEndOfScan", "Scan.FrameDataGrab"}
+    assert job["spans"]["Scan.WaitEndOfScan"]["category"] == "scan"
+    assert job["phases"]["scan"] > job["phases"]["tcp"]
+
+    events = tracer.chromeTrace(2)["traceEvents"]
+    assert sum(event["ph"] == "X" for event in events) == 4                     # Three round trips and the job itself
+
+def test_get_trace_job_ids():
+    """
+    Test that get_trace reports the job asked for, falls back to the most
+    recent job only for -job=-1 and says so when a job doesn't exist
+    """
+    from unittest.mock import patch
+    from types import SimpleNamespace
+    from scanbot.server.scanbot_interface import scanbot_interface
+
+    tracer = span_tracer()
+    for jobID,command in [(1,"survey"),(2,"zdep")]:
+        with tracer.job(jobID,command):
+            tracer.sleep(0.01)
+
+    interface = scanbot_interface.__new__(scanbot_interface)                    # Only the scheduler is needed
+    interface.scheduler = SimpleNamespace(current=None)
+    with patch('scanbot.server.scanbot_interface.tracing.tracer', tracer):
+        assert interface.getTrace(["-job=1"]).startswith("Job 1: survey")
+        assert interface.getTrace(["-job=-1"]).startswith("Job 2: zdep")
+        assert interface.getTrace(["-job=5"]) == "No trace for job 5"
@@ -0,0 +1,78 @@
+import pytest
+import threading
+from scanbot.server.uploader import upload_service
+
+def make_file(tmp_path, name, content=b"png"):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+@pytest.fixture
+def sent():
+    return []
+
+def test_files_are_sent_in_batches(tmp_path, sent):
+    """
+    Test that files going to the same place are handed to the sender
+    together and removed from the spool once they're uploaded
+    """
+    def sender(method, destination, items):
+        sent.append((method, destination, sorted(item["filename"] for item in items)))
+        return []
+
+    uploader = upload_service(str(tmp_path / "spool"), sender, batchWindow=60)
+    for n in range(5):
+        uploader.enqueue(make_file(tmp_path, "im" + str(n) + ".png"), "path", destination="out/")
+    uploader.enqueue(make_file(tmp_path, "data.pkl"), "scp", destination="host:db")
+
+    assert uploader.flush(timeout=5)
+    uploader.close()
+
+    assert sorted(sent) == [("path", "out/", ["im0.png","im1.png","im2.png","im3.png","im4.png"]),
+                            ("scp", "host:db", ["data.pkl"])]
+    assert sorted(p.name for p in (tmp_path / "spool").iterdir()) == []
+
+def test_failed_uploads_are_retried(tmp_path, sent):
+    """
+    Test that an upload that fails is retried after a backoff and given up on
+    after maxAttempts
+    """
+    def sender(method, destination, items):
+        sent.append(items[0]["filename"])
+        if(items[0]["filename"] == "bad.png"): raise Exception("network down")
+        if(sent.count("flaky.png") < 2): return items
+        return []
+
+    gaveUp = threading.Event()
+    uploader = upload_service(str(tmp_path / "spool"), sender, batchWindow=0, backoff=0.01,
+                              maxAttempts=3, onFailure=lambda item: gaveUp.set())
+    uploader.enqueue(make_file(tmp_path, "flaky.png"), "zulip")
+    uploader.enqueue(make_file(tmp_path, "bad.png"), "firebase")
+
+    assert gaveUp.wait(5)
+    assert uploader.flush(timeout=5)
+    uploader.close()
+
+    assert sent.count("flaky.png") == 2
+    assert sent.count("bad.png")   == 3
+    failed = list((tmp_path / "spool" / "failed").iterdir())
+    assert [(p / "bad.png").read_bytes() for p in failed] == [b"png"]
+
+def test_spool_survives_restart(tmp_path, sent):
+    """
+    Test that files still waiting when the service stops are uploaded when it
+    starts again
+    """
+    uploader = upload_service(str(tmp_path / "spool"), lambda method, destination, items: items, batchWindow=60)
+    uploader.enqueue(make_file(tmp_path, "im.png", b"data"), "path", destination="out/", notify=True)
+    uploader.close()
+
+    def sender(method, destination, items):
+        sent.extend((item["filename"], item["destination"], item["notify"], open(item["file"], "rb").read()) for item in items)
+        return []
+
+    restored = upload_service(str(tmp_path / "spool"), sender)
+    assert restored.flush(timeout=5)
+    restored.close()
+
+    assert sent == [("im.png", "out/", True, b"data")]
@@ -0,0 +1,153 @@
+import pytest
+import numpy as np
+from scipy import ndimage
+from scanbot.server import utilities
+
+def surface(shape=(160,160), seed=0):
+    return ndimage.gaussian_filter(np.random.default_rng(seed).normal(size=shape), 2)
+
+@pytest.mark.parametrize("dy,dx", [(0,0), (4,0), (0,-5), (-3,6)])
+def test_frame_offset(dy, dx):
+    """
+    Test that the drift between two frames is recovered with the same sign
+    convention as the original correlate2d implementation (ox = -dx, oy = dy)
+    """
+    base  = surface()
+    moved = np.roll(base, (dy,dx), axis=(0,1))
+
+    ox,oy = utilities.getFrameOffset(base[16:-16,16:-16], moved[16:-16,16:-16], dxy=[2,3])
+
+    assert ox == pytest.approx(-2*dx, abs=0.5)
+    assert oy == pytest.approx( 3*dy, abs=0.75)
+
+def test_frame_offset_rejects_unrelated_frames():
+    """
+    Test that the confidence of a match between unrelated frames falls below
+    the rejection threshold while a real match is well above it
+    """
+    reference = utilities.driftReference(surface(seed=1))
+
+    _,_,good = reference.offset(np.roll(surface(seed=1), 3, axis=1))
+    _,_,bad  = reference.offset(surface(seed=2))
+
+    assert good > reference.minConfidence
+    assert bad  < reference.minConfidence
+
+def test_tip_change_detector():
+    """
+    Test that full-line and partial-line tip changes are found, and that
+    feeding the scan in line by line gives the same answer
+    """
+    scan = surface((256,256), seed=3) + np.linspace(0,5,256)[:,None]            # Topography plus a slope in y
+    scan += np.random.default_rng(4).normal(size=scan.shape)*0.05
+    for row in [40, 41, 120, 200]: scan[row:] += 0.5                            # 40 and 41 are the same tip change
+    scan[160,10:60] += 1                                                        # Streak across a fifth of the line
+
+    result = utilities.tipChangeDetector().update(scan)
+    assert result["count"] == 4
+    assert result["rows"]  == [40, 120, 160, 200]
+
+    detector = utilities.tipChangeDetector()
+    partial  = np.full_like(scan, np.nan)
+    for line in range(256):
+        partial[line] = scan[line]
+        detector.update(partial)
+        if(line == 130): assert detector.result["rows"] == [40, 120]
+    assert detector.result["rows"] == result["rows"]
+
+    assert utilities.findTipChanges(surface((256,256), seed=5)) == 0
+
+def test_tip_shape_due():
+    """
+    Test that tip shaping is due after four bad complete scans in a row
+    """
+    bad  = {"tipChanges": 8, "nan": False}
+    good = {"tipChanges": 1, "nan": False}
+    stopped = {"tipChanges": 0, "nan": True}
+    assert utilities.tipShapeDue([good, bad, bad, stopped, bad, bad])
+    assert not utilities.tipShapeDue([bad, bad, good, bad, bad])
+    assert not utilities.tipShapeDue([bad, bad, bad])
+
+def test_clean_monitor():
+    """
+    Test that a contaminated area is called dirty part way through an upward
+    scan while a clean area is only called clean once it's finished
+    """
+    rng = np.random.default_rng(0)
+    yy,xx = np.mgrid[:256,:256]
+    clean = surface((256,256), seed=6)*20e-12 + np.linspace(0,2e-9,256)[None,:] + rng.normal(size=(256,256))*5e-12
+    dirty = clean.copy()
+    for cy,cx in rng.integers(10,246,(12,2)):
+        dirty += 0.8e-9*np.exp(-((yy-cy)**2 + (xx-cx)**2)/18)                   # Adsorbates
+
+    for image,expected in [(clean,True),(dirty,False)]:
+        assert utilities.isClean(image, lxy=20e-9, threshold=0.3e-9) == expected
+
+        monitor = utilities.cleanMonitor(lxy=20e-9, threshold=0.3e-9)
+        partial = np.full_like(image, np.nan)
+        for line in range(255,-1,-16):                                          # Scanning up, checking every 16 lines
+            partial[line-15:line+1] = image[line-15:line+1]
+            result = monitor.update(partial)
+            if(result["decided"]): break
+
+        assert result["clean"] == expected
+        if(expected): assert result["line"] == 256
+        else:         assert result["line"] < 128
+
+def test_find_islands():
+    """
+    Test that two flat terraces dotted with adsorbates come back as two
+    substrate regions in the label image and region table
+    """
+    rng = np.random.default_rng(1)
+    yy,xx = np.mgrid[:256,:256]
+    scan = np.where(xx < 128, 0.0, 1.0)
+    for y,x in rng.integers(8,248,size=(40,2)):
+        scan += 0.6*np.exp(-((yy - y)**2 + (xx - x)**2)/8)
+    scan += rng.normal(scale=0.01, size=scan.shape)
+
+    result  = utilities.findIslands(scan*1e-10, [50e-9,50e-9])
+    labels  = result["labels"]
+    regions = result["regions"]
+
+    assert labels.shape == scan.shape
+    assert np.sum(regions["pixels"]) == scan.size
+    substrate = np.flatnonzero(regions["kind"] == "substrate")
+    assert len(substrate) == 2
+    assert np.all(regions["area"][substrate] > 1000)
+    assert np.all(np.isin(labels[result["substrate"] > 0], substrate))
+    assert not np.any(result["molecules"])
+
+def test_find_islands_partial_frame():
+    """
+    Test that the unscanned (NaN) lines of a partial frame are edges and the
+    scanned part still has its terraces
+    """
+    yy,xx = np.mgrid[:256,:256]
+    scan = np.where(xx < 128, 0.0, 1.0) + np.random.default_rng(2).normal(scale=0.01, size=(256,256))
+    scan[128:] = np.nan
+
+    result = utilities.findIslands(scan*1e-10, [50e-9,50e-9])
+    regions = result["regions"]
+    assert np.all(result["labels"][128:] == 0)
+    assert len(np.flatnonzero(regions["kind"] == "substrate")) == 2
+    assert np.all(np.isfinite(result["substrate"]))
+
+def test_assess_tip():
+    """
+    Test that an elliptical imprint on a noisy surface is measured without
+    touching the caller's data and that the contour comes back separately
+    """
+    rng = np.random.default_rng(0)
+    yy,xx = np.mgrid[:256,:256]
+    scan  = rng.normal(scale=3e-11, size=(256,256))
+    scan += 3e-10*np.exp(-(((yy - 100)/10)**2 + ((xx - 140)/14)**2))
+    original = scan.copy()
+
+    symmetry,size,contour = utilities.assessTip(scan, 20e-9, [0,0], True)
+
+    assert np.array_equal(scan, original)
+    assert 0.1 < symmetry <= 1
+    assert 1 < size < 10
+    assert contour.shape == scan.shape
+    assert np.count_nonzero(contour == 2*np.max(scan)) > 20
@@ -0,0 +1,127 @@
+import pytest
+import threading
+import sys
+from types import SimpleNamespace
+from unittest.mock import patch
+from scanbot.server.workers import bounded_pool
+from scanbot.server.nanonis_sim import nanonis_sim
+from scanbot.server.scanbot_interface import scanbot_interface
+from scanbot.server import global_
+
+def test_submit_blocks_when_full():
+    """
+    Test that submit blocks once maxPending tasks are queued or running and
+    carries on as soon as one finishes
+    """
+    pool  = bounded_pool(workers=1, maxPending=2)
+    gate  = threading.Event()
+    pool.submit(gate.wait)
+    pool.submit(gate.wait)
+
+    submitted = threading.Event()
+    thread = threading.Thread(target=lambda: (pool.submit(lambda: None), submitted.set()))
+    thread.start()
+    assert not submitted.wait(0.2)                                              # Back-pressure
+    assert pool.pending() == 2
+
+    gate.set()
+    assert submitted.wait(5)
+    pool.drain(timeout=5)
+    assert pool.pending() == 0
+    pool.shutdown()
+
+def test_slot_released_when_task_raises():
+    """
+    Test that a task that raises gives its slot back and is reported to
+    onError
+    """
+    errors = []
+    pool = bounded_pool(workers=1, maxPending=1, onError=errors.append)
+    def fail(): raise ValueError("bad frame")
+    pool.submit(fail)
+    pool.submit(fail)                                                           # Would block forever if the first slot was lost
+    pool.drain(timeout=5)
+    assert [str(e) for e in errors] == ["bad frame","bad frame"]
+    assert pool.submit(lambda: 42).result(timeout=5) == 42
+    pool.shutdown()
+
+def runSurvey(tmp_path, pipeline):
+    """
+    Run a 2x2 survey with hk_survey against a fresh simulator. Returns the
+    pngs sent and the hook calls, in order
+    """
+    pngs,hookCalls = [],[]
+    hook = SimpleNamespace(run=lambda scanData,filePath,metaData: hookCalls.append((scanData.copy(),filePath)))
+    with nanonis_sim(ports=[0,0], timeScale=200, lineTime=0.1, pixels=64, lines=64, seed=1) as sim, \
+         patch.dict(sys.modules, {'hk_survey': hook}):
+        interface = scanbot_interface(run_mode='c', module_dir=str(tmp_path) + '/')
+        interface.IP       = sim.IP
+        interface.portList = sim.ports
+
+        sendPNG = interface.sendPNG
+        def record(pngFilename, *args, **kwargs):
+            with open(interface.module_dir + pngFilename, 'rb') as f:
+                pngs.append(f.read())
+            sendPNG(pngFilename, *args, **kwargs)
+        interface.sendPNG = record
+
+        error = interface.survey(["-n=2", "-xy=20e-9", "-st=0", "-hk_survey=1", "-pipeline=" + str(pipeline)])
+        assert not error
+        global_.tasks.join(60)
+        assert not global_.tasks.is_alive()
+        interface.uploader.close(wait=False)
+        interface.scheduler.close()
+        interface.config.close()
+        interface.scanbot.pool.close()
+    return pngs,hookCalls
+
+def test_pipelined_survey_matches_serial(tmp_path):
+    """
+    Test that a pipelined survey sends the same pngs and calls hk_survey with
+    the same frames, in the same order, as a serial one
+    """
+    serialPNGs,serialCalls = runSurvey(tmp_path / "serial", 0)
+    pipedPNGs,pipedCalls   = runSurvey(tmp_path / "pipeline", 1)
+
+    assert len(serialPNGs) == 4 and pipedPNGs == serialPNGs
+    assert [filePath for _,filePath in pipedCalls] == [filePath for _,filePath in serialCalls]
+    for (piped,_),(serial,_) in zip(pipedCalls,serialCalls):
+        assert (piped == serial).all()
+
+def test_worker_shut_down_when_survey_raises(tmp_path):
+    """
+    Test that the post-processing worker is drained and shut down when the
+    acquisition loop raises
+    """
+    pools = []
+    class recorded_pool(bounded_pool):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            if(kwargs.get("name") == "survey"): pools.append(self)
+
+    hook = SimpleNamespace(run=lambda scanData,filePath,metaData: None)
+    with nanonis_sim(ports=[0,0], timeScale=200, lineTime=0.1, pixels=64, lines=64, seed=1) as sim, \
+         patch.dict(sys.modules, {'hk_survey': hook}), \
+         patch('scanbot.server.workers.bounded_pool', recorded_pool):
+        interface = scanbot_interface(run_mode='c', module_dir=str(tmp_path) + '/')
+        interface.IP       = sim.IP
+        interface.portList = sim.ports
+
+        getMetaData,calls = interface.scanbot.getMetaData,[]
+        def failing(filePath):
+            calls.append(filePath)
+            if(len(calls) == 2): raise OSError("Connection lost")               # Second frame
+            return getMetaData(filePath)
+        interface.scanbot.getMetaData = failing
+
+        assert not interface.survey(["-n=2", "-xy=20e-9", "-st=0", "-hk_survey=1", "-pipeline=1"])
+        global_.tasks.join(60)
+        assert not global_.tasks.is_alive()
+        interface.uploader.close(wait=False)
+        interface.scheduler.close()
+        interface.config.close()
+        interface.scanbot.pool.close()
+
+    assert len(pools) == 1 and pools[0].pending() == 0
+    with pytest.raises(RuntimeError):                                           # Can't schedule new futures after shutdown
+        pools[0].submit(lambda: None)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:07:36 2026
+
+Closed-loop coarse positioning of the tip from the camera. Tracking, motor
+stepping and crash monitoring run at the same time instead of taking turns,
+so the tip keeps moving while frames are processed and the current is
+watched while the motors move rather than between blocks of steps.
+"""
+
+from nanonisTCP.Motor import Motor
+from nanonisTCP.ZController import ZController
+from nanonisTCP.Current import Current
+
+import numpy as np
+import threading
+import queue
+import time
+
+class tip_controller():
+    """
+    Drives the tip towards a target position in the camera image. Three
+    threads are linked by queues:
+
+        vision : The caller. Tracks the tip in each frame and hands the
+                 position over with observe()
+        motor  : Takes the latest position, picks a direction the same way
+                 moveTip always has (up first, then left/right) and a number
+                 of steps from how far the tip is from the target, then
+                 steps the motors
+        safety : Reads the tip current on its own connection while the
+                 motors are moving and stops them if it goes over the safe
+                 threshold. The motor thread then runs the usual safe
+                 retract
+
+    The step size is worked out from how far the tip actually moved on the
+    camera after each move (pixels per step, for each direction). Until that
+    has been measured, the user's step sizes are used.
+
+    """
+    liftSteps      = 10                                                         # Z+ steps before every sideways move. The tip never moves sideways without going up first
+    minSteps       = 10                                                         # Smallest move once the step size is known
+    maxScale       = 10                                                         # Largest move is this many times the user's step size
+    gain           = 0.7                                                        # Fraction of the remaining distance to cover per move. Falls short rather than overshooting
+    tolerance      = 2                                                          # Close enough to the target column (px)
+    minMovement    = 2                                                          # Smallest movement used to measure the step size (px)
+    safetyInterval = 0.01                                                       # Time between current readings while the motors move (s)
+
+    def __init__(self,scanbot,target,xStep,zStep,xV,zV,xF,zF,fresh=None,demo=False):
+        """
+        Parameters
+        ----------
+        scanbot : scanbot instance. Used for connections, limits and the
+                  safe retract
+        target  : Target position in the camera image [col, row]
+        xStep   : Motor steps per move in X+ or X- (before the step size is
+                  known)
+        zStep   : Motor steps per move in Z+ (before the step size is known)
+        xV,zV   : Piezo voltages (V)
+        xF,zF   : Piezo frequencies (Hz)
+        fresh   : Callable that returns the number of the last frame that
+                  could have been captured before now (camera_stream.fresh).
+                  Positions from frames up to that one are ignored after a
+                  move
+        demo    : Don't move anything, just say what would be done
+
+        """
+        self.scanbot = scanbot
+        self.target  = np.array(target[:2])
+        self.steps   = {"Z+": zStep, "X+": xStep, "X-": xStep}
+        self.freqAmp = {"Z" : [min(max(zF,scanbot.zMinF),scanbot.zMaxF),min(max(zV,scanbot.zMinV),scanbot.zMaxV)],
+                        "X" : [min(max(xF,scanbot.xyMinF),scanbot.xyMaxF),min(max(xV,scanbot.xyMinV),scanbot.xyMaxV)]}
+        self.fresh   = fresh or (lambda: 0)
+        self.demo    = demo
+
+        self.positions = queue.Queue(maxsize=1)                                 # Latest tip position (vision -> motor). Older ones are dropped
+        self.alarms    = queue.Queue()                                          # Currents over the threshold (safety -> motor)
+        self.moving    = threading.Event()                                      # Set while the motors are stepping
+        self.done      = threading.Event()
+        self.result    = ""                                                     # "hit", "crash", "stopped" or an error message
+        self.pxPerStep = {}                                                     # Measured tip movement per motor step, by direction
+        self.moves     = []                                                     # (direction, steps) of every move made
+        self.after     = 0                                                      # Ignore positions from frames up to this one
+        self.axis      = ""                                                     # Axis the motor frequency/amplitude is set for
+        self.threads   = []
+
+    def start(self):
+        targets = [self.motorLoop] if self.demo else [self.motorLoop,self.safetyLoop]
+        for target in targets:
+            thread = threading.Thread(target=target,name="scanbot-tip-" + target.__name__[:-4],daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def observe(self,tipPos,seq=0):
+        """
+        Hand over the latest tip position. Never blocks. If the motor thread
+        hasn't picked up the last position yet it's replaced with this one.
+
+        Parameters
+        ----------
+        tipPos : Tip position [col, row]
+        seq    : Number of the frame it was found in
+
+        """
+        try:
+            self.positions.get_nowait()
+        except queue.Empty:
+            pass
+        self.positions.put_nowait((np.array(tipPos[:2]),seq))
+
+    def stop(self,result="stopped"):
+        """
+        Stop moving (if still running) and wait for the threads to finish.
+
+        Returns
+        -------
+        result : "hit", "crash", "stopped" or an error message
+
+        """
+        self.finish(result)
+        for thread in self.threads: thread.join(10)
+        return self.result
+
+    def finish(self,result):
+        if(not self.done.is_set()):
+            self.result = result
+            self.done.set()
+
+###############################################################################
+# Planning
+###############################################################################
+    def plan(self,tipPos):
+        """
+        Returns
+        -------
+        move : (direction, steps) or None if the target has been reached
+
+        """
+        dx = self.target[0] - tipPos[0]
+        if(tipPos[1] > self.target[1]):                                         # First priority is to always keep the tip above this line
+            direction,distance = "Z+",tipPos[1] - self.target[1]
+        elif(abs(dx) > self.tolerance):
+            direction,distance = "X+" if dx > 0 else "X-",abs(dx)
+        else:
+            return None
+
+        steps = self.steps[direction]
+        rate  = self.pxPerStep.get(direction)
+        if(rate):
+            steps = int(np.clip(round(self.gain*distance/rate),min(self.minSteps,steps),self.maxScale*steps))
+        return direction,steps
+
+    def calibrate(self,direction,steps,before,after):
+        """
+        Update the step size for a direction from how far the tip moved.
+
+        """
+        if(direction == "Z+"):   moved = before[1] - after[1]                   # Rows count down the image
+        elif(direction == "X+"): moved = after[0] - before[0]
+        else:                    moved = before[0] - after[0]
+        if(moved < self.minMovement): return                                    # Too small to measure or the wrong way (tracking glitch)
+
+        rate = moved/steps
+        previous = self.pxPerStep.get(direction)
+        self.pxPerStep[direction] = rate if previous is None else 0.5*(previous + rate)
+
+###############################################################################
+# Threads
+###############################################################################
+    def motorLoop(self):
+        NTCP = None
+        try:
+            if(not self.demo):
+                NTCP,connection_error = self.scanbot.connect()                  # Connect to nanonis via TCP
+                if(connection_error): return self.finish(connection_error)
+                motor = Motor(NTCP)
+                ZController(NTCP).Withdraw(wait_until_finished=True,timeout=3)
+
+            last = None                                                         # (direction, steps, position before) of the last move
+            while(not self.done.is_set()):
+                try:
+                    tipPos,seq = self.positions.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+                if(seq and seq <= self.after): continue                         # Captured before the last move finished
+
+                if(last): self.calibrate(*last,tipPos)
+                last = None
+
+                move = self.plan(tipPos)
+                if(move is None): return self.finish("hit")
+                direction,steps = move
+
+                if(self.demo):
+                    print({"Z+": "Moving up", "X+": "Moving right", "X-": "Moving left"}[direction])
+                    continue
+
+                if(not self.step(NTCP,motor,direction,steps)): return
+                self.after = self.fresh()
+                last = (direction,steps,tipPos)
+        except Exception as e:
+            self.finish("Error moving the tip: " + str(e))
+        finally:
+            if(NTCP): self.scanbot.disconnect(NTCP)
+
+    def step(self,NTCP,motor,direction,steps):
+        """
+        Make one move. Sideways moves go up by liftSteps first.
+
+        Returns
+        -------
+        True if the move was made. False if the safety thread stopped it and
+        the safe retract was triggered, or if the controller was stopped
+
+        """
+        moves = [(direction,steps)]
+        if(direction != "Z+"): moves.insert(0,("Z+",self.liftSteps))
+
+        self.moving.set()
+        try:
+            for direction,steps in moves:
+                if(self.done.is_set() or not self.alarms.empty()): break
+                axis = direction[0] if direction[0] == "Z" else "X"
+                if(self.axis != axis):                                          # Only change the piezo settings when switching between Z and X
+                    motor.FreqAmpSet(*self.freqAmp[axis])
+                    self.axis = axis
+                motor.StartMove(direction,steps,wait_until_finished=True)
+                self.moves.append((direction,steps))
+        finally:
+            self.moving.clear()
+
+        if(self.alarms.empty()): return not self.done.is_set()
+
+        while(not self.alarms.empty()): self.alarms.get_nowait()
+        self.axis = ""                                                          # The safe retract sets its own piezo settings
+        if(self.scanbot.safeCurrentCheck(NTCP)): return True                    # Current was back down by the time it was checked again
+        self.finish("crash")
+        return False
+
+    def safetyLoop(self):
+        NTCP = None
+        try:
+            NTCP,connection_error = self.scanbot.connect()                      # Separate connection so the current can be read while the motors move
+            if(connection_error): return self.finish(connection_error)
+            motor   = Motor(NTCP)
+            current = Current(NTCP)
+
+            while(not self.done.is_set()):
+                if(not self.moving.wait(0.1)): continue
+                if(self.alarms.empty() and abs(current.Get()) >= self.scanbot.safeCurrent):
+                    motor.StopMove()
+                    self.alarms.put(time.time())
+                time.sleep(self.safetyInterval)
+
+            if(self.moving.is_set()): motor.StopMove()                          # Stopped mid-move. Don't wait for it to finish
+        except Exception as e:
+            self.finish("Error monitoring the tip current: " + str(e))
+        finally:
+            if(NTCP): self.scanbot.disconnect(NTCP)
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:47:09 2026
+
+Per-phase timing for Scanbot routines. Routines are broken down into named
+spans (TCP round trips, sleeps, waiting for scans, analysis, rendering,
+uploads) that are aggregated per job and can be exported as a Chrome trace
+(chrome://tracing or https://ui.perfetto.dev).
+"""
+
+from collections import deque
+import functools
+import json
+import threading
+import time
+
+class span_tracer():
+    """
+    Records spans from every thread. A span belongs to the job that was
+    running on the thread when it was opened. Work handed to a background
+    pool keeps the job of the thread that submitted it (see bind) and is
+    reported separately since it overlaps with the routine.
+
+    Spans are kept in a bounded buffer so an overnight run can't use up
+    memory. Per-job totals are worked out from whatever is still in the
+    buffer.
+
+    Span categories:
+        job      : A routine from start to finish (one per job thread)
+        tcp      : Round trip to nanonis
+        scan     : Waiting for nanonis to finish a scan
+        sleep    : Fixed sleeps in the routines
+        analysis : Image analysis (classification, drift, cleanliness, etc.)
+        render   : pngs, gifs and stitching
+        upload   : Sending data off the instrument pc
+
+    """
+    maxSpans = 100000                                                           # Oldest spans are dropped beyond this
+    scanCommands = ["Scan.WaitEndOfScan"]                                       # TCP commands that are really waiting on a scan
+
+    def __init__(self,enabled=True):
+        self.enabled = enabled
+        self.spans   = deque(maxlen=self.maxSpans)                              # (name, category, start, duration, thread ident, job id, depth, background, attrs)
+        self.jobs    = {}                                                       # job id: {command, start, finish}
+        self.threads = {}                                                       # thread ident: thread name
+        self.local   = threading.local()
+        self.lock    = threading.Lock()
+
+###############################################################################
+# Recording
+###############################################################################
+    def context(self):
+        local = self.local
+        if(not hasattr(local,'depth')):
+            local.depth      = 0
+            local.job        = None
+            local.background = False
+        return local
+
+    def record(self,name,category,start,duration,attrs=None):
+        """
+        Record a span that has already finished.
+
+        Parameters
+        ----------
+        name     : Name of the span (e.g. Scan.FrameDataGrab, classify)
+        category : See span categories
+        start    : Time the span started (time.time())
+        duration : Length of the span (s)
+        attrs    : Dictionary of extra information to keep with the span
+
+        """
+        if(not self.enabled): return
+        local  = self.context()
+        thread = threading.current_thread()
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.spans.append((name,category,start,duration,thread.ident,local.job,local.depth,local.background,attrs))
+
+    def span(self,name,category="",**attrs):
+        """
+        Context manager that times the code inside it.
+
+            with tracer.span("flatten","analysis"):
+                ...
+
+        """
+        return _span(self,name,category,attrs)
+
+    def job(self,jobID,command=""):
+        """
+        Context manager that marks the calling thread as working on a job for
+        as long as it's open. Called by the scheduler around every routine.
+
+        """
+        with self.lock:
+            job = self.jobs.setdefault(jobID,{"command": command, "start": time.time(), "finish": None})
+            job["finish"] = None
+        return _jobSpan(self,jobID,command)
+
+    def bind(self,func,jobID=None):
+        """
+        Wrap func so that when it runs (on another thread) its spans belong
+        to jobID, or to the job running on the calling thread now if jobID
+        is None.
+
+        """
+        if(jobID is None): jobID = self.context().job
+        if(jobID is None): return func
+
+        @functools.wraps(func)
+        def bound(*args,**kwargs):
+            local = self.context()
+            previous = (local.job,local.background)
+            local.job,local.background = jobID,True
+            try:
+                return func(*args,**kwargs)
+            finally:
+                local.job,local.background = previous
+        return bound
+
+    def traced(self,category,name=None):
+        """
+        Decorator that puts every call to a function in a span.
+
+        """
+        def decorator(func):
+            spanName = name or func.__qualname__
+            @functools.wraps(func)
+            def wrapper(*args,**kwargs):
+                if(not self.enabled): return func(*args,**kwargs)
+                with self.span(spanName,category):
+                    return func(*args,**kwargs)
+            return wrapper
+        return decorator
+
+    def sleep(self,seconds,name="sleep"):
+        """
+        time.sleep that shows up in the trace.
+
+        """
+        with self.span(name,"sleep"):
+            time.sleep(seconds)
+
+    def instrument(self,NTCP):
+        """
+        Time every round trip made over a nanonisTCP session. The command
+        name is read from the header as it's sent and the span ends when its
+        response has been read.
+
+        Returns
+        -------
+        NTCP : The same session
+
+        """
+        send,receive = NTCP.send_command,NTCP.receive_response
+        pending = []
+
+        def send_command(message):
+            try:
+                command = bytes.fromhex(message[:64]).split(b'\0')[0].decode()
+            except ValueError:
+                command = "unknown"
+            pending[:] = [command,time.time()]
+            return send(message)
+
+        def receive_response(*args,**kwargs):
+            error = None
+            try:
+                return receive(*args,**kwargs)
+            except Exception as e:
+                error = str(e)
+                raise
+            finally:
+                if(pending):
+                    command,start = pending
+                    pending.clear()
+                    category = "scan" if command in self.scanCommands else "tcp"
+                    self.record(command,category,start,time.time() - start,{"error": error} if error else None)
+
+        NTCP.send_command     = send_command
+        NTCP.receive_response = receive_response
+        return NTCP
+
+###############################################################################
+# Reporting
+###############################################################################
+    def summary(self,jobID=None):
+        """
+        Aggregate spans per job.
+
+        Time on the routine's own threads is split by category using the
+        outermost spans only, so nothing is counted twice. Whatever isn't
+        covered by a span is 'other' (python overhead, messages, hooks).
+        Background work runs alongside the routine and is reported
+        separately.
+
+        Parameters
+        ----------
+        jobID : Only summarise this job. All jobs if None
+
+        Returns
+        -------
+        summary : {job id: {command, start, finish, wall, phases, background,
+                            spans}}. phases and background map category to
+                  total time (s). spans maps span name to count, total, max
+                  and mean duration (s)
+
+        """
+        with self.lock:
+            spans = list(self.spans)
+            jobs  = {k: dict(v) for k,v in self.jobs.items() if jobID is None or k == jobID}
+
+        now = time.time()
+        summary = {}
+        for ID,job in jobs.items():
+            summary[ID] = {"command"    : job["command"],
+                           "start"      : job["start"],
+                           "finish"     : job["finish"],
+                           "wall"       : (job["finish"] or now) - job["start"],
+                           "phases"     : {},
+                           "background" : {},
+                           "spans"      : {}}
+
+        for name,category,start,duration,_,ID,depth,background,_ in spans:
+            if(ID not in summary): continue
+            job = summary[ID]
+            if(background):
+                job["background"][category] = job["background"].get(category,0) + duration
+            elif(depth == 1):                                                   # Directly under the job span
+                job["phases"][category] = job["phases"].get(category,0) + duration
+
+            if(category == "job"): continue
+            stats = job["spans"].setdefault(name,{"category": category, "count": 0, "total": 0, "max": 0})
+            stats["count"] += 1
+            stats["total"] += duration
+            stats["max"]    = max(stats["max"],duration)
+
+        for job in summary.values():
+            job["phases"]["other"] = max(0,job["wall"] - sum(job["phases"].values()))
+            for stats in job["spans"].values():
+                stats["mean"] = stats["total"]/stats["count"]
+        return summary
+
+    def chromeTrace(self,jobID=None):
+        """
+        Returns
+        -------
+        trace : Spans in Chrome's trace event format. Load the json into
+                chrome://tracing or https://ui.perfetto.dev
+
+        """
+        with self.lock:
+            spans   = list(self.spans)
+            threads = dict(self.threads)
+
+        events = []
+        for name,category,start,duration,thread,ID,_,_,attrs in spans:
+            if(jobID is not None and ID != jobID): continue
+            args = {"job": ID}
+            if(attrs): args.update(attrs)
+            events.append({"name": name, "cat": category, "ph": "X", "pid": 1, "tid": thread,
+                           "ts": start*1e6, "dur": duration*1e6, "args": args})
+
+        for thread in set(event["tid"] for event in events):
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": thread,
+                           "args": {"name": threads.get(thread,str(thread))}})
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self,path,jobID=None):
+        with open(path,'w') as f:
+            json.dump(self.chromeTrace(jobID),f)
+        return path
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+            self.jobs = {k: v for k,v in self.jobs.items() if v["finish"] is None} # Keep jobs that are still running
+
+class _span():
+    def __init__(self,tracer,name,category,attrs):
+        self.tracer   = tracer
+        self.name     = name
+        self.category = category
+        self.attrs    = attrs
+
+    def __enter__(self):
+        if(self.tracer.enabled):
+            self.tracer.context().depth += 1
+        self.start = time.time()
+        return self
+
+    def __exit__(self,excType,exc,tb):
+        if(not self.tracer.enabled): return False
+        duration = time.time() - self.start
+        local = self.tracer.context()
+        local.depth -= 1
+        if(excType): self.attrs["error"] = excType.__name__
+        self.tracer.record(self.name,self.category,self.start,duration,self.attrs or None)
+        return False
+
+class _jobSpan():
+    def __init__(self,tracer,jobID,command):
+        self.tracer  = tracer
+        self.jobID   = jobID
+        self.command = command
+
+    def __enter__(self):
+        local = self.tracer.context()
+        self.previous = (local.job,local.depth,local.background)
+        local.job,local.depth,local.background = self.jobID,0,False
+        self.span = self.tracer.span(self.command or "job","job").__enter__()
+        return self
+
+    def __exit__(self,excType,exc,tb):
+        self.span.__exit__(excType,exc,tb)
+        local = self.tracer.context()
+        local.job,local.depth,local.background = self.previous
+        with self.tracer.lock:
+            self.tracer.jobs[self.jobID]["finish"] = time.time()                # Updated again if another thread of the same job finishes later
+        return False
+
+tracer = span_tracer()                                                          # Shared by everything in the process
+
+span       = tracer.span
+traced     = tracer.traced
+sleep      = tracer.sleep
+bind       = tracer.bind
+instrument = tracer.instrument
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:04:26 2026
+
+Background upload service. Files waiting to be uploaded (pngs, animations,
+scan archives for the cloud database) are moved into a spool directory and sent in
+batches from worker threads so acquisition never waits on the network.
+"""
+
+from scanbot.server.workers import bounded_pool
+from scanbot.server import tracing
+
+import json
+import os
+import shutil
+import threading
+import time
+
+class upload_service():
+    """
+    Persistent upload queue. Each queued file lives in its own directory in
+    the spool, next to a json sidecar describing where it's going:
+        id          : Unique id. Also the name of the file's spool directory
+        file        : Path to the file in the spool
+        filename    : Original filename
+        method      : Upload method (zulip, firebase, path, scp)
+        destination : Where the file is going (path, storage prefix, scp target)
+        notify      : Notify users when the file arrives (zulip/firebase)
+        message     : Message the upload replies to (zulip only)
+        attempts    : Number of failed attempts so far
+        nextAttempt : Earliest time the next attempt can start (s since epoch)
+        error       : Last error
+
+    Files going to the same place are sent together: the sender is called
+    once per batch. Failed uploads are retried with exponential backoff and
+    moved to spool/failed/ after maxAttempts. Anything left in the spool when
+    scanbot stops is picked up again the next time it starts.
+
+    """
+    def __init__(self,path,sender,workers=2,batchSize=20,batchWindow=0.5,
+                 maxAttempts=8,backoff=2,maxBackoff=300,onFailure=None):
+        """
+        Parameters
+        ----------
+        path        : Spool directory
+        sender      : Callable sender(method,destination,items) that uploads a
+                      batch of items. Returns the list of items that failed.
+                      Raising fails the whole batch.
+        workers     : Number of batches that can be uploading at once
+        batchSize   : Maximum number of files per batch
+        batchWindow : Time to wait for more files before sending a batch (s)
+        maxAttempts : Number of attempts before an upload is given up on
+        backoff     : Retry delay after n failures is backoff**n (s)
+        maxBackoff  : Longest delay between retries (s)
+        onFailure   : Callable onFailure(item) called when an upload is given
+                      up on
+
+        """
+        self.path        = path
+        self.sender      = sender
+        self.batchSize   = batchSize
+        self.batchWindow = batchWindow
+        self.maxAttempts = maxAttempts
+        self.backoff     = backoff
+        self.maxBackoff  = maxBackoff
+        self.onFailure   = onFailure
+        self.items       = {}                                                   # id: item dictionary
+        self.inflight    = set()                                                # ids of items being uploaded
+        self.counter     = 0
+        self.flushing    = False                                                # Skip the batch window and backoff
+        self.closed      = False
+        self.lock        = threading.Condition()
+
+        os.makedirs(self.path,exist_ok=True)
+        self.pool = bounded_pool(workers=workers,maxPending=workers,name="scanbot-upload")
+
+        self.load()
+
+        self.dispatcher = threading.Thread(target=self.dispatch,name="scanbot-uploader",daemon=True)
+        self.dispatcher.start()
+
+    def enqueue(self,filePath,method,destination="",notify=False,message=""):
+        """
+        Move a file into the spool and queue it for upload. The file is no
+        longer at filePath when this returns.
+
+        Parameters
+        ----------
+        filePath    : Path to the file
+        method      : Upload method
+        destination : Where the file is going
+        notify      : Notify users when the file arrives
+        message     : Message the upload replies to (zulip only)
+
+        Returns
+        -------
+        id : Upload id
+
+        """
+        with self.lock:
+            self.counter += 1
+            uploadID = str(int(time.time()*1000)) + "_" + str(self.counter)
+
+        filename = os.path.basename(filePath)
+        spoolDir = os.path.join(self.path,uploadID)
+        os.makedirs(spoolDir)
+        shutil.move(filePath,os.path.join(spoolDir,filename))                   # A rename when the spool is on the same disk
+
+        item = {"id"          : uploadID,
+                "file"        : os.path.join(spoolDir,filename),
+                "filename"    : filename,
+                "method"      : method,
+                "destination" : destination,
+                "notify"      : bool(notify),
+                "message"     : message,
+                "job"         : tracing.tracer.context().job,
+                "attempts"    : 0,
+                "nextAttempt" : 0,
+                "error"       : ""}
+        self.save(item)
+
+        with self.lock:
+            self.items[uploadID] = item
+            self.lock.notify_all()
+        return uploadID
+
+    def dispatch(self):
+        """
+        Dispatcher loop. Groups ready items into batches and hands them to
+        the worker pool.
+
+        """
+        while(True):
+            with self.lock:
+                batch,wait = self.nextBatch()
+                while(not batch and not self.closed):
+                    self.lock.wait(wait)
+                    batch,wait = self.nextBatch()
+                if(self.closed): return
+                self.inflight.update(item["id"] for item in batch)
+
+            try:
+                self.pool.submit(self.send,batch)                               # Blocks while every worker is busy
+            except RuntimeError:                                                # Pool shut down
+                return
+
+    def nextBatch(self):
+        """
+        Returns
+        -------
+        batch : Oldest ready items going to the same place. Empty if nothing
+                is ready to go.
+        wait  : Time until something might be ready (s). None to wait until
+                notified.
+
+        """
+        now   = time.time()
+        ready = [item for item in self.items.values() if item["id"] not in self.inflight and item["nextAttempt"] <= now]
+        later = [item["nextAttempt"] for item in self.items.values() if item["id"] not in self.inflight and item["nextAttempt"] > now]
+        wait  = min(later) - now if later else None
+        if(not ready): return [],wait
+
+        ready.sort(key=lambda item: [int(n) for n in item["id"].split("_")])
+        first  = ready[0]
+        queued = int(first["id"].split("_")[0])/1000
+        if(not self.flushing and not first["attempts"] and now - queued < self.batchWindow): # Give the rest of the batch a chance to arrive
+            return [],self.batchWindow - (now - queued)
+
+        key   = self.batchKey(first)
+        batch = [item for item in ready if self.batchKey(item) == key]
+        return batch[:self.batchSize],wait
+
+    def batchKey(self,item):
+        return (item["method"],item["destination"],item["notify"],json.dumps(item["message"],sort_keys=True))
+
+    def send(self,batch):
+        for item in batch: item["error"] = ""                                   # Senders can record why an individual item failed
+        try:
+            sender = tracing.traced("upload",batch[0]["method"])(self.sender)
+            sender = tracing.bind(sender,batch[0].get("job"))                   # Upload time is counted against the job that produced the files
+            failed = sender(batch[0]["method"],batch[0]["destination"],batch)
+            error  = "Upload failed"
+        except Exception as e:
+            failed = batch
+            error  = str(e)
+
+        failedIDs = [item["id"] for item in failed]
+        for item in batch:
+            if(item["id"] in failedIDs):
+                self.retry(item,item["error"] or error)
+            else:
+                self.remove(item)
+
+        with self.lock:
+            self.inflight.difference_update(item["id"] for item in batch)
+            self.lock.notify_all()
+
+    def retry(self,item,error):
+        item["attempts"] += 1
+        item["error"]     = error
+        if(item["attempts"] >= self.maxAttempts):                               # Give up. Keep the file in case someone wants it
+            failedDir = os.path.join(self.path,"failed")
+            os.makedirs(failedDir,exist_ok=True)
+            try:
+                shutil.move(os.path.join(self.path,item["id"]),os.path.join(failedDir,item["id"]))
+                os.remove(os.path.join(self.path,item["id"] + ".json"))
+            except Exception as e:
+                print("Could not move failed upload: " + str(e))
+            with self.lock:
+                del self.items[item["id"]]
+            print("Giving up on upload of " + item["filename"] + ": " + error)
+            if(self.onFailure): self.onFailure(item)
+            return
+
+        item["nextAttempt"] = time.time() + min(self.backoff**item["attempts"],self.maxBackoff)
+        self.save(item)
+
+    def remove(self,item):
+        with self.lock:
+            self.items.pop(item["id"],None)
+        shutil.rmtree(os.path.join(self.path,item["id"]),ignore_errors=True)
+        try:
+            os.remove(os.path.join(self.path,item["id"] + ".json"))
+        except FileNotFoundError:
+            pass
+
+    def pending(self):
+        with self.lock:
+            return len(self.items)
+
+    def flush(self,timeout=None):
+        """
+        Send everything now, ignoring the batch window and any backoff, and
+        wait for the queue to empty.
+
+        Returns
+        -------
+        empty : True if everything was uploaded before the timeout
+
+        """
+        with self.lock:
+            self.flushing = True
+            for item in self.items.values(): item["nextAttempt"] = 0
+            self.lock.notify_all()
+            empty = self.lock.wait_for(lambda: not self.items,timeout=timeout)
+            self.flushing = False
+            return empty
+
+    def close(self,wait=True):
+        """
+        Stop the service. Anything not uploaded stays in the spool for next
+        time.
+
+        Parameters
+        ----------
+        wait : Wait for batches that are uploading to finish
+
+        """
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.pool.shutdown(wait=wait)
+
+    def save(self,item):
+        sidecar = os.path.join(self.path,item["id"] + ".json")
+        try:
+            with open(sidecar + ".tmp",'w') as f:
+                json.dump(item,f,indent=1)
+            os.replace(sidecar + ".tmp",sidecar)                                # Don't leave a half written sidecar behind if we die mid-write
+        except Exception as e:
+            print("Could not save upload " + item["id"] + ": " + str(e))
+
+    def load(self):
+        for name in sorted(os.listdir(self.path)):
+            if(not name.endswith(".json")): continue
+            try:
+                with open(os.path.join(self.path,name),'r') as f:
+                    item = json.load(f)
+            except Exception as e:
+                print("Could not load upload " + name + ": " + str(e))
+                continue
+
+            if(not os.path.exists(item["file"])):                               # Uploaded but the sidecar wasn't removed
+                os.remove(os.path.join(self.path,name))
+                continue
+
+            item["nextAttempt"] = 0
+            self.items[item["id"]] = item
+            counter = int(item["id"].split("_")[1])
+            self.counter = max(self.counter,counter)
+        if(self.items): print("Resuming " + str(len(self.items)) + " upload(s)")
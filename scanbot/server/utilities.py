@@ -9,12 +9,15 @@ import ntpath
 import pickle
 import math
 import numpy as np
-import scipy.signal as sp
 from scanbot.server import nanonispyfit as napfit
-import cv2
-from scipy import ndimage
+from scanbot.server import animation
+from scanbot.server import tracing
+from scanbot.server import lazy
 import os
 
+ndimage = lazy.lazy_module('scipy.ndimage')
+cv2     = lazy.lazy_module('cv2')
+
 def pklDict(scanData,filePath,x,y,w,h,angle,pixels,lines,comments=""):
     filename = ntpath.split(filePath)[1]
     pklDict = { "sxm"       : filename,
@@ -34,12 +37,16 @@ def pklDict(scanData,filePath,x,y,w,h,angle,pixels,lines,comments=""):
 ###############################################################################
 # Drift Correction - gets the real-space offset between two frames
 ###############################################################################
-def getFrameOffset(im1,im2,dxy=[1,1],theta=0):
+@tracing.traced("analysis")
+def getFrameOffset(im1,im2,dxy=[1,1],theta=0,returnConfidence=False):
     """
     Returns the offset of im2 relative to im1. im1 and im2 must be the same
     size and scale. Keep dxy=[1,1] to return offset in units of pixels.
     When using with nanonis to detect drift, take the current scan frame 
     position and subtract ox,oy from it. i.e.: center_x -= ox; center_y -= oy
+    
+    When comparing a series of frames against the same reference, use 
+    driftReference instead so the reference spectrum is only computed once.
 
     Parameters
     ----------
@@ -47,33 +54,107 @@ def getFrameOffset(im1,im2,dxy=[1,1],theta=0):
     im2 : image to get the offset of
     dxy : pixel size in x and y: [dx,dy]
     theta : angle in degrees
+    returnConfidence : Also return the confidence of the match
 
     Returns
     -------
     [ox,oy] : offset in x and y
+    confidence : Peak-to-sidelobe ratio. Only if returnConfidence=True. See
+                 driftReference.offset
 
     """
-    im1 = ndimage.gaussian_filter(im1, 0.5)
-    im2 = ndimage.gaussian_filter(im2, 0.5)
-    im1_diff = np.diff(im1,axis=1)                                              # Differentiate along x
-    im2_diff = np.diff(im2,axis=1)                                              # Differentiate along x
-        
-    xcor = sp.correlate2d(im1_diff,im2_diff, boundary='symm', mode='same')
-    y,x  = np.unravel_index(xcor.argmax(), xcor.shape)
+    ox,oy,confidence = driftReference(im1).offset(im2,dxy,theta)
+    if(returnConfidence): return np.array([ox,oy]),confidence
+    return np.array([ox,oy])
 
-    ni = np.array(xcor.shape)
-    oy,ox = np.array([y,x]).astype(int) - (ni/2).astype(int)
-    
-    oy += y%2                                                                   # Add in this offset because differentiating results in odd number of px
+class driftReference():
+    """
+    Phase correlation against a fixed reference frame. The windowed spectrum
+    of the reference is computed once and reused for every frame in a drift
+    correction series.
+
+    """
+    minConfidence = 8                                                           # Peak-to-sidelobe ratio below which a match should be rejected. Noise alone rarely exceeds ~5
+    
+    def __init__(self,reference,window=True):
+        """
+        Parameters
+        ----------
+        reference : Reference frame (e.g. the first drift correction image)
+        window    : Apply a Hann window before transforming to suppress edge
+                    effects
+
+        """
+        self.shape  = reference.shape
+        self.window = None
+        if(window): self.window = np.outer(np.hanning(self.shape[0]),np.hanning(self.shape[1]))
+        
+        self.spectrum = np.conj(np.fft.rfft2(self.prepare(reference)))
+        
+    def prepare(self,im):
+        im = np.array(im,dtype=np.float64)
+        im[np.isnan(im)] = np.nanmean(im) if not np.isnan(im).all() else 0
+        im = ndimage.gaussian_filter(im, 0.5)                                   # Take the edge off pixel noise, which phase correlation amplifies
+        im = napfit.plane_fit_2d(im)
+        if(self.window is not None): im *= self.window
+        return im
+    
+    @tracing.traced("analysis")
+    def offset(self,im,dxy=[1,1],theta=0):
+        """
+        Returns the offset of im relative to the reference, with sub-pixel 
+        precision.
+
+        Parameters
+        ----------
+        im    : image to get the offset of. Must be the same size and scale
+                as the reference
+        dxy   : pixel size in x and y: [dx,dy]
+        theta : angle in degrees
+
+        Returns
+        -------
+        ox,oy      : offset in x and y
+        confidence : Peak-to-sidelobe ratio of the correlation peak. Compare 
+                     against driftReference.minConfidence to reject bad
+                     matches
+
+        """
+        if(im.shape != self.shape): raise ValueError("Frame shape " + str(im.shape) + " does not match reference " + str(self.shape))
+        
+        crossPower  = np.fft.rfft2(self.prepare(im))*self.spectrum
+        crossPower /= np.abs(crossPower) + 1e-15                                # Normalise so only the phase is compared
+        xcor = np.fft.irfft2(crossPower,s=self.shape)
+        
+        y,x  = np.unravel_index(xcor.argmax(), xcor.shape)
+        confidence = self.peakToSidelobe(xcor,y,x)
+        
+        sy = y + self.subPixel(xcor[(y-1)%self.shape[0],x],xcor[y,x],xcor[(y+1)%self.shape[0],x])
+        sx = x + self.subPixel(xcor[y,(x-1)%self.shape[1]],xcor[y,x],xcor[y,(x+1)%self.shape[1]])
+        if(sy > self.shape[0]/2): sy -= self.shape[0]                           # Correlation wraps around so large shifts are negative shifts
+        if(sx > self.shape[1]/2): sx -= self.shape[1]
+        
+        ox = -sx*dxy[0]                                                         # Same sign convention as the original correlate2d implementation
+        oy =  sy*dxy[1]
+        
+        theta *= math.pi/180                                                    # Convert to radians
+        ox,oy = rotate([0,0],[ox,oy],theta)
+        
+        return ox,oy,confidence
     
-    ox *= dxy[0]
-    oy *= -dxy[1]
+    def subPixel(self,left,centre,right):
+        denominator = left - 2*centre + right                                   # Vertex of a parabola through the peak and its neighbours
+        if(denominator >= 0): return 0
+        return 0.5*(left - right)/denominator
     
-    theta *= math.pi/180                                                        # Convert to radians
-    ox,oy = rotate([0,0],[ox,oy],theta)
+    def peakToSidelobe(self,xcor,y,x,exclude=5):
+        shifted = np.roll(xcor,(exclude - y,exclude - x),axis=(0,1))            # Move the peak to a fixed position so it can be masked out
+        sidelobe = shifted[2*exclude+1:,:].ravel()
+        sidelobe = np.concatenate([sidelobe,shifted[:2*exclude+1,2*exclude+1:].ravel()])
+        std = sidelobe.std()
+        if(std == 0): return np.inf
+        return (xcor[y,x] - sidelobe.mean())/std
     
-    return np.array([ox,oy])
-
 def rotate(origin, point, angle):
     """
     Taken from:
@@ -91,21 +172,27 @@ def rotate(origin, point, angle):
 ###############################################################################
 # Make gif
 ###############################################################################
-def makeGif(GIF):
+def makeGif(frames,path,fps=2):
     """
-    To Do: pass in list of images and turn them into a gif
+    Turn a list of frames into an animation. See animation.openWriter for 
+    incremental writing.
 
     Parameters
     ----------
-    data : TYPE
-        DESCRIPTION.
+    frames : List of (h,w,3) uint8 BGR images or paths to image files
+    path   : Output path. .gif, .mp4 or .webm
+    fps    : Frames per second
 
     Returns
     -------
-    None.
+    path : Output path
 
     """
-    pass
+    writer = animation.openWriter(path,fps=fps)
+    for frame in frames:
+        writer.append(frame)
+    writer.close()
+    return path
 ###############################################################################
 # Tip tracking
 ###############################################################################
@@ -126,25 +213,44 @@ def getAveragedFrame(cap,n=1,initialFrame=[]):
     """
     ret, avgFrame = cap.read()
     if(not ret): return ret, avgFrame
+    frame = avgFrame
     avgFrame = np.array(avgFrame).astype(np.float32)
     for i in range(n-1):
         ret, frame = cap.read()                                                 # Capture frame-by-frame
         if(not ret): return ret, frame
-        avgFrame += np.array(frame).astype(np.float32)
+        avgFrame += frame                                                       # Accumulate in place. No float copy of every frame
     
-    avgFrame = avgFrame/n
+    avgFrame /= n
     
     if(len(initialFrame)):
-        diff = abs(initialFrame.astype(float) - frame.astype(float))
-        tip = np.max(diff,axis=2)
-        tip /= np.max(tip)
-        mask = tip > 0.25
-        initialFrame[mask,:] = 0.0
-        diff = abs(initialFrame - frame)
-        avgFrame = np.max(diff,axis=2)
+        avgFrame = backgroundDifference(initialFrame,frame)
     
     return ret,avgFrame
 
+def backgroundDifference(initialFrame,frame):
+    """
+    Difference between a frame and the initial frame that makes the tip
+    stand out. Wherever the tip has moved away from where it was in the
+    initial frame, the initial frame is blacked out so the tip's old
+    position doesn't show up in the difference.
+
+    Parameters
+    ----------
+    initialFrame : Frame captured before the tip started moving
+    frame        : Current frame (raw or averaged)
+
+    Returns
+    -------
+    diff : Largest difference across the colour channels
+
+    """
+    background = np.array(initialFrame,dtype=np.float32)                        # Copy. The caller's frame is left alone
+    frame = np.asarray(frame,dtype=np.float32)
+    tip = np.max(abs(background - frame),axis=2)
+    mask = tip > 0.25*np.max(tip)
+    background[mask,:] = 0.0
+    return np.max(abs(background - frame),axis=2)
+
 def trackTip(ROI,tipPos):
     threshold = 160
     ret,thresh = cv2.threshold(ROI.astype(np.uint8),threshold,255,0)            # Set threshold values for finding contours. high threshold since we've saturated the edges
@@ -346,7 +452,8 @@ def drawCircle(event, x, y, flags, param):
 ###############################################################################
 # Classifying STM Images
 ###############################################################################
-def classify(scanData,filename,classificationHistory):
+@tracing.traced("analysis")
+def classify(scanData,filename,classificationHistory,detector=None):
     """
     This classifies scans based on the number of tip changes that occur in 
     them. If more than 5 tip changes occur, the scan is considered 'bad'. If
@@ -361,6 +468,8 @@ def classify(scanData,filename,classificationHistory):
     scanData    : Raw scan data
     filename    : .sxm filename
     classificationHistory : Running list of all previous classifications
+    detector    : tipChangeDetector that has been following this scan as it
+                  was acquired. A new one is used if None
 
     Returns
     -------
@@ -368,80 +477,162 @@ def classify(scanData,filename,classificationHistory):
 
     """
     nan = np.isnan(scanData).any()                                              # Flag to say there are nans in data which might affect  analysis
-    scanData = np.nan_to_num(scanData)
-    tipChangeCount = findTipChanges(scanData.copy())
+    if(detector is None): detector = tipChangeDetector()
+    result = detector.update(scanData)
     
-    i = 0
-    badScans = 0
     tipShape = 0
-    while(True and tipChangeCount > 5):
-        i -= 1
-        if(abs(i) > len(classificationHistory)): break
+    if(result["count"] > 5): tipShape = int(tipShapeDue(classificationHistory))
+        
+    classification = {"tipChanges"    : result["count"],
+                      "tipChangeRows" : result["rows"],
+                      "confidence"    : result["confidence"],
+                      "nan"           : nan,
+                      "tipShape"      : tipShape}
     
-        scan_i = classificationHistory[i]
+    return classification
+
+def tipShapeDue(classificationHistory,maxTipChanges=5,badScans=4):
+    """
+    Returns True if the last badScans complete scans in the history all had
+    more than maxTipChanges tip changes. Scans that were stopped midway (nan)
+    don't count either way. Together with a bad current scan that makes five
+    bad scans in a row.
+
+    """
+    tipChanges = [scan_i["tipChanges"] for scan_i in classificationHistory if not scan_i["nan"]][-badScans:]
+    return len(tipChanges) == badScans and min(tipChanges) > maxTipChanges
+
+def findTipChanges(scanData):
+    """
+    Returns the number of tip changes in scanData. See tipChangeDetector.
+
+    """
+    return tipChangeDetector().update(scanData)["count"]
+
+class tipChangeDetector():
+    """
+    Finds tip changes from row-to-row differences. A tip change shows up as a
+    horizontal streak: a step in z between consecutive lines that runs along
+    a good part of the line, unlike surface features.
+    
+    For each pair of lines, the fraction of pixels whose step is an outlier
+    (more than pixelThreshold robust standard deviations, all in the same
+    direction) is computed. Rows where that fraction is at least minFraction
+    and is itself an outlier compared to the other rows (robust z-score above
+    zThreshold) are tip changes. Small tip changes, where the whole line
+    shifts by less than the pixel noise, are caught by the mean step of each
+    line instead (outlier pixels clipped, robust z-score across lines above
+    shiftThreshold). Neighbouring rows are grouped into one tip change.
+    
+    Lines can be fed in as they're acquired: update() accepts partial frames
+    with unscanned lines set to NaN (as returned by Scan.FrameDataGrab while a
+    scan is running).
+
+    """
+    pixelThreshold = 4                                                          # Robust standard deviations for a pixel step to count as an outlier
+    minFraction    = 1/8                                                        # Fraction of a line a streak has to cover
+    zThreshold     = 5                                                          # Robust z-score for a row to stand out from the others
+    shiftThreshold = 8                                                          # Robust z-score of a whole-line shift. Higher, since topography moves line means around too
+    minRows        = 8                                                          # Rows needed before the row statistics mean anything
+    maxSamples     = 4096                                                       # Pixels sampled to estimate the noise
+    
+    def __init__(self):
+        self.shape     = None                                                   # Frame shape. A new frame resets the detector
+        self.result    = {"count": 0, "rows": [], "confidence": 0.0}
+    
+    def reset(self,shape):
+        self.shape     = shape
+        self.scored    = np.zeros(shape[0],dtype=bool)                          # Row pairs whose outlier counts are up to date
+        self.up        = np.zeros(shape[0],dtype=np.int32)                      # Number of pixels stepping up/down between line i-1 and line i
+        self.down      = np.zeros(shape[0],dtype=np.int32)
+        self.shift     = np.zeros(shape[0],dtype=np.float32)                    # Mean step between line i-1 and line i with outliers clipped
+        self.samples   = []                                                     # Strided samples of the steps, for the noise level
+        self.threshold = None                                                   # [centre,sigma] the counts were made with
+        self.result    = {"count": 0, "rows": [], "confidence": 0.0}
+    
+    @tracing.traced("analysis")
+    def update(self,scanData):
+        """
+        Parameters
+        ----------
+        scanData : Scan data, complete or partial. Lines containing NaNs are
+                   ignored. Only lines that weren't complete last time are 
+                   processed, unless the noise level has changed noticeably
+
+        Returns
+        -------
+        result : Dictionary with
+                    count      : Number of tip changes
+                    rows       : Row index of each tip change (the first line
+                                 after the change)
+                    confidence : How far the strongest row is from the
+                                 threshold, from 0 (right on it) to 1 (well
+                                 clear of it either way)
+
+        """
+        scanData = np.asarray(scanData)
+        if(scanData.shape != self.shape): self.reset(scanData.shape)
         
-        if(scan_i["nan"]):
-            continue                                                            # Don't count any scans that have been stopped midway
+        complete = ~np.isnan(scanData).any(axis=1)
+        pairs = np.flatnonzero(complete[1:] & complete[:-1]) + 1                # Lines that can be compared with the line before
+        new   = pairs[~self.scored[pairs]]
+        if(not len(new)): return self.result
         
-        if(scan_i["tipChanges"] > 5):                                           # If there are more than 5 tip changes in this scan, consider the tip unstable
-            badScans += 1                                                       # Keep track of the number of bad scans in a row
+        steps  = self.steps(scanData,new)
+        stride = max(1,scanData.size//self.maxSamples)
+        self.samples.append(steps.ravel()[::stride])
         
-        if(badScans > 3):                                                       # If we get to 5 bad scans in a row (the current one plus four from history), then we'll kick off tip shaping
-            tipShape = 1
-            break
+        sample = np.concatenate(self.samples)
+        centre = np.median(sample)                                              # Removes the slope in y
+        sigma  = 1.4826*np.median(np.abs(sample - centre))
+        sigma  = max(sigma,1e-6*np.max(np.abs(sample - centre)),np.finfo(np.float32).tiny)
         
-        if(scan_i["tipChanges"] <= 5):                                          # If we run into a good scan, before we hit 5 bad scans, don't tip shape... we need 5 bad scans in a row for that.
-            break
+        if(self.threshold is None or abs(sigma/self.threshold[1] - 1) > 0.2 or abs(centre - self.threshold[0]) > 0.5*sigma):
+            self.threshold = [centre,sigma]                                     # Noise estimate has moved. Recount everything
+            if(len(new) != len(pairs)):
+                new   = pairs
+                steps = self.steps(scanData,new)
         
-    classification = {"tipChanges" : tipChangeCount,
-                      "nan"        : nan,
-                      "tipShape"   : tipShape}
+        centre,sigma = self.threshold
+        self.up[new]     = np.count_nonzero(steps > centre + self.pixelThreshold*sigma,axis=1)
+        self.down[new]   = np.count_nonzero(steps < centre - self.pixelThreshold*sigma,axis=1)
+        self.shift[new]  = np.clip(steps,centre - self.pixelThreshold*sigma,centre + self.pixelThreshold*sigma).mean(axis=1)
+        self.scored[new] = True
+        
+        self.result = self.evaluate(pairs)
+        return self.result
     
-    return classification
-
-def findTipChanges(scanData):
-    scanData = np.diff(scanData,axis=0)**2                                      # Take the derivative in y to enhance tip changes that occur as horizontal lines. **2 to further enhance
-    scanData /= np.max(abs(scanData))                                           # Normalise
-    vmin, vmax = napfit.filter_sigma(scanData)                                  # Find 3 sigma
-    scanData -= vmin                                                            # Subtract the minimum
-    scanData /= abs(vmax - vmin)                                                # And divide by the range (3 sigma)
-    scanData[scanData > 1] = 1                                                  # Saturate everything over 1
-    scanData *= 255                                                             # Change the range so it's uint8 representable
-    grey = scanData.astype(np.uint8)                                            # Change the data type to uint8 for the Canny filter
-    
-    edges = cv2.Canny(grey, threshold1=50, threshold2=150, apertureSize = 3)    # Edge detection
-    lines = cv2.HoughLinesP(image=edges, rho=1, theta=np.pi/180, threshold=1,   # Pull lines from edges
-                            lines=np.array([]),minLineLength=1,maxLineGap=0)
-    
-    if(type(lines) == type(None)): lines = []                                   # Make it an empty list if there are no lines detected
-    
-    lineDict = {}                                                               # Dictionary to sort all lines according to their y-coodinate
-    for line in lines:                                                          
-        if(abs(line[0][1] == line[0][3])):                                      # Only process this line if it is horizontal (i.e. y1=y2)
-            if(line[0][1] in lineDict):                                         # If there's already a horizontal line at this y-coordinate
-                lineDict[line[0][1]].append(line)                               # Add it to the dictionary
-            else:                                                               # If this is the first horizontal line at this y-coordinate...
-                lineDict[line[0][1]] = [line]                                   # Create a new dictionary entry with the y-coordinate as the key and add the line
-
-    tipChanges = []                                                             # This will be the list of y-coordinates where tip changes have occurred
-    minLineLength=len(grey[0])/8                                                # Only count lines if they are at least 1/8 of the image in length
-    for y,lines in lineDict.items():                                            # For each y-coordinate we've found lines at
-        totalLength = 0
-        for line in lines:
-            totalLength += line[0][2] - line[0][0]                              # Accumulate total line length at this y coordinate.
-        if(totalLength > minLineLength):                                        # If the total length is greater than our threshold
-            tipChanges.append(y)                                                # Count this line as a tip change and append its y coord
-
-    tipChanges = np.sort(tipChanges)                                            # Sort coords by ascending order
-    diff = np.diff(tipChanges)                                                  # Group lines that are less than two pixels apart in y and
-    tipChangeCount = sum(diff > 2)                                              # Count the number of tip changes to be the number of groups
-    if(not tipChangeCount and len(tipChanges)): tipChangeCount += 1             # Some very fine tip changes can be missed without this
-    
-    return tipChangeCount
+    def steps(self,scanData,rows):
+        if(rows[-1] - rows[0] + 1 == len(rows)):                                # Contiguous. Slices avoid copying the frame twice
+            return np.subtract(scanData[rows[0]:rows[-1] + 1],scanData[rows[0] - 1:rows[-1]],dtype=np.float32)
+        return np.subtract(scanData[rows],scanData[rows - 1],dtype=np.float32)
+    
+    def evaluate(self,rows):
+        if(len(rows) <= self.minRows): return {"count": 0, "rows": [], "confidence": 0.0}
+        
+        fraction = np.maximum(self.up[rows],self.down[rows])/self.shape[1]
+        spread = 1.4826*np.median(np.abs(fraction - np.median(fraction)))
+        spread = max(spread,1/self.shape[1])                                    # At least one pixel's worth. Most rows usually have no outliers at all
+        z = (fraction - np.median(fraction))/spread
+        
+        shift  = self.shift[rows]
+        spread = 1.4826*np.median(np.abs(shift - np.median(shift)))
+        spread = max(spread,np.finfo(np.float32).tiny)
+        zShift = np.abs(shift - np.median(shift))/spread
+        
+        flagged = rows[((fraction >= self.minFraction) & (z > self.zThreshold)) | (zShift > self.shiftThreshold)]
+        groups  = []
+        if(len(flagged)): groups = np.split(flagged,np.flatnonzero(np.diff(flagged) > 2) + 1) # Rows less than two lines apart are the same tip change
+        
+        strongest = np.max(np.maximum(np.minimum(z/self.zThreshold,fraction/self.minFraction),zShift/self.shiftThreshold))
+        return {"count"      : len(groups),
+                "rows"       : [int(group[0]) for group in groups],
+                "confidence" : float(min(1,abs(strongest - 1)))}
 
 ###############################################################################
 # Analyse STM Images
 ###############################################################################
+@tracing.traced("analysis")
 def assessTip(scanData,lxy,xy,returnContour=False):
     """
     Assess the quality of the tip based on the imprint it left on the surface
@@ -449,7 +640,7 @@ def assessTip(scanData,lxy,xy,returnContour=False):
 
     Parameters
     ----------
-    scanData : raw scan data
+    scanData : raw scan data. Not modified
     lxy      : lenght and width of the scan frame (m)
     xy       : position the tip shape occurred relative to the centre of the 
                scan frame
@@ -458,7 +649,7 @@ def assessTip(scanData,lxy,xy,returnContour=False):
     -------
     symScore : score out of 10 for symmetry
     size     : size of the imprint area (nm2)
-    contour  : Image of the imprint with a contour drawn on it
+    contour  : Copy of the image with the imprint's contour drawn on it
 
     """
     lowpass  = ndimage.gaussian_filter(scanData, 20)                            # Lowpass filter the scandata
@@ -473,33 +664,38 @@ def assessTip(scanData,lxy,xy,returnContour=False):
     norm = norm.astype(np.uint8)
     ret,thresh = cv2.threshold(norm,threshold,255,0)                            # Set threshold values for finding contours. high threshold since we've saturated the edges
     contours,hierarchy = cv2.findContours(thresh, 1, 2)                         # Pull out all contours
-    contours = sorted(contours, key=cv2.contourArea)                            # Sort all the contours by ascending area. This will help when we have concentric contours that we need to deal with
     
     dxy = lxy/scanData.shape[0]
     # xy += np.array([lxy,lxy])/2
     # xy /= dxy
     # xy  = xy.astype(np.int)
-    xy = np.flip(np.unravel_index(np.argmax(np.flipud(highpass)),highpass.shape)) # Take the location of the brightest contour in the image
+    row,col = np.unravel_index(np.argmax(highpass),highpass.shape)              # Take the location of the brightest contour in the image
+    peak = (float(col),float(row))
+    
+    imprint = None                                                              # Smallest contour containing the peak. Concentric contours can all contain it
+    area    = np.inf
+    for c in contours:
+        x,y,w,h = cv2.boundingRect(c)
+        if(not (x <= col < x + w and y <= row < y + h)): continue               # Cheap rejection before the point-in-polygon test
+        if(cv2.pointPolygonTest(c,peak,False) < 0): continue                    # Peak is outside this contour (0 means on the edge)
+        cArea = cv2.contourArea(c)
+        if(cArea < area): imprint,area = c,cArea
     
     size = -1
     symScore = 1
-    tipImprint = np.zeros_like(scanData) + zMin
-    for idx,c in enumerate(contours):
-        mask = np.zeros_like(scanData)
-        cv2.drawContours(mask, contours, idx, 255, -1)                          # Draw filled contour in mask
-        mask = np.flipud(mask)
-        if(mask[xy[1],xy[0]] > 0):
-            mask = np.flipud(mask) > 0
-            tipImprint[mask] = highpass[mask]
-            size = cv2.contourArea(c)*dxy*dxy*1e18
-            perimeter = cv2.arcLength(c,True)*dxy*1e9
-            symScore = (4*np.pi*size)/(perimeter**2)
-            cv2.drawContours(scanData, contours, idx, 2*np.max(scanData), 1)    # Draw contour over original scanData
-            break
+    if(imprint is not None):
+        size = area*dxy*dxy*1e18
+        perimeter = cv2.arcLength(imprint,True)*dxy*1e9
+        symScore = (4*np.pi*size)/(perimeter**2)
     
     if(not returnContour): return symScore,size
-    return symScore, size, scanData
     
+    overlay = np.array(scanData,dtype=np.float64)                               # Draw on a copy so the caller's data is left alone
+    if(imprint is not None):
+        cv2.drawContours(overlay, [imprint], 0, 2*np.max(scanData), 1)          # Draw contour over the scan data
+    return symScore, size, overlay
+    
+@tracing.traced("analysis")
 def getCleanCoordinate(scanData,lxy):
     """
     Returns a coordinate w.r.t the centre of the scan frame that is free from
@@ -518,10 +714,11 @@ def getCleanCoordinate(scanData,lxy):
     
     return np.array([0.0,0.0])
 
+@tracing.traced("analysis")
 def isClean(scanData,lxy,threshold=1e-9,sensitivity=1):
     """
     Assess whether imaged surface is clean/flat. Function also works for 
-    incomplete images.
+    incomplete images. See cleanMonitor.
 
     Parameters
     ----------
@@ -537,36 +734,132 @@ def isClean(scanData,lxy,threshold=1e-9,sensitivity=1):
                   False: Area is not clean to within threshold.
 
     """
-    validScan = scanData[np.logical_not(np.isnan(scanData))]
-    
-    axy = (lxy/scanData.shape[0])**2                                            # Area per pixel
-    thresholdArea  = (1e9*lxy/10)*(threshold)**2                                # Threshold for the amount of 'unclean' area
-    thresholdArea /= sensitivity
-    
-    lowpass  = ndimage.gaussian_filter(validScan, 20)                           # Lowpass filter the scandata
-    highpass = validScan - lowpass                                              # Subtract the lowpass from original to get highpass
+    return cleanMonitor(lxy,threshold,sensitivity).update(scanData)["clean"]
+
+class cleanMonitor():
+    """
+    Streaming version of isClean for a scan in progress. Each update only
+    processes the lines completed since the last one.
     
-    unCleanMask         = abs(highpass) > 1*threshold                           # Mask for surface area that's unClean
-    unScannableMask     = abs(highpass) > 2*threshold                           # Mask for surface area that's unScannable
-    bailImmediatelyMask = abs(highpass) > 3*threshold                           # Mask for surface area that's extreme
+    The surface is high-pass filtered (image minus a 2D gaussian lowpass) and
+    pixels that stick out by more than 1, 2 and 3 times the threshold are 
+    counted as unclean, unscannable and extreme. Lines further than the
+    filter radius from the newest line are final. The last few are
+    recomputed each update as more context arrives.
     
-    unCleanArea         = np.sum(unCleanMask)*axy
-    unScannableArea     = np.sum(unScannableMask)*axy
-    bailImmediatelyArea = np.sum(bailImmediatelyMask)*axy
+    The area is called dirty as soon as either:
+        - The counted area so far exceeds a limit (it can only grow), or
+        - Once minFraction of the frame has been scanned, the per-line counts
+          project to more than a limit over the whole frame even at the low
+          end of their confidence interval (mean - confidence*standard error)
     
-    if(unCleanArea         > thresholdArea/1): return False
-    if(unScannableArea     > thresholdArea/2): return False
-    if(bailImmediatelyArea > thresholdArea/5): return False
+    It's only called clean once the whole frame has been scanned.
+
+    """
+    sigma       = 20                                                            # Lowpass filter width (px)
+    truncate    = 3                                                             # Filter radius in units of sigma
+    minFraction = 1/4                                                           # Fraction of the frame scanned before projecting
+    confidence  = 3                                                             # Standard errors below the projected area that still has to exceed the limit
+    reasons     = ["unclean area","unscannable area","extreme features"]
+    
+    def __init__(self,lxy,threshold=1e-9,sensitivity=1):
+        """
+        Parameters
+        ----------
+        lxy         : Length/width of scan frame in units of nm
+        threshold   : Threshold for cleanliness in units of nm
+        sensitivity : Scales the threshold area for which a surface is
+                      considered unclean. Larger = less tolerant.
+
+        """
+        self.lxy       = lxy
+        self.levels    = np.array([1,2,3])*threshold                            # unClean, unScannable, bailImmediately
+        thresholdArea  = (1e9*lxy/10)*(threshold)**2                            # Threshold for the amount of 'unclean' area
+        thresholdArea /= sensitivity
+        self.areaLimits = thresholdArea/np.array([1,2,5])
+        self.shape     = None
+    
+    def reset(self,shape):
+        self.shape    = shape
+        self.radius   = int(self.truncate*self.sigma + 0.5)
+        self.limits   = self.areaLimits/(self.lxy/shape[0])**2                  # Area limits in pixels
+        self.counts   = np.zeros((3,shape[0]),dtype=np.int64)                   # Pixels over each level, per line (in acquisition order)
+        self.lines    = 0                                                       # Number of complete lines
+        self.settled  = 0                                                       # Lines whose counts are final
+        self.reverse  = None                                                    # Lines are acquired from the bottom of the array up
+        self.result   = {"clean": True, "decided": False, "line": 0, "reason": ""}
+    
+    @tracing.traced("analysis")
+    def update(self,scanData):
+        """
+        Parameters
+        ----------
+        scanData : Scan data so far, with unscanned lines set to NaN
+
+        Returns
+        -------
+        result : Dictionary with
+                    clean   : False once the area has been called dirty
+                    decided : True once the call is final
+                    line    : Number of lines scanned when the call was made
+                    reason  : Why the area was called dirty
+
+        """
+        scanData = np.asarray(scanData)
+        if(scanData.shape != self.shape): self.reset(scanData.shape)
+        if(self.result["decided"]): return self.result
+        
+        complete = ~np.isnan(scanData).any(axis=1)
+        if(self.reverse is None and complete.any()):
+            self.reverse = bool(complete[-1] and not complete[0])               # Scanning up fills the array from the bottom
+        if(self.reverse): complete = complete[::-1]
+        
+        lines = len(complete) if complete.all() else int(np.argmin(complete))   # Contiguous complete lines from where the scan started
+        if(lines <= self.lines): return self.result
+        self.lines = lines
+        
+        total = self.shape[0]
+        data  = scanData[::-1] if self.reverse else scanData
+        start = max(0,self.settled - self.radius)                               # Context above the first line that needs (re)counting
+        block = np.asarray(data[start:lines],dtype=np.float64)
+        highpass = block - ndimage.gaussian_filter(block,self.sigma,truncate=self.truncate,mode='reflect')
+        highpass = np.abs(highpass[self.settled - start:])
+        for level,value in enumerate(self.levels):
+            self.counts[level,self.settled:lines] = np.count_nonzero(highpass > value,axis=1)
+        self.settled = lines if lines == total else max(self.settled,lines - self.radius)
+        
+        counts = self.counts[:,:lines]
+        over = counts.sum(axis=1) > self.limits
+        if(over.any()): return self.decide(False,self.reasons[int(np.argmax(over))])
+        
+        if(lines == total): return self.decide(True)
+        
+        if(lines >= self.minFraction*total):
+            mean = counts.mean(axis=1)
+            se   = counts.std(axis=1)/np.sqrt(lines)
+            over = (mean - self.confidence*se)*total > self.limits
+            if(over.any()): return self.decide(False,self.reasons[int(np.argmax(over))] + " (projected)")
+        
+        return self.result
     
-    return True
+    def decide(self,clean,reason=""):
+        self.result = {"clean": clean, "decided": True, "line": self.lines, "reason": reason}
+        return self.result
 
+@tracing.traced("analysis")
 def findIslands(scanData,lxy,curvatureThreshold=4,minIslandArea=30,minGoopArea=2):
     """
-    Utility that decomposes a scan into islands and substrate
+    Utility that decomposes a scan into islands and substrate.
+    
+    The scan is split into regions bounded by edges (strong gradients) and
+    bright features. Each region is labelled once and everything about it
+    (area, curvature, classification) is worked out with per-label
+    reductions, so memory and time don't grow with the number of regions.
 
     Parameters
     ----------
-    scanData : raw scan data
+    scanData : raw scan data. Lines not scanned yet (NaN) are treated as
+               edges
     lxy      : scan range [x,y](m)
     curvatureThreshold : islands with sum(abs(mean curvature)) less than this 
                          threshold are considered substrate. otherwise 
@@ -575,79 +868,84 @@ def findIslands(scanData,lxy,curvatureThreshold=4,minIslandArea=30,minGoopArea=2
     minIslandArea : minimum size of something considered an island (nm2)        # Note: Bare regions of substrate are also considered islands
     minGoopArea   : minimum size of something considered goop (nm2)
 
+    Returns
+    -------
+    result : Dictionary with
+                labels    : int32 label image. 0 is edges/features between
+                            regions. Region i has label i
+                regions   : Region table. Dictionary of arrays indexed by
+                            label (row 0 is the edges):
+                                area      : Area (nm2)
+                                pixels    : Number of pixels
+                                centroid  : [x,y] (px)
+                                bbox      : [x,y,w,h] (px)
+                                curvature : Total abs mean curvature per 
+                                            unit area
+                                kind      : 'edge', 'noise', 'goop', 
+                                            'substrate' or 'molecules'
+                substrate : Image of the substrate islands (height above
+                            the bottom of each island). Zero elsewhere
+                molecules : Same for islands classified as molecules/sample
+
     """
     lxy = np.array(lxy)                                                         # Ensure it's a numpy array
-    pxy = np.array(scanData.shape[1],scanData.shape[0])                         # Num pixels [x,y]
+    pxy = np.array([scanData.shape[1],scanData.shape[0]])                       # Num pixels [x,y]
     dxy = np.array(lxy/pxy)                                                     # Real size of each pixel on the figure (this is not the resolution of the actual data)
     pixelArea = dxy[0]*dxy[1]*1e18                                              # Area of each pixel in units of nm2
     
-    im = normalise(scanData.copy(), 255).astype(np.uint8)                       # Normalise the data and convert it to uint8 for the canny filter later
+    finite = np.isfinite(scanData)
+    if(not finite.all()):                                                       # Partially scanned frame. Fill the gap so the filters don't spread NaNs
+        scanData = np.where(finite,scanData,scanData[finite].mean())
     
-    lowpass = ndimage.gaussian_filter(scanData, 2)
-    gxy  = np.gradient(lowpass,*dxy)                                            # Not sure if it should be dx,dy or dy,dx here
-    grad = np.sqrt(gxy[0]**2 + gxy[1]**2)
-    grad = normalise(grad,255).astype(np.uint8)
-    mask = grad > 127
-    
-    edgeEnhanced = im.copy()
-    edgeEnhanced[mask] = 255                                                    # Set edges to saturation
-    edgeEnhanced[0][:] = 255                                                    # Saturate the top border. Saturating the border ensures no open contours later
-    edgeEnhanced[pxy[1]-1][:] = 255                                             # Saturate the bottom border
-    edgeEnhanced[:,0] = 255                                                     # Saturate the left border
-    edgeEnhanced[:,pxy[0]-1] = 255                                              # Saturate the right border
-    
-    ret,thresh = cv2.threshold(edgeEnhanced,240,255,0)                          # Set threshold values for finding contours. high threshold since we've saturated the edges
-    contours,hierarchy = cv2.findContours(thresh, 1, 2)                         # Pull out all contours
-    contours = sorted(contours, key=cv2.contourArea)                            # Sort all the contours by ascending area. This will help when we have concentric contours that we need to deal with
+    im = normalise(np.array(scanData,dtype=np.float64), 255, mask=finite)       # Normalise the data to 0-255
     
-    goop     = []                                                               # List of 2D arrays, each containing one piece of 'goop' from the raw image
-    goopMask = []                                                               # List of 2D boolean arrays that contain the mask for the goop in the above array
-    for idx,c in enumerate(contours):
-        area = cv2.contourArea(c)*pixelArea                                     # Area of the contour in nm2
-        if(area > minGoopArea and area < minIslandArea):                        # Anything between these two values is considered 'goop'
-            mask = np.zeros_like(scanData)
-            cv2.drawContours(mask, contours, idx, 255, -1)                      # Draw filled contour in mask
-            mask = mask> 0                                                      # Convert to bool
-            
-            goopMask.append(mask)                                               # Append this mask to the list of goop
-            goop.append(np.zeros_like(scanData))                                # Append new image to list of goop
-            goop[-1][mask] = (im[mask] - np.min(im[mask]))                      # Anything outside the mask remains zero. anything inside the mask is filled with the original data
-    totalGoopMask = np.sum(goopMask,0) > 0                                      # Sum of all that is considered goop
-    
-    island     = []                                                             # List of 2D image arrays, each will contain a single island
-    islandMask = []                                                             # List of 2D mask arrays, each will contain the corresponding mask for an island
-    totalIslandMask = np.zeros_like(scanData) > 0                               # Running total mask of all islands.
-    for idx,c in enumerate(contours):                                           # Loop through all the contours
-        area = cv2.contourArea(c)*pixelArea                                     # Calculate the area in nm2
-        if(area > 0.95*pxy[0]*pxy[1]*pixelArea): continue                       # If the area is the the ~whole scan window, it's probably the artificial contour we've drawn around it so skip it
-        if(area > minIslandArea):                                               # If is large enough to be considered an island...
-            mask = np.zeros_like(scanData)                                      # This will contain the mask for this island
-            cv2.drawContours(mask, contours, idx, 255, -1)                      # Draw filled contour in mask
-            
-            mask = mask > 0                                                     # Convert it to bool
-            islandMask.append(mask)                                             # Append this mask to the list of masks
-            island.append(np.zeros_like(scanData))                              # Append a new image to our list of islands
-            island[-1][mask] = im[mask]                                         # Grab the island from the original image
-            island[-1][totalGoopMask]   -= im[totalGoopMask]                    # Get rid of the goop
-            island[-1][totalIslandMask] -= im[totalIslandMask]                  # Get rid of any smaller islands we've already found within it. This only works because we've sorted the contours by ascending area already
-            island[-1][~mask] = 0                                               # Anything outside our island should just be zero
-            island[-1][island[-1]<0] = 0                                        # Anything within our island that was subtracted in the previous step should also be zero
-            island[-1][island[-1]>0] -=np.min( island[-1][island[-1]>0])        # Bring the bottom of the island to zero
-        
-            totalIslandMask = totalIslandMask | (islandMask[-1] > 0)            # Append this island to the total island mask
-    
-    substrate = np.zeros_like(scanData)                                         # Substrate mask
-    molecules = np.zeros_like(scanData)                                         # Molecules/sample mask
-    for idx,i in enumerate(island):                                             # Loop through everyhing we've considered an island
-        H = meanCurvature(i,dxy*1e10)                                           # Calculate the mean curvature (numbers are weird when dxy is really small so multiply by a large constant)
-        H[~islandMask[idx]] = 0                                                 # Force everything outside the island to zero
-        hfactor = np.sum(abs(H)/(pixelArea*np.sum(i>0)))                        # Sum the total curvature and divide by area
-        if(hfactor < curvatureThreshold):                                       # Anything less than the curvature threshold is considered flat enough to be substrate.
-            substrate += i
-        else:                                                                   # Otherwise count it as molecules/sample
-            molecules += i
-    
-    return {"substrate" : substrate,
+    lowpass = ndimage.gaussian_filter(scanData, 2)
+    gy,gx = np.gradient(lowpass,dxy[1],dxy[0])                                  # Rows are y, columns are x
+    grad  = normalise(np.sqrt(gx**2 + gy**2),255,mask=finite)
+    
+    edges = (grad > 127) | (im > 240) | ~finite                                 # Edges and saturated features separate the regions
+    edges[[0,-1],:] = True                                                      # Close off the border so regions touching it are still bounded
+    edges[:,[0,-1]] = True
+    
+    count,labels,stats,centroids = cv2.connectedComponentsWithStats((~edges).astype(np.uint8),connectivity=4,ltype=cv2.CV_32S)
+    
+    pixels = stats[:,cv2.CC_STAT_AREA].astype(np.int64)
+    area   = pixels*pixelArea
+    
+    floor = np.full(count,np.inf)                                               # Bottom of each region
+    np.minimum.at(floor,labels.ravel(),im.ravel())
+    floor[0] = 0
+    height = im - floor[labels]                                                 # Every region relative to its own bottom. Edges are zero
+    height[labels == 0] = 0
+    
+    H = np.abs(meanCurvature(height,dxy*1e10))                                  # Calculate the mean curvature (numbers are weird when dxy is really small so multiply by a large constant)
+    H[labels == 0] = 0
+    curvatureSum = np.bincount(labels.ravel(),weights=H.ravel(),minlength=count)
+    raised       = np.bincount(labels.ravel(),weights=(height > 0).ravel(),minlength=count)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        curvature = np.where(raised > 0,curvatureSum/(pixelArea*raised),0)      # Sum the total curvature and divide by area
+    
+    kind = np.full(count,'noise',dtype='<U9')
+    kind[(area > minGoopArea) & (area < minIslandArea)] = 'goop'                # Anything between these two values is considered 'goop'
+    islands = area > minIslandArea
+    kind[islands & (curvature <  curvatureThreshold)] = 'substrate'             # Anything less than the curvature threshold is considered flat enough to be substrate.
+    kind[islands & (curvature >= curvatureThreshold)] = 'molecules'             # Otherwise count it as molecules/sample
+    kind[0] = 'edge'
+    
+    regionKind = kind[labels]
+    substrate  = np.where(regionKind == 'substrate',height,0)
+    molecules  = np.where(regionKind == 'molecules',height,0)
+    
+    regions = {"area"      : area,
+               "pixels"    : pixels,
+               "centroid"  : centroids,
+               "bbox"      : stats[:,:4],
+               "curvature" : curvature,
+               "kind"      : kind}
+    
+    return {"labels"    : labels,
+            "regions"   : regions,
+            "substrate" : substrate,
             "molecules" : molecules}
 
 def meanCurvature(Z,dxy=[1,1]):
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:02:17 2026
+
+Bounded background worker pool for non-instrument work (rendering, uploads,
+analysis) so acquisition doesn't wait on it.
+"""
+
+from scanbot.server import tracing
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+class bounded_pool():
+    """
+    Thread pool with back-pressure. submit() blocks once maxPending tasks are
+    queued or running so a slow consumer can't build up an unbounded backlog
+    of frames in memory.
+
+    """
+    def __init__(self,workers=1,maxPending=2,name="scanbot-worker",onError=None):
+        """
+        Parameters
+        ----------
+        workers    : Number of worker threads. Keep this at 1 when tasks must
+                     complete in the order they were submitted.
+        maxPending : Maximum number of tasks queued or running before submit
+                     blocks
+        name       : Thread name prefix
+        onError    : Callable onError(exception) called from the worker when a
+                     task raises. Exceptions are otherwise printed.
+
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers,thread_name_prefix=name)
+        self.slots    = threading.BoundedSemaphore(maxPending)
+        self.onError  = onError
+        self.futures  = []
+        self.lock     = threading.Lock()
+
+    def submit(self,func,*args,**kwargs):
+        """
+        Queue func(*args,**kwargs). Blocks while the pool is full.
+
+        Returns
+        -------
+        future : concurrent.futures.Future for the task
+
+        """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.run,tracing.bind(func),*args,**kwargs) # Spans from the task belong to the caller's job
+        except:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.futures = [f for f in self.futures if not f.done()] + [future]
+        return future
+
+    def run(self,func,*args,**kwargs):
+        try:
+            return func(*args,**kwargs)
+        except Exception as e:
+            if(self.onError): self.onError(e)
+            else: print("Background task failed: " + str(e))
+        finally:
+            self.slots.release()
+
+    def drain(self,timeout=None):
+        """
+        Wait for every submitted task to finish.
+
+        Parameters
+        ----------
+        timeout : Maximum time to wait for each task (s). None waits forever.
+
+        """
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.result(timeout=timeout)
+
+    def pending(self):
+        with self.lock:
+            return sum(not f.done() for f in self.futures)
+
+    def shutdown(self,wait=True):
+        self.executor.shutdown(wait=wait)